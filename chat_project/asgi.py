@@ -16,15 +16,20 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_project.production_setting
 # Initialize Django ASGI application early to ensure the AppRegistry is populated
 django_asgi_app = get_asgi_application()
 
+from chatapp import write_behind
+
+# Replay messages a crashed predecessor left in the write-behind journal
+write_behind.startup()
+
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 from channels.security.websocket import AllowedHostsOriginValidator
 from chatapp.routing import websocket_urlpatterns
+from chatapp.tickets import TicketAuthMiddleware
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
     "websocket": AllowedHostsOriginValidator(
-        AuthMiddlewareStack(
+        TicketAuthMiddleware(
             URLRouter(
                 websocket_urlpatterns
             )
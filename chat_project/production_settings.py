@@ -70,16 +70,21 @@ ASGI_APPLICATION = 'chat_project.asgi.application'
 
 # Database
 DATABASES = {
-    'default': dj_database_url.config(
+    'default': with_pool(dj_database_url.config(
         default=os.environ.get('DATABASE_URL'),
         conn_max_age=600,
-    )
+    ))
 }
 
 # Channel Layer
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        # runworkers --affinity sets CHAT_LOCAL_FANOUT so group messages for
+        # connections on the same worker skip the Redis round trip
+        'BACKEND': (
+            'chatapp.layers.LocalFanoutChannelLayer' if os.getenv('CHAT_LOCAL_FANOUT', 'False') == 'True'
+            else 'channels_redis.core.RedisChannelLayer'
+        ),
         'CONFIG': {
             'hosts': [os.environ.get('REDIS_URL', 'redis://localhost:6379')],
         },
@@ -158,9 +163,6 @@ CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.redis.RedisCache',
         'LOCATION': os.environ.get('REDIS_URL', 'redis://localhost:6379'),
-        'OPTIONS': {
-            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
-        }
     }
 }
 
@@ -84,9 +84,35 @@ DATABASES = {
     }
 }
 
+if os.getenv('DATABASE_URL'):
+    import dj_database_url
+    DATABASES['default'] = dj_database_url.parse(os.environ['DATABASE_URL'])
+
+
+def with_pool(database):
+    """Postgres with psycopg 3 only: give each worker a connection pool so
+    database calls from consumers run on parallel threads instead of queueing
+    on one. Pooled connections replace persistent ones. Also applied by
+    production_settings to its own DATABASES."""
+    if os.getenv('CHAT_DB_POOL', 'False') == 'True' and database['ENGINE'] == 'django.db.backends.postgresql':
+        database['CONN_MAX_AGE'] = 0
+        database.setdefault('OPTIONS', {})['pool'] = {
+            'min_size': 2,
+            'max_size': int(os.getenv('CHAT_DB_POOL_SIZE', '10')),
+        }
+    return database
+
+
+DATABASES['default'] = with_pool(DATABASES['default'])
+
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        # runworkers --affinity sets CHAT_LOCAL_FANOUT so group messages for
+        # connections on the same worker skip the Redis round trip
+        'BACKEND': (
+            'chatapp.layers.LocalFanoutChannelLayer' if os.getenv('CHAT_LOCAL_FANOUT', 'False') == 'True'
+            else 'channels_redis.core.RedisChannelLayer'
+        ),
         'CONFIG': {
             'hosts': [os.getenv('REDIS_URL', 'redis://localhost:6379')],
             'capacity': 1500,
@@ -95,6 +121,195 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Id (0-63) used by chatapp.ids to keep allocated message ids unique across
+# processes; required, and distinct for every worker, when write-behind is
+# enabled (runworkers sets it)
+CHAT_WORKER_ID = os.getenv('CHAT_WORKER_ID')
+
+# Write-behind message persistence: broadcast first, then bulk insert in batches
+CHAT_WRITE_BEHIND = {
+    'ENABLED': os.getenv('CHAT_WRITE_BEHIND', 'False') == 'True',
+    'BATCH_SIZE': 200,
+    'FLUSH_INTERVAL': 0.25,
+    'JOURNAL_DIR': os.path.join(BASE_DIR, 'var', 'write_behind'),
+    'FSYNC': False,
+    'MAX_ATTEMPTS': 40,
+}
+
+# Per-process LRU/TTL cache of Room and User rows, room memberships and avatars
+# used by the WebSocket consumer
+CHAT_IDENTITY_CACHE = {
+    'ROOM_MAXSIZE': 10000,
+    'USER_MAXSIZE': 50000,
+    'MEMBERSHIP_MAXSIZE': 200000,
+    'TTL': 300,
+}
+
+# Signed WebSocket tickets handed out with room pages; a handshake carrying an
+# unexpired one skips the session and user queries
+CHAT_WS_TICKETS = {
+    'TTL': 60,
+}
+
+# Typing indicators are kept in memory and broadcast once per room per INTERVAL
+# seconds; an entry expires TTL seconds after the user's last typing frame
+CHAT_TYPING = {
+    'INTERVAL': 0.5,
+    'TTL': 5,
+}
+
+# Read receipts are stored as per-(room, user) "read up to" cursors, written and
+# broadcast in one batch every FLUSH_INTERVAL seconds
+CHAT_READ_RECEIPTS = {
+    'FLUSH_INTERVAL': 1.0,
+}
+
+# Page sizes for the keyset-paginated message history API, and the most
+# messages replayed to a client that reconnects with last_message_id
+CHAT_HISTORY = {
+    'PAGE_SIZE': 50,
+    'MAX_PAGE_SIZE': 200,
+    'MAX_REPLAY': 500,
+}
+
+# Presence: connections per user are counted in the cache with a TTL kept alive
+# by client heartbeats; status changes are broadcast per room every
+# BROADCAST_INTERVAL seconds and written to UserProfile every DB_FLUSH_INTERVAL
+CHAT_PRESENCE = {
+    'BROADCAST_INTERVAL': 1.0,
+    'HEARTBEAT_INTERVAL': 20,
+    'TTL': 60,
+    'DB_FLUSH_INTERVAL': 30,
+}
+
+# Ring buffer of each room's newest serialized messages. 'auto' keeps it in Redis
+# when CACHES['default'] is the Redis backend and in process memory otherwise
+CHAT_RECENT_MESSAGES = {
+    'BACKEND': 'auto',
+    'SIZE': 200,
+    'TTL': 3600,
+    'MAX_ROOMS': 1000,
+}
+
+# Chunked, resumable uploads (/chat/api/uploads/). Chunks are streamed to
+# TEMP_DIR, then a background thread verifies the SHA-256, saves the file to
+# default storage and broadcasts the file message. Sessions stuck writing a
+# chunk or processing for STALE_AFTER seconds (a worker died) are recovered
+# by the retention command and when the client asks for its offset.
+CHAT_UPLOADS = {
+    'TEMP_DIR': os.path.join(BASE_DIR, 'var', 'uploads'),
+    'CHUNK_SIZE': 4 * 1024 * 1024,
+    'MAX_FILE_SIZE': 1024 * 1024 * 1024,
+    'WORKERS': 2,
+    'STALE_AFTER': 3600,
+}
+
+# WebP derivatives made in a background pool for uploaded avatars and image
+# files, as {label: longest side in px}; their URLs appear in message and
+# presence payloads
+CHAT_THUMBNAILS = {
+    'AVATAR_SIZES': {'small': 48, 'medium': 128},
+    'IMAGE_SIZES': {'thumb': 320, 'preview': 1024},
+    'QUALITY': 80,
+    'WORKERS': 2,
+    'URL_CACHE_SIZE': 10000,
+    'URL_CACHE_TTL': 300,
+}
+
+# Lobby room directory: RoomStats aggregates are updated from the consumer
+# every FLUSH_INTERVAL seconds and directory pages are cached for CACHE_TTL
+# seconds, so new rooms and activity show up with that much delay.
+CHAT_ROOM_DIRECTORY = {
+    'FLUSH_INTERVAL': 1.0,
+    'PAGE_SIZE': 50,
+    'MAX_PAGE_SIZE': 200,
+    'CACHE_TTL': 10,
+}
+
+# Ranked message search. BACKEND 'auto' uses the tsvector column and GIN
+# index on Postgres and an in-process inverted index elsewhere ('memory'),
+# keeping at most MAX_ROOMS room indexes per process.
+CHAT_SEARCH = {
+    'BACKEND': 'auto',
+    'PAGE_SIZE': 20,
+    'MAX_PAGE_SIZE': 100,
+    'MAX_ROOMS': 100,
+}
+
+# Retention (python manage.py retention [--periodic]). Messages older than
+# ARCHIVE_AFTER_DAYS move to compressed JSON-lines segments in the default
+# storage under LOCATION (zstd, or gzip with a warning if zstandard is missing)
+# and history reads them back transparently. ROOMS overrides
+# ARCHIVE_AFTER_DAYS / PURGE_DELETED_AFTER_DAYS by room name; None disables.
+CHAT_RETENTION = {
+    'ARCHIVE_AFTER_DAYS': 90,
+    'PURGE_DELETED_AFTER_DAYS': 7,
+    'RECEIPTS_AFTER_DAYS': 30,
+    'TYPING_AFTER_SECONDS': 300,
+    'BATCH_SIZE': 1000,
+    'INTERVAL': 3600,
+    'CODEC': 'zstd',
+    'LOCATION': 'archive',
+    'SEGMENT_CACHE': 16,
+    'SEGMENT_CACHE_TTL': 300,
+    'ROOMS': {},
+}
+
+# Room export/import (export_room / import_room commands and
+# /chat/api/rooms/<room>/export/): rows per bulk_create and iterator() fetch,
+# and bytes per chunk of the streamed response.
+CHAT_TRANSFER = {
+    'BATCH_SIZE': 2000,
+    'CHUNK_BYTES': 65536,
+}
+
+# Threads: replies go only to participants; root reply counts are updated and
+# broadcast once per FLUSH_INTERVAL. PARENT_MAXSIZE messages are remembered
+# so replying needs no parent lookup. PAGE_SIZE/MAX_PAGE_SIZE apply to
+# /chat/api/rooms/<room>/threads/<message_id>/.
+CHAT_THREADS = {
+    'FLUSH_INTERVAL': 1.0,
+    'CACHE_TTL': 3600,
+    'PARENT_MAXSIZE': 100000,
+    'PAGE_SIZE': 100,
+    'MAX_PAGE_SIZE': 500,
+}
+
+# Token-bucket limits per frame type as (tokens per second, burst), per user
+# and per room. BACKEND 'local' keeps buckets per process; 'cache' shares them
+# across workers through the Redis cache at one round trip per limited frame.
+CHAT_RATE_LIMITS = {
+    'ENABLED': True,
+    'BACKEND': os.getenv('CHAT_RATE_LIMIT_BACKEND', 'local'),
+    'LIMITS': {
+        'message': {'user': (2, 10), 'room': (50, 200)},
+        'reaction': {'user': (5, 20), 'room': (100, 400)},
+        'resume': {'user': (0.2, 3)},
+    },
+}
+
+# Reaction counts are broadcast per message at most once per FLUSH_INTERVAL;
+# changed counts are cached for CACHE_TTL so buffered history stays current
+CHAT_REACTIONS = {
+    'FLUSH_INTERVAL': 0.25,
+    'CACHE_TTL': 3600,
+}
+
+# /chat/metrics/ (Prometheus text format). Scrapers must send
+# "Authorization: Bearer <TOKEN>"; without a TOKEN only staff users get in
+CHAT_METRICS = {
+    'TOKEN': os.getenv('CHAT_METRICS_TOKEN'),
+}
+
+# Per-connection outbound queue (frames). Past SHED_THRESHOLD typing/presence
+# frames are dropped; at MAX_QUEUE the client is disconnected and resumes with
+# last_message_id. Queues at LAG_THRESHOLD or deeper count as lagging.
+CHAT_OUTBOUND = {
+    'MAX_QUEUE': 500,
+    'SHED_THRESHOLD': 100,
+    'LAG_THRESHOLD': 50,
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
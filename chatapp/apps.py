@@ -5,8 +5,5 @@ class ChatappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chatapp'
 
-
-
-
-
-
+    def ready(self):
+        from . import metrics, signals  # noqa: F401
@@ -0,0 +1,222 @@
+import gzip
+import json
+import logging
+from urllib.parse import unquote
+
+from django.conf import settings
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from .conf import get_config
+from .identity_cache import LRUCache
+from .models import ArchiveSegment
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:  # optional; archives fall back to gzip
+    zstandard = None
+
+DEFAULTS = {
+    'CODEC': 'zstd',
+    'LOCATION': 'archive',
+    'SEGMENT_CACHE': 16,
+    'SEGMENT_CACHE_TTL': 300,
+}
+
+
+class GzipCodec:
+    name = 'gzip'
+    extension = 'gz'
+
+    def compress(self, data):
+        return gzip.compress(data)
+
+    def decompress(self, data):
+        return gzip.decompress(data)
+
+
+class ZstdCodec:
+    name = 'zstd'
+    extension = 'zst'
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=10).compress(data)
+
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+CODECS = {'gzip': GzipCodec()}
+if zstandard is not None:
+    CODECS['zstd'] = ZstdCodec()
+
+
+def get_settings():
+    return get_config('CHAT_RETENTION', DEFAULTS)
+
+
+_unavailable = set()
+
+
+def get_codec():
+    """The configured codec, or gzip (with a warning) when it isn't installed."""
+    name = get_settings()['CODEC']
+    if name in CODECS:
+        return CODECS[name]
+    if name not in _unavailable:
+        _unavailable.add(name)
+        logger.warning('Archive codec %r is not available; writing gzip segments', name)
+    return CODECS['gzip']
+
+
+def entry_key(entry):
+    """Keyset position (timestamp, id) of a serialized message."""
+    return parse_datetime(entry['timestamp']), entry['message_id']
+
+
+def write_segment(room_id, month, entries):
+    """Store serialized ``entries`` (in key order) as one compressed file.
+
+    Returns an unsaved ArchiveSegment describing it. Files are never
+    modified afterwards, so any storage backend will do.
+    """
+    codec = get_codec()
+    payload = ''.join(json.dumps(entry, separators=(',', ':')) + '\n' for entry in entries).encode()
+    name = (
+        f"{get_settings()['LOCATION']}/{room_id}/{month}/"
+        f"{entries[0]['message_id']}-{entries[-1]['message_id']}.jsonl.{codec.extension}"
+    )
+    path = default_storage.save(name, ContentFile(codec.compress(payload)))
+    first, last = entry_key(entries[0]), entry_key(entries[-1])
+    return ArchiveSegment(
+        room_id=room_id,
+        month=month,
+        path=path,
+        codec=codec.name,
+        message_count=len(entries),
+        first_timestamp=first[0],
+        first_message_id=first[1],
+        last_timestamp=last[0],
+        last_message_id=last[1],
+    )
+
+
+def delete_file(path):
+    default_storage.delete(path)
+
+
+_segments = LRUCache(get_settings()['SEGMENT_CACHE'], get_settings()['SEGMENT_CACHE_TTL'])
+
+
+def read_segment(segment, cache=True):
+    """Serialized messages of ``segment``, decoded once per process while cached."""
+    # Keyed by path too: a database may hand a compacted segment's pk out again
+    key = (segment.pk, segment.path)
+    entries = _segments.get(key) if cache else None
+    if entries is None:
+        codec = CODECS.get(segment.codec)
+        if codec is None:
+            raise RuntimeError(f'{segment.codec} is needed to read archive segment {segment.path}')
+        with default_storage.open(segment.path, 'rb') as archived:
+            data = codec.decompress(archived.read())
+        entries = [json.loads(line) for line in data.splitlines()]
+        if cache:
+            _segments.set(key, entries)
+    return entries
+
+
+def in_timeline(entry):
+    # Thread replies are archived alongside their roots but only shown in threads
+    return entry.get('thread_root_id') is None
+
+
+def entries_before(room_id, key, count):
+    """Up to ``count`` archived messages older than ``key`` (the newest when None).
+
+    Returns ``(entries, has_more)`` in chronological order. Segments are
+    opened newest first and only until none of the rest can hold one of
+    the ``count`` newest matches.
+    """
+    segments = ArchiveSegment.objects.filter(room_id=room_id)
+    if key is not None:
+        segments = segments.filter(
+            Q(first_timestamp__lt=key[0]) | Q(first_timestamp=key[0], first_message_id__lt=key[1])
+        )
+    collected = []
+    for segment in segments.order_by('-last_timestamp', '-last_message_id'):
+        if len(collected) > count and (segment.last_timestamp, segment.last_message_id) < entry_key(collected[-count - 1]):
+            break
+        collected.extend(
+            entry for entry in read_segment(segment)
+            if in_timeline(entry) and (key is None or entry_key(entry) < key)
+        )
+        collected.sort(key=entry_key)
+    return collected[max(0, len(collected) - count):], len(collected) > count
+
+
+def entries_after(room_id, key, count):
+    """Up to ``count`` archived messages newer than ``key``, oldest first, and
+    whether there are more."""
+    segments = ArchiveSegment.objects.filter(room_id=room_id).filter(
+        Q(last_timestamp__gt=key[0]) | Q(last_timestamp=key[0], last_message_id__gt=key[1])
+    )
+    collected = []
+    for segment in segments.order_by('first_timestamp', 'first_message_id'):
+        if len(collected) > count and (segment.first_timestamp, segment.first_message_id) > entry_key(collected[count]):
+            break
+        collected.extend(entry for entry in read_segment(segment) if in_timeline(entry) and entry_key(entry) > key)
+        collected.sort(key=entry_key)
+    return collected[:count], len(collected) > count
+
+
+def find_entry(room_id, message_id):
+    """The archived entry of message ``message_id`` in the room, or None.
+
+    Ids grow with time, so only the segment whose id range should hold it
+    and its neighbours (for clock skew between workers) are read.
+    """
+    segments = ArchiveSegment.objects.filter(room_id=room_id)
+    candidates = list(segments.filter(first_message_id__lte=message_id).order_by('-first_message_id')[:2])
+    candidates += segments.filter(first_message_id__gt=message_id).order_by('first_message_id')[:1]
+    for segment in candidates:
+        for entry in read_segment(segment):
+            if entry['message_id'] == message_id:
+                return entry
+    return None
+
+
+def thread_entries(room_id, root):
+    """Archived messages of the thread whose archived root entry is ``root``,
+    in key order: the root, then its replies up to ``last_reply_at``."""
+    start = entry_key(root)
+    end = parse_datetime(root['last_reply_at']) if root.get('last_reply_at') else start[0]
+    segments = ArchiveSegment.objects.filter(room_id=room_id, first_timestamp__lte=end).filter(
+        Q(last_timestamp__gt=start[0]) | Q(last_timestamp=start[0], last_message_id__gte=start[1])
+    )
+    entries = [
+        entry
+        for segment in segments.order_by('first_timestamp', 'first_message_id')
+        for entry in read_segment(segment)
+        if entry['message_id'] == root['message_id'] or entry.get('thread_root_id') == root['message_id']
+    ]
+    entries.sort(key=entry_key)
+    return entries
+
+
+def stored_file(entry):
+    """Storage name of an archived entry's file, for exports.
+
+    Segments written before the name was archived only have the URL; names
+    are recovered from media URLs, and URLs stored as-is are kept.
+    """
+    if 'file' in entry:
+        return entry['file']
+    url = entry['file_url']
+    if url and settings.MEDIA_URL and url.startswith(settings.MEDIA_URL):
+        return unquote(url[len(settings.MEDIA_URL):])
+    return url
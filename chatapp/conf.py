@@ -0,0 +1,30 @@
+import threading
+
+from django.conf import settings
+
+
+def get_config(name, defaults):
+    """Return the ``name`` settings dict merged over ``defaults``."""
+    config = dict(defaults)
+    config.update(getattr(settings, name, None) or {})
+    return config
+
+
+_redis = None
+_redis_lock = threading.Lock()
+
+
+def redis_client():
+    """Client for the Redis server behind ``CACHES['default']``, for the list
+    and script commands the cache API doesn't expose."""
+    global _redis
+    if _redis is None:
+        with _redis_lock:
+            if _redis is None:
+                import redis
+
+                location = settings.CACHES['default']['LOCATION']
+                if not isinstance(location, str):
+                    location = location[0]
+                _redis = redis.Redis.from_url(location.split(',')[0])
+    return _redis
@@ -1,187 +1,395 @@
 import json
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from django.contrib.auth import get_user_model
 from django.utils import timezone
-from .models import Room, Message, UserProfile, MessageReaction, ReadReceipt, TypingStatus
+from .ids import allocate_message_id
+from .models import Room, Message
+from . import (
+    history, identity_cache, metrics, outbound, protocol, recent_messages, room_directory, threads, thumbnails,
+    write_behind,
+)
+from .presence import tracker as presence_tracker
+from .rate_limits import get_limiter
+from .reactions import broadcaster as reaction_broadcaster, toggle_reaction
+from .read_receipts import buffer as read_cursors
+from .serializers import serialize_new_message
+from .typing_indicators import tracker as typing_tracker
 
-User = get_user_model()
+MAX_MESSAGE_ID = 2 ** 63 - 1
+
+
+def parse_message_id(value):
+    """A client-sent message id as an int, or None if it can't be one."""
+    if isinstance(value, bool):
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return value if 0 < value <= MAX_MESSAGE_ID else None
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         self.room_group_name = f'chat_{self.room_name}'
         self.user = self.scope["user"]
+        self.replayed_ids = set()
+        self.joined = False
+        # Clients may opt into a binary encoding through the WebSocket subprotocol
+        self.codec, subprotocol = protocol.negotiate(self.scope.get('subprotocols'))
+        # Frames to this client go through a bounded queue so a slow socket
+        # can't back up the channel layer
+        self.outbound = outbound.create_queue(self.write_frame)
 
-        # Join room group
+        # Refuse before accepting: anonymous users and non-members never join
+        # the group or cost a presence update
+        if not await self.authorize():
+            await self.close()
+            return
+
+        # Join room group, and the user's own group that thread replies are sent to
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
+        await self.channel_layer.group_add(
+            threads.user_group(self.room_group_name, self.user.id),
+            self.channel_name
+        )
 
-        await self.accept()
-        
-        # Set user as online
-        await self.update_user_status(True)
+        await self.accept(subprotocol)
+        self.joined = True
+        metrics.connection_opened(self.room_name)
+        protocol.connection_opened(self.codec)
+
+        # A reconnecting client passes the last message it saw; send it what it
+        # missed before live messages (queued behind connect) are delivered
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        last_message_id = query.get('last_message_id', [None])[0]
+        if last_message_id:
+            await self.replay_since(last_message_id)
         
-        # Broadcast user's online status
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_status',
-                'user_id': self.user.id,
-                'status': 'online'
-            }
+        # Count the connection towards the user's presence; the tracker batches
+        # online/offline changes into one user_status event per room
+        await presence_tracker.connect(
+            self.channel_layer, self.room_group_name, self.channel_name, self.user.id,
+            avatar=await self.avatar_url()
         )
 
     async def disconnect(self, close_code):
-        # Set user as offline
-        await self.update_user_status(False)
-        
-        # Broadcast user's offline status
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_status',
-                'user_id': self.user.id,
-                'status': 'offline'
-            }
-        )
+        self.outbound.close()
+        if not self.joined:
+            return
+        metrics.connection_closed(self.room_name)
+        protocol.connection_closed(self.codec)
+        typing_tracker.stop(self.channel_layer, self.room_group_name, self.user.id)
+
+        # Persist anything still queued by the write-behind buffer
+        if write_behind.is_enabled():
+            await write_behind.get_buffer().flush()
+
+        await presence_tracker.disconnect(self.channel_name)
 
         # Leave room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        await self.channel_layer.group_discard(
+            threads.user_group(self.room_group_name, self.user.id),
+            self.channel_name
+        )
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None:
+            data = self.codec.decode(bytes_data)
+        else:
+            data = json.loads(text_data)
         message_type = data.get('type', 'message')
 
+        throttled = await get_limiter().check_async(message_type, self.user.id, self.room_name)
+        if throttled is not None:
+            # Rejected before any DB work or broadcast; only the sender hears of it
+            scope, retry_after = throttled
+            await self.send_event({
+                'type': 'throttled',
+                'frame': message_type,
+                'scope': scope,
+                'retry_after': retry_after
+            })
+            return
+
+        with metrics.frame(message_type):
+            await self.handle_frame(message_type, data)
+
+    async def handle_frame(self, message_type, data):
         if message_type == 'message':
             message = data['message']
             username = data['username']
             parent_id = data.get('parent_id')
             file_url = data.get('file_url')
+            thread_root_id = None
+            if parent_id:
+                # Any reply joins the thread of the message it answers
+                parent_id = parse_message_id(parent_id)
+                if parent_id is None:
+                    return
+                parent = await threads.resolve_parent(parent_id)
+                room = await self.get_room()
+                if parent is None or parent[0] != room.id:
+                    return
+                thread_root_id = threads.thread_root_of(parent_id, parent)
 
-            # Save message to database
-            saved_message = await self.save_message(username, message, parent_id, file_url)
+            # Save message to database, or queue it when write-behind is enabled
+            if write_behind.is_enabled():
+                saved_message = await self.queue_message(message, parent_id, thread_root_id, file_url)
+            else:
+                saved_message = await self.save_message(username, message, parent_id, thread_root_id, file_url)
+            threads.remember(saved_message)
+            entry = serialize_new_message(saved_message)
+            if thread_root_id is not None:
+                entry['parent_preview'] = parent[2]
 
-            # Send message to room group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'message': message,
-                    'username': username,
-                    'message_id': saved_message.id,
-                    'parent_id': parent_id,
-                    'file_url': file_url,
-                    'timestamp': saved_message.timestamp.isoformat()
-                }
+            if thread_root_id is not None:
+                # Replies only reach the thread's participants; the room sees
+                # the root's reply count change in batches
+                await threads.send_reply(
+                    self.channel_layer, self.room_group_name, room.id, thread_root_id, self.user.id,
+                    dict(entry, type='chat_message')
+                )
+                threads.activity.record(
+                    self.channel_layer, self.room_group_name, thread_root_id, saved_message.timestamp
+                )
+            else:
+                # Send message to room group, encoded once for every recipient
+                await protocol.group_send(
+                    self.channel_layer,
+                    self.room_group_name,
+                    dict(entry, type='chat_message'),
+                    keep=('message_id',)
+                )
+
+                # Saved rows reach the recent-message buffer through post_save;
+                # queued rows have not been saved yet, so add them here
+                if write_behind.is_enabled():
+                    await recent_messages.append_async(saved_message.room_id, entry)
+
+            # Room directory aggregates are updated in batches, not per message
+            room_directory.activity.record(
+                saved_message.room_id, saved_message.id, saved_message.content, saved_message.timestamp
             )
 
+        elif message_type == 'heartbeat':
+            presence_tracker.heartbeat(self.channel_name)
+
+        elif message_type == 'resume':
+            await self.replay_since(data.get('last_message_id'))
+
         elif message_type == 'typing':
-            # Handle typing status
-            await self.save_typing_status()
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'typing_status',
-                    'user_id': self.user.id,
-                    'username': self.user.username
-                }
+            # Typing state lives in memory; the tracker broadcasts one
+            # aggregated typing_status event per room per interval
+            typing_tracker.start(
+                self.channel_layer, self.room_group_name, self.user.id, self.user.username
             )
 
+        elif message_type == 'typing_stopped':
+            typing_tracker.stop(self.channel_layer, self.room_group_name, self.user.id)
+
         elif message_type == 'reaction':
-            message_id = data['message_id']
-            emoji = data['emoji']
-            await self.save_reaction(message_id, emoji)
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'message_reaction',
+            # Toggles the user's reaction; updated counts are broadcast in
+            # batches as {emoji: count} per message
+            message_id = parse_message_id(data.get('message_id'))
+            if message_id is None or 'emoji' not in data:
+                return
+            emoji = str(data['emoji'])
+            room = await self.get_room()
+            if await self.save_reaction(room.id, message_id, emoji) is None:
+                # Not a stored message of this room; only the sender hears of it
+                await self.send_event({
+                    'type': 'reaction_rejected',
                     'message_id': message_id,
-                    'user_id': self.user.id,
-                    'username': self.user.username,
                     'emoji': emoji
-                }
-            )
+                })
+                return
+            reaction_broadcaster.changed(self.channel_layer, self.room_group_name, message_id, emoji)
 
-        elif message_type == 'read_receipt':
-            message_id = data['message_id']
-            await self.save_read_receipt(message_id)
-            await self.channel_layer.group_send(
+        elif message_type in ('thread_follow', 'thread_unfollow'):
+            # Opening a thread subscribes to its replies until unfollowed
+            message_id = parse_message_id(data.get('message_id'))
+            if message_id is None:
+                return
+            parent = await threads.resolve_parent(message_id)
+            room = await self.get_room()
+            if parent is None or parent[0] != room.id:
+                return
+            change = threads.follow if message_type == 'thread_follow' else threads.unfollow
+            await change(room.id, threads.thread_root_of(message_id, parent), self.user.id)
+
+        elif message_type in ('read_up_to', 'read_receipt'):
+            # Receipts are high-water marks: "read everything up to message N".
+            # Batches and repeated frames collapse to the highest id and are
+            # stored and broadcast once per interval. Frames without a usable
+            # id are dropped; ids past the room's newest message are clamped
+            # when the batch is stored.
+            message_ids = data.get('message_ids') or [data.get('message_id')]
+            if not isinstance(message_ids, (list, tuple)):
+                return
+            message_ids = [message_id for message_id in map(parse_message_id, message_ids) if message_id is not None]
+            if not message_ids:
+                return
+            room = await self.get_room()
+            read_cursors.mark(
+                self.channel_layer,
                 self.room_group_name,
-                {
-                    'type': 'read_receipt',
-                    'message_id': message_id,
-                    'user_id': self.user.id,
-                    'username': self.user.username
-                }
+                room.id,
+                self.user.id,
+                self.user.username,
+                max(message_ids)
             )
 
+    async def send_event(self, event):
+        if 'frames' in event:
+            # Pre-encoded once by protocol.group_send
+            payload = protocol.frame_for(event, self.codec)
+        else:
+            payload = self.codec.encode(event)
+        message_id = event.get('message_id') if event['type'] == 'chat_message' else None
+        if not self.outbound.put(event['type'], payload, outbound.coalesce_key(event), message_id):
+            await self.overflow()
+
+    async def write_frame(self, payload):
+        if self.codec.binary:
+            await self.send(bytes_data=payload)
+        else:
+            await self.send(text_data=payload)
+
+    async def overflow(self):
+        # Too far behind: drop the backlog and tell the client where to resume
+        last_message_id = self.outbound.last_message_id
+        self.outbound.close()
+        await self.write_frame(self.codec.encode({
+            'type': 'overflow',
+            'last_message_id': last_message_id
+        }))
+        await self.close(code=outbound.OVERFLOW_CLOSE_CODE)
+
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps(event))
+        if self.replayed_ids and event['message_id'] in self.replayed_ids:
+            # Already delivered by replay_since
+            self.replayed_ids.discard(event['message_id'])
+            return
+        await self.send_event(event)
+
+    async def replay_since(self, last_message_id):
+        last_message_id = parse_message_id(last_message_id)
+        if last_message_id is None:
+            return
+        room = await self.get_room()
+        messages, complete = await metrics.db_call(history.load_after_message)(
+            room.id, last_message_id
+        )
+        self.replayed_ids = {message['message_id'] for message in messages}
+        await self.send_event({
+            'type': 'history_replay',
+            'messages': messages,
+            'complete': complete
+        })
 
     async def typing_status(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.send_event(event)
 
     async def message_reaction(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.send_event(event)
+
+    async def thread_activity(self, event):
+        await self.send_event(event)
 
     async def read_receipt(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.send_event(event)
 
     async def user_status(self, event):
-        await self.send(text_data=json.dumps(event))
-
-    @database_sync_to_async
-    def update_user_status(self, is_online):
-        profile, _ = UserProfile.objects.get_or_create(user=self.user)
-        profile.is_online = is_online
-        profile.last_seen = timezone.now()
-        profile.save()
-
-    @database_sync_to_async
-    def save_message(self, username, message_content, parent_id=None, file_url=None):
-        user = User.objects.get(username=username)
-        room = Room.objects.get(name=self.room_name)
-        parent_message = None
-        if parent_id:
-            parent_message = Message.objects.get(id=parent_id)
-        
-        message = Message.objects.create(
+        await self.send_event(event)
+
+    async def presence_expired(self, event):
+        await self.close()
+
+    # Single-query paths use the async ORM; multi-query units of work
+    # (reaction toggles, history replay) stay in one db_call each
+
+    async def avatar_url(self):
+        derived = identity_cache.avatars.get(self.user.id)
+        if derived is None:
+            derived = await metrics.db_call(identity_cache.aget_avatar_thumbnails)(self.user.id)
+        return thumbnails.urls(derived).get('small') if derived else None
+
+    async def authorize(self):
+        """Whether the user may join the room, from caches where possible.
+
+        A ticket issued for this room (see chatapp.tickets) already proves
+        membership. Otherwise the room and the membership are looked up
+        through the identity cache, which also warms it for per-frame
+        handlers.
+        """
+        if not self.user.is_authenticated:
+            return False
+        if self.scope.get('ticket_room') == self.room_name:
+            return True
+        if 'ticket_room' not in self.scope:
+            # Ticket users are unsaved stand-ins; only cache full rows
+            identity_cache.users.set(self.user.username, self.user)
+        try:
+            room = await self.get_room()
+        except Room.DoesNotExist:
+            return False
+        if identity_cache.memberships.get((room.id, self.user.id)):
+            return True
+        return await metrics.db_call(identity_cache.ais_member)(room.id, self.user.id)
+
+    @metrics.db_call
+    async def save_message(self, username, message_content, parent_id=None, thread_root_id=None, file_url=None):
+        # The parent was resolved (usually from cache) before this, so a
+        # reply is a single insert like any other message
+        user = await identity_cache.aget_user(username)
+        room = await self.get_room()
+        return await Message.objects.acreate(
             user=user,
             room=room,
             content=message_content,
-            parent_message=parent_message,
+            parent_message_id=parent_id,
+            thread_root_id=thread_root_id,
             file=file_url
         )
-        return message
 
-    @database_sync_to_async
-    def save_typing_status(self):
-        room = Room.objects.get(name=self.room_name)
-        TypingStatus.objects.update_or_create(
-            room=room,
-            user=self.user,
-            defaults={'timestamp': timezone.now()}
-        )
+    async def get_room(self):
+        room = identity_cache.rooms.get(self.room_name)
+        if room is None:
+            room = await metrics.db_call(identity_cache.aget_room)(self.room_name)
+        return room
 
-    @database_sync_to_async
-    def save_reaction(self, message_id, emoji):
-        message = Message.objects.get(id=message_id)
-        MessageReaction.objects.create(
-            message=message,
+    async def queue_message(self, message_content, parent_id=None, thread_root_id=None, file_url=None):
+        room = await self.get_room()
+        message = Message(
+            id=allocate_message_id(),
+            room=room,
             user=self.user,
-            emoji=emoji
+            parent_message_id=parent_id or None,
+            thread_root_id=thread_root_id,
+            content=message_content,
+            file=file_url,
+            timestamp=timezone.now()
         )
+        await write_behind.get_buffer().enqueue({
+            'id': message.id,
+            'room_id': message.room_id,
+            'user_id': message.user_id,
+            'parent_message_id': message.parent_message_id,
+            'thread_root_id': message.thread_root_id,
+            'content': message.content,
+            'file': file_url,
+            'timestamp': message.timestamp.isoformat()
+        })
+        return message
 
-    @database_sync_to_async
-    def save_read_receipt(self, message_id):
-        message = Message.objects.get(id=message_id)
-        ReadReceipt.objects.create(
-            message=message,
-            user=self.user
-        )
+    @metrics.db_call
+    def save_reaction(self, room_id, message_id, emoji):
+        return toggle_reaction(message_id, self.user, emoji, room_id)
@@ -0,0 +1,255 @@
+import base64
+import binascii
+
+from django.db.models import Prefetch, Q
+from django.utils.dateparse import parse_datetime
+
+from . import archive, threads
+from .conf import get_config
+from .models import Message, MessageReactionCount
+from .reactions import with_current_counts
+from .recent_messages import get_buffer
+from .serializers import serialize_message
+
+DEFAULTS = {
+    'PAGE_SIZE': 50,
+    'MAX_PAGE_SIZE': 200,
+    'MAX_REPLAY': 500,
+}
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(entry):
+    """Cursor for a serialized message (see ``serialize_message``)."""
+    raw = f'{entry["timestamp"]}|{entry["message_id"]}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, message_id = base64.urlsafe_b64decode(padded).decode().split('|')
+        parsed = parse_datetime(timestamp)
+        if parsed is None:
+            raise ValueError(timestamp)
+        return parsed, int(message_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as exc:
+        raise InvalidCursor(cursor) from exc
+
+
+def page_size(requested=None):
+    config = get_config('CHAT_HISTORY', DEFAULTS)
+    if requested in (None, ''):
+        return config['PAGE_SIZE']
+    return max(1, min(int(requested), config['MAX_PAGE_SIZE']))
+
+
+def message_queryset():
+    """Messages with everything ``serialize_message`` reads, in two queries."""
+    return Message.objects.select_related('user', 'parent_message').prefetch_related(
+        Prefetch(
+            'reaction_counts',
+            queryset=MessageReactionCount.objects.filter(count__gt=0).only('id', 'message_id', 'emoji', 'count'),
+        ),
+    )
+
+
+def history_queryset(room_id):
+    # The room timeline; thread replies are loaded with load_thread
+    return message_queryset().filter(room_id=room_id, thread_root__isnull=True)
+
+
+def fetch_page(room_id, before=None, after=None, limit=None):
+    """Return one page of a room's history in chronological order.
+
+    Pages are addressed by keyset on (timestamp, id), which the
+    ``chatapp_msg_room_ts_id`` index serves directly, so the cost does not grow
+    with the depth of the page. Without a cursor the newest page is returned.
+    Returns ``(messages, has_more)`` where ``has_more`` refers to the direction
+    being paged in.
+    """
+    limit = page_size(limit)
+    queryset = history_queryset(room_id)
+    if after is not None:
+        timestamp, message_id = decode_cursor(after)
+        queryset = queryset.filter(
+            Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id)
+        ).order_by('timestamp', 'id')
+        messages = list(queryset[:limit + 1])
+        return messages[:limit], len(messages) > limit
+
+    if before is not None:
+        timestamp, message_id = decode_cursor(before)
+        queryset = queryset.filter(
+            Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+        )
+    messages = list(queryset.order_by('-timestamp', '-id')[:limit + 1])
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    messages.reverse()
+    return messages, has_more
+
+
+def _current(entries):
+    """Buffered ``entries`` with reaction and reply counts brought up to date."""
+    return threads.with_current_threads(with_current_counts(entries))
+
+
+def _serve_from_buffer(entries, size, before, after, limit):
+    """Answer a page from the ring buffer, or return None if it can't.
+
+    A buffer holding fewer than ``size`` entries holds the room's entire
+    history, so it can also answer "is there more?" on its own.
+    """
+    complete = len(entries) < size
+    if after is not None:
+        position = _position(entries, after)
+        if position is None:
+            return None
+        newer = entries[position + 1:]
+        return newer[:limit], len(newer) > limit
+    if before is not None:
+        position = _position(entries, before)
+        if position is None:
+            return None
+        entries = entries[:position]
+    if len(entries) > limit:
+        return entries[-limit:], True
+    if complete:
+        return entries, False
+    return None
+
+
+def _position(entries, cursor):
+    _, message_id = decode_cursor(cursor)
+    for index in range(len(entries) - 1, -1, -1):
+        if entries[index]['message_id'] == message_id:
+            return index
+    return None
+
+
+def load_page(room_id, before=None, after=None, limit=None):
+    """Like :func:`fetch_page` but returns serialized messages, reading through
+    the recent-message ring buffer first and warming it on a cold read."""
+    limit = page_size(limit)
+    buffer = get_buffer()
+    entries = buffer.get(room_id)
+    if entries is not None:
+        page = _serve_from_buffer(entries, buffer.size, before, after, limit)
+        if page is not None:
+            return _current(page[0]), page[1]
+    elif before is None and after is None and limit <= buffer.size:
+        # Taken before the read so an invalidation during it voids the fill
+        version = buffer.version(room_id)
+        messages = list(history_queryset(room_id).order_by('-timestamp', '-id')[:buffer.size])
+        messages.reverse()
+        entries = [serialize_message(message) for message in messages]
+        if len(entries) < buffer.size:
+            # The rest of the room's history may have been archived
+            older, _ = archive.entries_before(
+                room_id, archive.entry_key(entries[0]) if entries else None, buffer.size - len(entries)
+            )
+            entries = older + entries
+        buffer.fill(room_id, entries, version)
+        if len(entries) > limit:
+            return entries[-limit:], True
+        return entries, len(entries) >= buffer.size
+    return _load_with_archive(room_id, before, after, limit)
+
+
+def _load_with_archive(room_id, before, after, limit):
+    """Page from the message table, continued into the archive where it runs out.
+
+    Archived messages are older than what remains in the table, so the
+    archive is only read when paging forward from an archived cursor or
+    when a backward page reaches the oldest message in the table.
+    """
+    if after is not None:
+        archived, more = archive.entries_after(room_id, decode_cursor(after), limit)
+        if more:
+            return archived, True
+        if archived:
+            messages, has_more = fetch_page(room_id, after=after, limit=max(1, limit - len(archived)))
+            page = archived + [serialize_message(message) for message in messages]
+            return page[:limit], has_more or len(page) > limit
+    messages, has_more = fetch_page(room_id, before=before, after=after, limit=limit)
+    page = [serialize_message(message) for message in messages]
+    if after is None and not has_more:
+        if page:
+            key = archive.entry_key(page[0])
+        else:
+            key = decode_cursor(before) if before is not None else None
+        older, has_more = archive.entries_before(room_id, key, limit - len(page))
+        page = older + page
+    return page, has_more
+
+
+def load_after_message(room_id, message_id):
+    """Serialized messages newer than ``message_id``, for resuming a session.
+
+    Served from the ring buffer when it still holds ``message_id``, otherwise
+    by keyset from the message's own position. Returns ``(messages, complete)``;
+    ``complete`` is False when more than ``MAX_REPLAY`` messages were missed or
+    ``message_id`` is unknown, in which case the client should reload history.
+    """
+    limit = get_config('CHAT_HISTORY', DEFAULTS)['MAX_REPLAY']
+    entries = get_buffer().get(room_id)
+    if entries is not None:
+        for index in range(len(entries) - 1, -1, -1):
+            if entries[index]['message_id'] == message_id:
+                newer = entries[index + 1:]
+                return _current(newer[:limit]), len(newer) <= limit
+    anchor = Message.objects.filter(room_id=room_id, id=message_id).values_list('timestamp', flat=True).first()
+    if anchor is None:
+        return [], False
+    messages = list(
+        history_queryset(room_id).filter(
+            Q(timestamp__gt=anchor) | Q(timestamp=anchor, id__gt=message_id)
+        ).order_by('timestamp', 'id')[:limit + 1]
+    )
+    return [serialize_message(message) for message in messages[:limit]], len(messages) <= limit
+
+
+def load_thread(room_id, message_id, after=None, limit=None):
+    """One page of a thread in chronological order: its root, then replies.
+
+    ``message_id`` may be the root or any reply in it. However deep the reply
+    tree, the page is one query: the root by primary key and its replies by
+    a range scan of ``chatapp_msg_thread_ts_id``. Threads whose messages
+    have left the table are read from the archive (retention archives a
+    thread's replies no later than its root). Returns ``(root_id, messages,
+    has_more)``; ``root_id`` is None if the message isn't in the room.
+    """
+    config = threads.get_settings()
+    limit = config['PAGE_SIZE'] if limit in (None, '') else max(1, min(int(limit), config['MAX_PAGE_SIZE']))
+    parent = threads.parents.get(message_id) or threads.get_parent(message_id)
+    if parent is None:
+        return _load_archived_thread(room_id, message_id, after, limit)
+    if parent[0] != room_id:
+        return None, [], False
+    root_id = threads.thread_root_of(message_id, parent)
+    queryset = message_queryset().filter(Q(pk=root_id) | Q(thread_root_id=root_id))
+    if after is not None:
+        timestamp, after_id = decode_cursor(after)
+        queryset = queryset.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=after_id))
+    messages = list(queryset.order_by('timestamp', 'id')[:limit + 1])
+    page = [serialize_message(message) for message in messages[:limit]]
+    return root_id, _current(page), len(messages) > limit
+
+
+def _load_archived_thread(room_id, message_id, after, limit):
+    entry = archive.find_entry(room_id, message_id)
+    if entry is None:
+        return None, [], False
+    root_id = entry.get('thread_root_id') or message_id
+    root = entry if root_id == message_id else archive.find_entry(room_id, root_id)
+    if root is None:
+        return None, [], False
+    entries = archive.thread_entries(room_id, root)
+    if after is not None:
+        key = decode_cursor(after)
+        entries = [entry for entry in entries if archive.entry_key(entry) > key]
+    return root_id, _current(entries[:limit]), len(entries) > limit
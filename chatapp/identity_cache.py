@@ -0,0 +1,187 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.contrib.auth import get_user_model
+
+from . import metrics
+from .conf import get_config
+from .models import Room, UserProfile
+
+DEFAULTS = {
+    'ROOM_MAXSIZE': 10000,
+    'USER_MAXSIZE': 50000,
+    'MEMBERSHIP_MAXSIZE': 200000,
+    'TTL': 300,
+}
+
+
+class LRUCache:
+    """Thread-safe LRU mapping whose entries also expire after ``ttl`` seconds.
+
+    Model instances are also indexed by primary key for :meth:`invalidate_pk`.
+    Every process has its own copy and invalidation only reaches this one;
+    other workers serve their entries until ``ttl`` runs out.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        # pk -> keys whose value is the instance with that pk
+        self._pks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._remove(key)
+            pk = getattr(value, 'pk', None)
+            self._data[key] = (time.monotonic() + self.ttl, value, pk)
+            if pk is not None:
+                self._pks.setdefault(pk, set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def invalidate_pk(self, pk):
+        """Drop every entry holding the model instance with primary key ``pk``."""
+        with self._lock:
+            for key in list(self._pks.get(pk, ())):
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is None or entry[2] is None:
+            return
+        keys = self._pks[entry[2]]
+        keys.discard(key)
+        if not keys:
+            del self._pks[entry[2]]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._pks.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+_config = get_config('CHAT_IDENTITY_CACHE', DEFAULTS)
+rooms = LRUCache(_config['ROOM_MAXSIZE'], _config['TTL'])
+users = LRUCache(_config['USER_MAXSIZE'], _config['TTL'])
+# (room_id, user_id) -> True; only memberships are cached, so a user who
+# joins is never refused on a stale entry
+memberships = LRUCache(_config['MEMBERSHIP_MAXSIZE'], _config['TTL'])
+# user_id -> the profile's avatar_thumbnails ({} without an avatar)
+avatars = LRUCache(_config['USER_MAXSIZE'], _config['TTL'])
+
+
+def get_room(name):
+    room = rooms.get(name)
+    if room is None:
+        room = Room.objects.get(name=name)
+        rooms.set(name, room)
+    return room
+
+
+def get_user(username):
+    user = users.get(username)
+    if user is None:
+        user = get_user_model().objects.get(username=username)
+        users.set(username, user)
+    return user
+
+
+async def aget_room(name):
+    room = rooms.get(name)
+    if room is None:
+        room = await Room.objects.aget(name=name)
+        rooms.set(name, room)
+    return room
+
+
+async def aget_user(username):
+    user = users.get(username)
+    if user is None:
+        user = await get_user_model().objects.aget(username=username)
+        users.set(username, user)
+    return user
+
+
+def is_member(room_id, user_id):
+    if memberships.get((room_id, user_id)):
+        return True
+    member = Room.members.through.objects.filter(room_id=room_id, user_id=user_id).exists()
+    if member:
+        memberships.set((room_id, user_id), True)
+    return member
+
+
+async def ais_member(room_id, user_id):
+    if memberships.get((room_id, user_id)):
+        return True
+    member = await Room.members.through.objects.filter(room_id=room_id, user_id=user_id).aexists()
+    if member:
+        memberships.set((room_id, user_id), True)
+    return member
+
+
+def join(room, user):
+    """Add ``user`` to ``room`` unless already known to be a member."""
+    if memberships.get((room.pk, user.pk)) is None:
+        room.members.add(user)
+        memberships.set((room.pk, user.pk), True)
+
+
+async def aget_avatar_thumbnails(user_id):
+    derived = avatars.get(user_id)
+    if derived is None:
+        derived = await UserProfile.objects.filter(user_id=user_id).values_list(
+            'avatar_thumbnails', flat=True
+        ).afirst() or {}
+        avatars.set(user_id, derived)
+    return derived
+
+
+def stats():
+    return {
+        'rooms': rooms.stats(),
+        'users': users.stats(),
+        'memberships': memberships.stats(),
+        'avatars': avatars.stats(),
+    }
+
+
+@metrics.collector
+def _collect():
+    current = stats()
+    for name, kind in (('hits', 'counter'), ('misses', 'counter'), ('size', 'gauge')):
+        metric = f'chat_identity_cache_{name}' + ('_total' if kind == 'counter' else '')
+        yield (metric, kind, f'Identity cache {name}',
+               [({'cache': cache}, values[name]) for cache, values in current.items()])
@@ -0,0 +1,78 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# Custom epoch (2024-01-01 UTC). Ids are kept within 53 bits so they survive
+# the round trip through JavaScript numbers in chat.js.
+EPOCH_MS = 1704067200000
+WORKER_BITS = 6
+SEQUENCE_BITS = 6
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+# Every id issued after the epoch's first three days is above this, and no
+# auto-increment sequence gets near it
+MIN_ALLOCATED_ID = 1 << 40
+
+
+class MessageIdAllocator:
+    """Time-ordered integer ids that can be handed out before a row is inserted.
+
+    Layout: 41 bits of milliseconds since ``EPOCH_MS``, 6 bits of worker id,
+    6 bits of per-millisecond sequence.
+    """
+
+    def __init__(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f'worker_id must be between 0 and {MAX_WORKER_ID}')
+        self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def next_id(self):
+        with self._lock:
+            now_ms = self._now_ms()
+            if now_ms < self._last_ms:
+                # Clock went backwards; keep issuing from the last known tick.
+                now_ms = self._last_ms
+            if now_ms == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    while now_ms <= self._last_ms:
+                        now_ms = self._now_ms()
+            else:
+                self._sequence = 0
+            self._last_ms = now_ms
+            return ((now_ms - EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS)) | (
+                self.worker_id << SEQUENCE_BITS
+            ) | self._sequence
+
+    @staticmethod
+    def _now_ms():
+        return time.time_ns() // 1_000_000
+
+
+def get_worker_id():
+    worker_id = getattr(settings, 'CHAT_WORKER_ID', None)
+    if worker_id in (None, ''):
+        # Guessing (e.g. from the pid) could give two workers the same id space
+        raise ImproperlyConfigured('CHAT_WORKER_ID must be set to a distinct 0-63 value per worker')
+    worker_id = int(worker_id)
+    if not 0 <= worker_id <= MAX_WORKER_ID:
+        raise ImproperlyConfigured(f'CHAT_WORKER_ID must be between 0 and {MAX_WORKER_ID}')
+    return worker_id
+
+
+_allocator = None
+_allocator_lock = threading.Lock()
+
+
+def allocate_message_id():
+    global _allocator
+    if _allocator is None:
+        with _allocator_lock:
+            if _allocator is None:
+                _allocator = MessageIdAllocator(get_worker_id())
+    return _allocator.next_id()
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import time
+
+from channels_redis.core import RedisChannelLayer
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+layer_deliveries = metrics.Counter(
+    'chat_layer_deliveries', 'Group messages delivered per channel, by path', ['path']
+)
+
+# Same as RedisChannelLayer.group_send: push to each channel key under capacity
+GROUP_SEND_LUA = """
+local over_capacity = 0
+local current_time = ARGV[#ARGV - 1]
+local expiry = ARGV[#ARGV]
+for i=1,#KEYS do
+    if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+        redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+        redis.call('EXPIRE', KEYS[i], expiry)
+    else
+        over_capacity = over_capacity + 1
+    end
+end
+return over_capacity
+"""
+
+
+class LocalFanoutChannelLayer(RedisChannelLayer):
+    """RedisChannelLayer that delivers to channels of this process directly.
+
+    Group membership still lives in Redis, but members whose channel belongs
+    to this process are handed the message in memory instead of through a
+    Redis push and the receive loop's pop. With room-affinity sharding
+    (``runworkers --affinity``) most members of a room share a worker, so a
+    broadcast costs one Redis round trip to read the group instead of three.
+    """
+
+    _local_wakeup = None
+
+    def _local_receiver(self, channel):
+        # Only channels a consumer is currently receiving on have a buffer;
+        # anything else goes through Redis as usual
+        if '!' in channel and self.non_local_name(channel).endswith(self.client_prefix + '!'):
+            return self.receive_buffer.get(channel)
+        return None
+
+    def _deliver(self, buffer, message):
+        # Every consumer gets its own dict, as it would from Redis; the
+        # pre-encoded frames inside are immutable and stay shared
+        message = dict(message)
+        loop = self.receive_event_loop
+        if loop is None or loop is asyncio.get_running_loop():
+            self._put(buffer, message)
+        else:
+            # Sent from another loop (e.g. async_to_sync in a worker thread);
+            # the buffer's queue may only be touched on the receiving loop
+            loop.call_soon_threadsafe(self._put, buffer, message)
+
+    def _put(self, buffer, message):
+        buffer.put_nowait(message)
+        if self._local_wakeup is not None:
+            self._local_wakeup.set()
+
+    async def receive_single(self, channel):
+        # receive() lets one consumer at a time read Redis for the whole
+        # process while the others wait on their buffers. That reader would
+        # not notice a local delivery to its own buffer until Redis returned
+        # something, so stop reading when one arrives.
+        if '!' not in channel:
+            return await super().receive_single(channel)
+        self._local_wakeup = wakeup = asyncio.Event()
+        remote = asyncio.ensure_future(super().receive_single(channel))
+        local = asyncio.ensure_future(wakeup.wait())
+        try:
+            await asyncio.wait([remote, local], return_when=asyncio.FIRST_COMPLETED)
+        except BaseException:
+            remote.cancel()
+            raise
+        finally:
+            local.cancel()
+            self._local_wakeup = None
+        if remote.done():
+            return remote.result()
+        # A popped but unreturned message stays in Redis' backup queue
+        remote.cancel()
+        # No channels to buffer for: receive() rechecks its buffer
+        return [], None
+
+    async def send(self, channel, message):
+        buffer = self._local_receiver(channel)
+        if buffer is None:
+            return await super().send(channel, message)
+        layer_deliveries.labels('local').inc()
+        self._deliver(buffer, message)
+
+    async def group_send(self, group, message):
+        assert self.require_valid_group_name(group), 'Group name not valid'
+        key = self._group_key(group)
+        connection = self.connection(self.consistent_hash(group))
+        pipe = connection.pipeline()
+        pipe.zremrangebyscore(key, min=0, max=int(time.time()) - self.group_expiry)
+        pipe.zrange(key, 0, -1)
+        _, members = await pipe.execute()
+
+        remote = []
+        for member in members:
+            channel = member.decode('utf8')
+            buffer = self._local_receiver(channel)
+            if buffer is None:
+                remote.append(channel)
+            else:
+                self._deliver(buffer, message)
+        layer_deliveries.labels('local').inc(len(members) - len(remote))
+        if remote:
+            layer_deliveries.labels('redis').inc(len(remote))
+            await self._send_remote(group, remote, message)
+
+    async def _send_remote(self, group, channel_names, message):
+        connection_to_keys, key_to_message, key_to_capacity = self._map_channel_keys_to_connection(
+            channel_names, message
+        )
+        for index, keys in connection_to_keys.items():
+            connection = self.connection(index)
+            pipe = connection.pipeline()
+            for key in keys:
+                pipe.zremrangebyscore(key, min=0, max=int(time.time()) - int(self.expiry))
+            await pipe.execute()
+            args = [key_to_message[key] for key in keys] + [key_to_capacity[key] for key in keys]
+            args += [time.time(), self.expiry]
+            over_capacity = await connection.eval(GROUP_SEND_LUA, len(keys), *keys, *args)
+            if over_capacity > 0:
+                logger.info('%s of %s channels over capacity in group %s', over_capacity, len(channel_names), group)
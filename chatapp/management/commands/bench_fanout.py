@@ -0,0 +1,99 @@
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chatapp import outbound, protocol
+from chatapp.consumers import ChatConsumer
+
+
+def make_event(index):
+    return {
+        'type': 'chat_message',
+        'message_id': 360000000000000 + index,
+        'message': 'The quick brown fox jumps over the lazy dog ' * 2,
+        'username': 'benchmark-user',
+        'user_id': 42,
+        'parent_id': None,
+        'parent_preview': None,
+        'file_url': None,
+        'file_name': None,
+        'timestamp': timezone.now().isoformat(),
+        'edited_at': None,
+        'is_deleted': False,
+        'reactions': {},
+        'reply_count': 0,
+    }
+
+
+async def _discard(message):
+    pass
+
+
+def make_recipients(count, binary_share):
+    """Consumers wired to a no-op transport, a ``binary_share`` of them on MessagePack."""
+    recipients = []
+    binary_every = round(1 / binary_share) if binary_share else 0
+    for index in range(count):
+        consumer = ChatConsumer()
+        consumer.base_send = _discard
+        consumer.outbound = outbound.create_queue(_discard)
+        consumer.replayed_ids = set()
+        subprotocol = 'chat.msgpack.v1' if binary_every and index % binary_every == 0 else 'chat.json.v1'
+        consumer.codec = protocol.CODECS[subprotocol]
+        recipients.append(consumer)
+    return recipients
+
+
+async def fan_out(recipients, events, pre_encoded):
+    """CPU seconds spent delivering ``events`` to every recipient."""
+    started = time.process_time()
+    for event in events:
+        if pre_encoded:
+            event = protocol.pre_encode(event, keep=('message_id',))
+        for consumer in recipients:
+            await consumer.chat_message(event)
+    # Frames are written by each recipient's outbound queue
+    while any(len(consumer.outbound) for consumer in recipients):
+        await asyncio.sleep(0)
+    return time.process_time() - started
+
+
+class Command(BaseCommand):
+    help = 'Measure per-recipient CPU cost of room broadcasts with and without pre-encoding'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,1000,10000', help='Comma-separated room sizes')
+        parser.add_argument('--messages', type=int, default=20, help='Messages broadcast per room size')
+        parser.add_argument('--binary-share', type=float, default=0.25,
+                            help='Fraction of recipients using the MessagePack protocol')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        results = []
+        for size in [int(size) for size in options['sizes'].split(',')]:
+            recipients = make_recipients(size, options['binary_share'])
+            events = [make_event(index) for index in range(options['messages'])]
+            deliveries = size * len(events)
+            per_mode = {}
+            for mode, pre_encoded in (('per_recipient', False), ('pre_encoded', True)):
+                seconds = asyncio.run(fan_out(recipients, events, pre_encoded))
+                per_mode[mode] = {
+                    'cpu_seconds': round(seconds, 6),
+                    'us_per_recipient': round(seconds / deliveries * 1e6, 3),
+                }
+            per_mode['room_size'] = size
+            per_mode['messages'] = len(events)
+            per_mode['speedup'] = round(
+                per_mode['per_recipient']['cpu_seconds'] / max(per_mode['pre_encoded']['cpu_seconds'], 1e-9), 2
+            )
+            results.append(per_mode)
+
+        report = json.dumps({'benchmark': 'fanout', 'results': results}, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report)
+        else:
+            self.stdout.write(report)
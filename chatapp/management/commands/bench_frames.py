@@ -0,0 +1,129 @@
+import asyncio
+import json
+import time
+
+from channels.db import database_sync_to_async
+from channels.layers import InMemoryChannelLayer
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from chatapp import identity_cache, metrics
+from chatapp.consumers import ChatConsumer
+from chatapp.models import Message, Room
+from chatapp.management.commands.bench_load import percentile
+
+
+class SyncORMConsumer(ChatConsumer):
+    """ChatConsumer with its persistence written against the sync ORM and
+    wrapped in ``database_sync_to_async``, as it was before the async ORM."""
+
+    @database_sync_to_async
+    def save_message(self, username, message_content, parent_id=None, thread_root_id=None, file_url=None):
+        user = identity_cache.get_user(username)
+        room = identity_cache.get_room(self.room_name)
+        parent_message = None
+        if parent_id:
+            parent_message = Message.objects.get(id=parent_id)
+        return Message.objects.create(
+            user=user, room=room, content=message_content, parent_message=parent_message,
+            thread_root_id=thread_root_id, file=file_url
+        )
+
+
+class FrameRun:
+    """Push ``message`` frames through ``handle_frame`` from concurrent tasks."""
+
+    def __init__(self, frames, concurrency, reply_every):
+        self.frames = frames
+        self.concurrency = concurrency
+        self.reply_every = reply_every
+
+    def setup_data(self):
+        user, _ = get_user_model().objects.get_or_create(username='bench_frames_user')
+        room, _ = Room.objects.get_or_create(name='bench_frames_room')
+        parent = Message.objects.create(room=room, user=user, content='parent')
+        return user, parent.id
+
+    def consumer(self, consumer_class, user, channel_layer):
+        consumer = consumer_class()
+        consumer.scope = {'user': user}
+        consumer.user = user
+        consumer.room_name = 'bench_frames_room'
+        consumer.room_group_name = 'chat_bench_frames_room'
+        consumer.channel_layer = channel_layer
+        return consumer
+
+    async def measure(self, consumer_class, user, parent_id):
+        # A fresh layer per run with nobody listening, so only the sender's
+        # side of the frame is timed
+        channel_layer = InMemoryChannelLayer(capacity=self.frames + 1)
+        consumers = [self.consumer(consumer_class, user, channel_layer) for _ in range(self.concurrency)]
+        latencies = []
+        remaining = iter(range(self.frames))
+
+        async def client(consumer):
+            for number in remaining:
+                data = {'type': 'message', 'message': f'frame {number}', 'username': user.username}
+                if self.reply_every and number % self.reply_every == 0:
+                    data['parent_id'] = parent_id
+                started = time.perf_counter()
+                await consumer.handle_frame('message', data)
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client(consumer) for consumer in consumers))
+        elapsed = time.perf_counter() - started
+        return {
+            'frames_per_second': round(self.frames / elapsed, 1),
+            'latency_ms': {
+                'p50': percentile(latencies, 0.5),
+                'p95': percentile(latencies, 0.95),
+                'p99': percentile(latencies, 0.99),
+            },
+        }
+
+    async def run(self):
+        user, parent_id = await database_sync_to_async(self.setup_data)()
+        # Warm caches and connections once so both runs start alike
+        await self.measure(ChatConsumer, user, parent_id)
+        return {
+            'frames': self.frames,
+            'concurrency': self.concurrency,
+            'database': connection.vendor,
+            'pooled_connections': metrics.pooled_connections(),
+            'sync_orm': await self.measure(SyncORMConsumer, user, parent_id),
+            'async_orm': await self.measure(ChatConsumer, user, parent_id),
+        }
+
+
+class Command(BaseCommand):
+    help = 'Compare message-frame throughput of the sync-ORM and async-ORM consumer paths as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--frames', type=int, default=2000)
+        parser.add_argument('--concurrency', type=int, default=50, help='Simulated connections sending at once')
+        parser.add_argument('--reply-every', type=int, default=5,
+                            help='Every Nth frame is a reply, which costs an extra parent lookup (0 for none)')
+        parser.add_argument('--keepdb', action='store_true',
+                            help='Run against the configured database instead of a throwaway test database')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        old_name = None
+        if not options['keepdb']:
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            run = FrameRun(options['frames'], options['concurrency'], options['reply_every'])
+            report = asyncio.run(run.run())
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                handle.write(output)
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,232 @@
+import asyncio
+import json
+import random
+import statistics
+import time
+import tracemalloc
+
+from channels.db import database_sync_to_async
+from channels.layers import InMemoryChannelLayer, channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from chatapp import protocol
+from chatapp.models import Room
+from chatapp.routing import websocket_urlpatterns
+
+FRAME_MIX = {
+    'message': 0.4,
+    'typing': 0.35,
+    'reaction': 0.1,
+    'read_up_to': 0.15,
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 3)
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class LoadRun:
+    """N rooms x M simulated clients talking to ChatConsumer in-process."""
+
+    def __init__(self, rooms, clients, duration, rate, subprotocol, seed):
+        self.rooms = rooms
+        self.clients = clients
+        self.duration = duration
+        self.rate = rate
+        self.codec = protocol.CODECS[subprotocol]
+        self.subprotocol = subprotocol
+        self.random = random.Random(seed)
+        self.application = URLRouter(websocket_urlpatterns)
+        self.sent = {frame_type: 0 for frame_type in FRAME_MIX}
+        self.received = 0
+        self.latencies = []
+        self.pending = {}
+        self.last_message_id = {}
+
+    def setup_data(self):
+        User = get_user_model()
+        users = {}
+        for room_index in range(self.rooms):
+            room_name = f'bench_room_{room_index}'
+            room, _ = Room.objects.get_or_create(name=room_name)
+            for client_index in range(self.clients):
+                username = f'bench_user_{room_index}_{client_index}'
+                user, _ = User.objects.get_or_create(username=username)
+                # connect() only admits members
+                room.members.add(user)
+                users[(room_name, client_index)] = user
+        return users
+
+    async def connect_all(self, users):
+        communicators = []
+        for (room_name, _), user in users.items():
+            communicator = WebsocketCommunicator(
+                self.application, f'/ws/chat/{room_name}/', subprotocols=[self.subprotocol]
+            )
+            communicator.scope['user'] = user
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise RuntimeError(f'Connection refused for {user.username}')
+            communicators.append((room_name, user, communicator))
+        return communicators
+
+    async def send(self, communicator, frame):
+        payload = self.codec.encode(frame)
+        if self.codec.binary:
+            await communicator.send_to(bytes_data=payload)
+        else:
+            await communicator.send_to(text_data=payload)
+
+    async def drive(self, room_name, user, communicator, deadline):
+        frame_types = list(FRAME_MIX)
+        weights = list(FRAME_MIX.values())
+        while time.monotonic() < deadline:
+            frame_type = self.random.choices(frame_types, weights)[0]
+            last_id = self.last_message_id.get(room_name)
+            if frame_type in ('reaction', 'read_up_to') and last_id is None:
+                frame_type = 'message'
+            if frame_type == 'message':
+                token = f'{user.id}-{self.sent["message"]}'
+                self.pending[token] = time.perf_counter()
+                frame = {'type': 'message', 'message': f'bench {token}', 'username': user.username}
+            elif frame_type == 'typing':
+                frame = {'type': 'typing'}
+            elif frame_type == 'reaction':
+                frame = {'type': 'reaction', 'message_id': last_id, 'emoji': self.random.choice('👍🎉❤')}
+            else:
+                frame = {'type': 'read_up_to', 'message_id': last_id}
+            self.sent[frame_type] += 1
+            await self.send(communicator, frame)
+            await asyncio.sleep(self.random.expovariate(self.rate))
+
+    async def listen(self, room_name, communicator):
+        while True:
+            # receive_output() cancels the consumer on timeout, so read the
+            # queue directly and let run() cancel this task when done
+            output = await communicator.output_queue.get()
+            raw = output.get('bytes') if output.get('bytes') is not None else output.get('text')
+            if raw is None:
+                continue
+            event = self.codec.decode(raw)
+            self.received += 1
+            if event.get('type') == 'chat_message':
+                self.last_message_id[room_name] = event['message_id']
+                started = self.pending.get(event['message'].removeprefix('bench '))
+                if started is not None:
+                    self.latencies.append((time.perf_counter() - started) * 1000)
+
+    async def run(self):
+        users = await database_sync_to_async(self.setup_data)()
+        counter = QueryCounter()
+        # Consumers run their queries on the database_sync_to_async thread
+        await database_sync_to_async(lambda: connection.execute_wrappers.append(counter))()
+
+        tracemalloc.start()
+        before, _ = tracemalloc.get_traced_memory()
+        communicators = await self.connect_all(users)
+        after, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        listeners = [
+            asyncio.ensure_future(self.listen(room_name, communicator))
+            for room_name, _, communicator in communicators
+        ]
+        queries_before = counter.count
+        started = time.monotonic()
+        await asyncio.gather(*(
+            self.drive(room_name, user, communicator, started + self.duration)
+            for room_name, user, communicator in communicators
+        ))
+        elapsed = time.monotonic() - started
+        # Give in-flight broadcasts a moment to arrive
+        await asyncio.sleep(1.0)
+        queries = counter.count - queries_before
+        for listener in listeners:
+            listener.cancel()
+        await asyncio.gather(*listeners, return_exceptions=True)
+        for _, _, communicator in communicators:
+            await communicator.disconnect()
+        await database_sync_to_async(lambda: connection.execute_wrappers.remove(counter))()
+
+        frames = sum(self.sent.values())
+        return {
+            'benchmark': 'load',
+            'rooms': self.rooms,
+            'clients_per_room': self.clients,
+            'connections': len(communicators),
+            'subprotocol': self.subprotocol,
+            'duration_seconds': round(elapsed, 3),
+            'frames_sent': self.sent,
+            'frames_per_second': round(frames / elapsed, 1),
+            'events_delivered': self.received,
+            'deliveries_per_second': round(self.received / elapsed, 1),
+            'fanout_latency_ms': {
+                'samples': len(self.latencies),
+                'p50': percentile(self.latencies, 0.50),
+                'p90': percentile(self.latencies, 0.90),
+                'p99': percentile(self.latencies, 0.99),
+                'max': round(max(self.latencies), 3) if self.latencies else None,
+                'mean': round(statistics.fmean(self.latencies), 3) if self.latencies else None,
+            },
+            'db_queries': queries,
+            'db_queries_per_frame': round(queries / frames, 3) if frames else None,
+            'memory_per_connection_bytes': (after - before) // max(len(communicators), 1),
+        }
+
+
+class Command(BaseCommand):
+    help = 'Simulate rooms full of WebSocket clients against ChatConsumer and report latency/throughput as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=5)
+        parser.add_argument('--clients', type=int, default=20, help='Clients per room')
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds of traffic')
+        parser.add_argument('--rate', type=float, default=1.0, help='Frames per second per client')
+        parser.add_argument('--protocol', default='chat.json.v1', choices=sorted(protocol.CODECS))
+        parser.add_argument('--layer', choices=['memory', 'configured'], default='memory',
+                            help='Use an in-memory channel layer or the one in CHANNEL_LAYERS')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--keepdb', action='store_true',
+                            help='Run against the configured database instead of a throwaway test database')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        if options['layer'] == 'memory':
+            channel_layers.set('default', InMemoryChannelLayer(capacity=10000, expiry=60))
+
+        old_name = None
+        if not options['keepdb']:
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            run = LoadRun(
+                options['rooms'], options['clients'], options['duration'],
+                options['rate'], options['protocol'], options['seed'],
+            )
+            report = asyncio.run(run.run())
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                handle.write(output)
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,151 @@
+import itertools
+import json
+import random
+import time
+import tracemalloc
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from chatapp import search
+from chatapp.models import Message, Room
+from chatapp.management.commands.bench_load import percentile
+
+
+def vocabulary(size, rng):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(letters) for _ in range(rng.randint(3, 9))))
+    return sorted(words)
+
+
+class SearchRun:
+    """Fill one room with generated messages and time searches against it."""
+
+    def __init__(self, messages, queries, vocabulary_size, measure_memory, seed):
+        self.messages = messages
+        self.queries = queries
+        self.measure_memory = measure_memory
+        self.random = random.Random(seed)
+        self.words = vocabulary(vocabulary_size, self.random)
+        # Zipf-like word frequencies, as in real chat text
+        self.cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(self.words))))
+
+    def sentence(self):
+        return ' '.join(self.random.choices(self.words, cum_weights=self.cum_weights, k=self.random.randint(3, 15)))
+
+    def populate(self):
+        user, _ = get_user_model().objects.get_or_create(username='bench_search_user')
+        room, _ = Room.objects.get_or_create(name='bench_search_room')
+        room.members.add(user)
+        started = time.perf_counter()
+        now = timezone.now()
+        batch = []
+        for _ in range(self.messages):
+            batch.append(Message(room=room, user=user, content=self.sentence(), timestamp=now))
+            if len(batch) == 5000:
+                Message.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            Message.objects.bulk_create(batch)
+        return room, time.perf_counter() - started
+
+    def query(self):
+        # Mostly mid-frequency words: the most common ones match most of the room
+        terms = self.random.sample(self.words[len(self.words) // 20:], self.random.randint(1, 3))
+        return ' '.join(terms)
+
+    def run(self):
+        room, populate_seconds = self.populate()
+        report = {
+            'backend': search.backend(),
+            'messages': self.messages,
+            'vocabulary': len(self.words),
+            'populate_seconds': round(populate_seconds, 3),
+        }
+
+        if report['backend'] == 'memory':
+            if self.measure_memory:
+                tracemalloc.start()
+            started = time.perf_counter()
+            search._index.get(room.id)
+            report['index_build_seconds'] = round(time.perf_counter() - started, 3)
+            if self.measure_memory:
+                report['index_memory_mb'] = round(tracemalloc.get_traced_memory()[0] / 1048576, 1)
+                tracemalloc.stop()
+
+        latencies = []
+        hits = 0
+        for _ in range(self.queries):
+            started = time.perf_counter()
+            results, _ = search.search(room.id, self.query())
+            latencies.append((time.perf_counter() - started) * 1000)
+            hits += bool(results)
+        report['search_ms'] = {
+            'p50': percentile(latencies, 0.5),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'max': round(max(latencies), 3),
+        }
+        report['queries_with_results'] = hits
+
+        # Unindexed baseline: what a LIKE scan costs for a single term
+        scans = []
+        for _ in range(min(10, self.queries)):
+            term = self.query().split()[0]
+            started = time.perf_counter()
+            list(Message.objects.filter(room=room, content__icontains=term).order_by('-id')[:20])
+            scans.append((time.perf_counter() - started) * 1000)
+        report['icontains_scan_ms_p50'] = percentile(scans, 0.5)
+
+        # Incremental index maintenance on edit
+        edits = []
+        for message in Message.objects.filter(room=room).order_by('-id')[:50]:
+            message.content = self.sentence()
+            message.edited_at = timezone.now()
+            started = time.perf_counter()
+            message.save(update_fields=['content', 'edited_at'])
+            edits.append((time.perf_counter() - started) * 1000)
+        report['edit_ms_p50'] = percentile(edits, 0.5)
+        return report
+
+
+class Command(BaseCommand):
+    help = 'Time ranked message search over a generated room and report the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=100000,
+                            help='Messages to generate, e.g. 1000000 for a large room')
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--vocabulary', type=int, default=20000, help='Distinct words in generated text')
+        parser.add_argument('--memory', action='store_true',
+                            help='Trace memory used by the in-process index (slows the build)')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--keepdb', action='store_true',
+                            help='Run against the configured database instead of a throwaway test database')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        old_name = None
+        if not options['keepdb']:
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            run = SearchRun(
+                options['messages'], options['queries'], options['vocabulary'],
+                options['memory'], options['seed'],
+            )
+            report = run.run()
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                handle.write(output)
+        else:
+            self.stdout.write(output)
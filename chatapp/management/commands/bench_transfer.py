@@ -0,0 +1,149 @@
+import json
+import os
+import random
+import resource
+import tempfile
+import time
+import tracemalloc
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from chatapp import transfer
+from chatapp.models import Message, MessageReaction, MessageReactionCount, ReadCursor, ReadReceipt, Room
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class TransferRun:
+    """Fill one room, export it to a file, empty it and import the file back."""
+
+    def __init__(self, messages, users, measure_memory, seed):
+        self.messages = messages
+        self.users = users
+        self.measure_memory = measure_memory
+        self.random = random.Random(seed)
+
+    def populate(self):
+        User = get_user_model()
+        users = [User.objects.get_or_create(username=f'bench_transfer_{index}')[0] for index in range(self.users)]
+        room, _ = Room.objects.get_or_create(name='bench_transfer_room')
+        room.members.add(*users)
+        started = time.perf_counter()
+        now = timezone.now()
+        for offset in range(0, self.messages, 5000):
+            batch = [
+                Message(room=room, user=self.random.choice(users), content=f'message {offset + index}', timestamp=now)
+                for index in range(min(5000, self.messages - offset))
+            ]
+            Message.objects.bulk_create(batch)
+            # One reaction and one receipt per ten messages
+            sample = batch[::10]
+            MessageReaction.objects.bulk_create([
+                MessageReaction(message=message, user=self.random.choice(users), emoji='👍') for message in sample
+            ], ignore_conflicts=True)
+            ReadReceipt.objects.bulk_create([
+                ReadReceipt(message=message, user=self.random.choice(users)) for message in sample
+            ], ignore_conflicts=True)
+        return room, time.perf_counter() - started
+
+    def measured(self, func):
+        if self.measure_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        memory = None
+        if self.measure_memory:
+            memory = round(tracemalloc.get_traced_memory()[1] / 1048576, 1)
+            tracemalloc.stop()
+        return result, elapsed, memory
+
+    def empty(self, room):
+        # Raw deletes; the collector would load every row to cascade
+        for model in (MessageReaction, MessageReactionCount, ReadReceipt):
+            model.objects.filter(message__room=room)._raw_delete(connection.alias)
+        ReadCursor.objects.filter(room=room)._raw_delete(connection.alias)
+        Message.objects.filter(room=room)._raw_delete(connection.alias)
+
+    def run(self):
+        room, populate_seconds = self.populate()
+        report = {
+            'vendor': connection.vendor,
+            'messages': self.messages,
+            'populate_seconds': round(populate_seconds, 3),
+        }
+        rows = Message.objects.filter(room=room).count() + MessageReaction.objects.filter(message__room=room).count()
+        rows += ReadReceipt.objects.filter(message__room=room).count()
+
+        with tempfile.NamedTemporaryFile(suffix='.ndjson', delete=False) as output:
+            path = output.name
+
+            def export():
+                for chunk in transfer.chunked(transfer.export_room(room)):
+                    output.write(chunk)
+
+            _, elapsed, memory = self.measured(export)
+        report['export'] = {
+            'seconds': round(elapsed, 3),
+            'rows_per_second': round(rows / elapsed),
+            'bytes': os.path.getsize(path),
+            'traced_peak_mb': memory,
+            'process_peak_rss_mb': peak_rss_mb(),
+        }
+
+        self.empty(room)
+        try:
+            with open(path, 'rb') as source:
+                counts, elapsed, memory = self.measured(
+                    lambda: transfer.Importer(room.name).run(source)
+                )
+        finally:
+            os.unlink(path)
+        report['import'] = {
+            'seconds': round(elapsed, 3),
+            'rows_per_second': round(rows / elapsed),
+            'counts': counts,
+            'traced_peak_mb': memory,
+            'process_peak_rss_mb': peak_rss_mb(),
+        }
+        report['round_trip_ok'] = Message.objects.filter(room=room).count() == self.messages
+        return report
+
+
+class Command(BaseCommand):
+    help = 'Time export_room/import_room over a generated room and report the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=100000,
+                            help='Messages to generate, e.g. 10000000 for a large room')
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--memory', action='store_true',
+                            help='Trace Python allocations during export and import (slows both)')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--keepdb', action='store_true',
+                            help='Run against the configured database instead of a throwaway test database')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        old_name = None
+        if not options['keepdb']:
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            report = TransferRun(options['messages'], options['users'], options['memory'], options['seed']).run()
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                handle.write(output)
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,28 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chatapp import transfer
+from chatapp.models import Room
+
+
+class Command(BaseCommand):
+    help = "Write a room's members, messages, reactions and receipts as NDJSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('room')
+        parser.add_argument('--output', help='File to write (default stdout)')
+
+    def handle(self, *args, **options):
+        room = Room.objects.filter(name=options['room']).first()
+        if room is None:
+            raise CommandError(f'Room {options["room"]} does not exist')
+        output = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        try:
+            for chunk in transfer.chunked(transfer.export_room(room)):
+                output.write(chunk)
+        finally:
+            if options['output']:
+                output.close()
+            else:
+                output.flush()
@@ -0,0 +1,30 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError
+
+from chatapp import transfer
+
+
+class Command(BaseCommand):
+    help = 'Load a room exported with export_room'
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help="NDJSON file, or - for stdin")
+        parser.add_argument('--room', help='Import into this room instead of the exported name')
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--skip-existing', action='store_true',
+                            help="Ignore messages already in the room instead of failing")
+
+    def handle(self, *args, **options):
+        importer = transfer.Importer(options['room'], options['batch_size'], options['skip_existing'])
+        source = sys.stdin.buffer if options['input'] == '-' else open(options['input'], 'rb')
+        try:
+            counts = importer.run(source)
+        except (transfer.InvalidExport, IntegrityError) as exc:
+            raise CommandError(f'Import failed: {exc}') from exc
+        finally:
+            if source is not sys.stdin.buffer:
+                source.close()
+        summary = ', '.join(f'{count} {kind}s' for kind, count in counts.items())
+        self.stdout.write(f'Imported into {importer.room.name}: {summary}')
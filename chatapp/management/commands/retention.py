@@ -0,0 +1,42 @@
+import signal
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from chatapp import retention
+
+
+class Command(BaseCommand):
+    help = 'Archive old messages per room policy and purge stale typing, receipt and deleted-message rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', action='append', dest='rooms',
+                            help='Only apply room policies to this room (repeatable)')
+        parser.add_argument('--periodic', action='store_true',
+                            help='Keep running, once every --interval seconds')
+        parser.add_argument('--interval', type=float, default=None,
+                            help='Seconds between periodic runs (default CHAT_RETENTION INTERVAL)')
+
+    def handle(self, *args, **options):
+        interval = options['interval'] or retention.get_settings()['INTERVAL']
+        self.stopping = False
+        if options['periodic']:
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+        while True:
+            started = time.monotonic()
+            report = retention.run(options['rooms'])
+            summary = ', '.join(f'{name} {count}' for name, count in sorted(report.items())) or 'nothing to do'
+            self.stdout.write(f'Retention: {summary} ({time.monotonic() - started:.1f}s)')
+            if not options['periodic']:
+                return
+            deadline = time.monotonic() + interval
+            while not self.stopping and time.monotonic() < deadline:
+                time.sleep(min(1.0, deadline - time.monotonic()))
+            if self.stopping:
+                return
+            close_old_connections()
+
+    def stop(self, signum, frame):
+        self.stopping = True
@@ -0,0 +1,386 @@
+import argparse
+import os
+import re
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import time
+import zlib
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chatapp.ids import MAX_WORKER_ID
+
+# First request lines naming a room: its WebSocket, e.g.
+# "GET /ws/chat/lobby/?last_message_id=1 HTTP/1.1", its API and its page.
+# Everything else (uploads, profile, the lobby) is spread round-robin.
+ROOM_PATHS = (
+    re.compile(rb'^[A-Z]+ /ws/chat/([^/?\s]+)/'),
+    re.compile(rb'^[A-Z]+ /chat/api/rooms/([^/?\s]+)/'),
+    re.compile(rb'^[A-Z]+ /chat/(?!(?:api|upload|profile|signup|logout|metrics)/)([^/?\s]+)/'),
+)
+PEEK_SIZE = 2048
+PEEK_TIMEOUT = 2.0
+RESTART_DELAY = 1.0
+# Each worker holds its own caches and DB pool, so stay small unless told
+# otherwise (WEB_CONCURRENCY or --workers)
+DEFAULT_WORKERS = 2
+
+
+def room_of(head):
+    """Room named by the request line at the start of ``head``, or None."""
+    for pattern in ROOM_PATHS:
+        match = pattern.match(head)
+        if match:
+            return match.group(1)
+    return None
+
+
+def room_worker(room_name, workers):
+    """Worker index owning ``room_name``; stable across processes and restarts."""
+    return zlib.crc32(room_name) % workers
+
+
+class Worker:
+    def __init__(self, index, command):
+        self.index = index
+        # callable: extra arguments -> argv of the worker process
+        self.command = command
+        self.process = None
+        self.handoff = None
+        self.started = 0
+
+    def start(self, listener=None, affinity=False):
+        env = dict(os.environ, CHAT_WORKER_ID=str(self.index))
+        if affinity:
+            env.setdefault('CHAT_LOCAL_FANOUT', 'True')
+            parent_end, child_end = socket.socketpair()
+            command = self.command(['--handoff-fd', str(child_end.fileno())])
+            self.process = subprocess.Popen(command, env=env, pass_fds=[child_end.fileno()])
+            child_end.close()
+            self.handoff = parent_end
+        else:
+            command = self.command(['--fd', str(listener.fileno())])
+            self.process = subprocess.Popen(command, env=env, pass_fds=[listener.fileno()])
+        self.started = time.monotonic()
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def hand_over(self, connection):
+        try:
+            socket.send_fds(self.handoff, [b'c'], [connection.fileno()])
+            return True
+        except OSError:
+            return False
+
+    def stop(self):
+        if self.alive():
+            self.process.terminate()
+        if self.handoff is not None:
+            self.handoff.close()
+            self.handoff = None
+
+
+def listening_socket(host, port, reuse_port):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def serve_worker(application_path, proxy_headers, handoff_fd=None, listen_fd=None):
+    """Run one Daphne worker on the inherited ``listen_fd``, or fed with
+    connections passed over ``handoff_fd``.
+
+    Unlike plain Daphne, a WebSocket ``send`` here waits while the socket's
+    write buffer is full (see :class:`WriteGate`), so a slow client's frames
+    back up in its ``chatapp.outbound`` queue, where they are shed or end
+    in an overflow, instead of in the transport.
+    """
+    import asyncio
+
+    from daphne.access import AccessLogGenerator
+    from daphne.server import Server
+    from daphne.utils import import_by_path
+    from daphne.ws_protocol import WebSocketProtocol
+    from twisted.internet import reactor
+    from twisted.internet.interfaces import IPushProducer, IReadDescriptor
+    from twisted.web.http import HTTPChannel
+    from zope.interface import implementer
+
+    @implementer(IPushProducer)
+    class WriteGate:
+        """Registered as the producer of a WebSocket's transport; Twisted
+        pauses it while the transport buffers more than it can write."""
+
+        def __init__(self):
+            self.resumed = None
+
+        def pauseProducing(self):
+            if self.resumed is None:
+                self.resumed = asyncio.get_event_loop().create_future()
+
+        def resumeProducing(self):
+            if self.resumed is not None:
+                self.resumed.set_result(None)
+                self.resumed = None
+
+        # Connection lost: release writers, the protocol drops their frames
+        stopProducing = resumeProducing
+
+        async def wait(self):
+            if self.resumed is not None:
+                await asyncio.shield(self.resumed)
+
+    @implementer(IReadDescriptor)
+    class HandoffReader:
+        def __init__(self, adopt):
+            self.doRead = adopt
+
+        def fileno(self):
+            return channel.fileno()
+
+        def connectionLost(self, reason):
+            if reactor.running:
+                reactor.stop()
+
+        def logPrefix(self):
+            return 'handoff'
+
+    class WorkerServer(Server):
+        def run(self):
+            if handoff_fd is not None:
+                # Nothing to listen on; the supervisor hands accepted sockets over
+                self.endpoints = []
+                reactor.callWhenRunning(self.start_handoff)
+            super().run()
+
+        async def handle_reply(self, protocol, message):
+            await super().handle_reply(protocol, message)
+            if message['type'] == 'websocket.send' and isinstance(protocol, WebSocketProtocol):
+                gate = self.connections.get(protocol, {}).get('write_gate')
+                if gate is None:
+                    transport = protocol.transport
+                    producer = getattr(transport, 'producer', None)
+                    if producer is not None:
+                        if not isinstance(producer, HTTPChannel):
+                            return
+                        # Left over from the upgrade request; nothing else uses it
+                        transport.unregisterProducer()
+                    gate = self.connections[protocol]['write_gate'] = WriteGate()
+                    transport.registerProducer(gate, True)
+                await gate.wait()
+
+        def start_handoff(self):
+            self.reader = HandoffReader(self.adopt)
+            reactor.addReader(self.reader)
+
+        def adopt(self):
+            while True:
+                try:
+                    message, fds, _, _ = socket.recv_fds(channel, 1, 16)
+                except BlockingIOError:
+                    return
+                if not message:
+                    # Supervisor went away
+                    reactor.removeReader(self.reader)
+                    reactor.stop()
+                    return
+                for fd in fds:
+                    # The reactor duplicates the descriptor it adopts
+                    connection = socket.socket(fileno=fd)
+                    reactor.adoptStreamConnection(connection.fileno(), connection.family, self.http_factory)
+                    connection.close()
+
+    if handoff_fd is not None:
+        channel = socket.socket(fileno=handoff_fd)
+        channel.setblocking(False)
+        # Satisfies Server's "no endpoints" check; cleared in run()
+        endpoints = ['handoff']
+    else:
+        endpoints = [f'fd:fileno={listen_fd}']
+    headers = {}
+    if proxy_headers:
+        headers = {
+            'proxy_forwarded_address_header': 'X-Forwarded-For',
+            'proxy_forwarded_port_header': 'X-Forwarded-Port',
+            'proxy_forwarded_proto_header': 'X-Forwarded-Proto',
+        }
+    WorkerServer(
+        import_by_path(application_path),
+        endpoints=endpoints,
+        action_logger=AccessLogGenerator(sys.stdout),
+        **headers,
+    ).run()
+
+
+class Supervisor:
+    """Starts ``workers`` Daphne processes on one port and restarts any that die.
+
+    Without affinity every worker gets its own ``SO_REUSEPORT`` socket (or
+    all share one where that option is missing) and the kernel spreads
+    connections across them. With affinity the supervisor accepts
+    connections itself, peeks at the request line and passes the socket to
+    the worker that owns the room, so a room's members mostly share a
+    process and its broadcasts stay local (see
+    ``chatapp.layers.LocalFanoutChannelLayer``).
+    """
+
+    def __init__(self, command, workers, host, port, affinity, stdout):
+        self.workers = [Worker(index, command) for index in range(workers)]
+        self.host = host
+        self.port = port
+        self.affinity = affinity
+        self.stdout = stdout
+        self.listeners = []
+        self.stopping = False
+        self.next_worker = 0
+        self.pending = {}
+
+    def run(self):
+        reuse_port = hasattr(socket, 'SO_REUSEPORT') and not self.affinity
+        count = len(self.workers) if reuse_port else 1
+        self.listeners = [listening_socket(self.host, self.port, reuse_port) for _ in range(count)]
+        for worker in self.workers:
+            self.start(worker)
+        self.stdout.write(
+            f'Serving {len(self.workers)} workers on {self.host}:{self.port}'
+            + (' with room affinity' if self.affinity else '')
+        )
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        try:
+            if self.affinity:
+                self.route_connections()
+            else:
+                while not self.stopping:
+                    time.sleep(RESTART_DELAY)
+                    self.restart_dead()
+        finally:
+            for worker in self.workers:
+                worker.stop()
+            for worker in self.workers:
+                if worker.process is not None:
+                    worker.process.wait()
+            for listener in self.listeners:
+                listener.close()
+
+    def start(self, worker):
+        if self.affinity:
+            worker.start(affinity=True)
+        else:
+            worker.start(self.listeners[worker.index % len(self.listeners)])
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def restart_dead(self):
+        now = time.monotonic()
+        for worker in self.workers:
+            if not worker.alive() and now - worker.started >= RESTART_DELAY:
+                self.stdout.write(f'Worker {worker.index} exited; restarting')
+                worker.stop()
+                self.start(worker)
+
+    def route_connections(self):
+        listener = self.listeners[0]
+        listener.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(listener, selectors.EVENT_READ)
+        while not self.stopping:
+            for key, _ in selector.select(timeout=RESTART_DELAY):
+                if key.fileobj is listener:
+                    self.accept(listener, selector)
+                else:
+                    self.route(key.fileobj, selector)
+            self.expire_pending(selector)
+            self.restart_dead()
+
+    def accept(self, listener, selector):
+        while True:
+            try:
+                connection, _ = listener.accept()
+            except BlockingIOError:
+                return
+            self.pending[connection] = time.monotonic() + PEEK_TIMEOUT
+            selector.register(connection, selectors.EVENT_READ)
+
+    def route(self, connection, selector):
+        try:
+            head = connection.recv(PEEK_SIZE, socket.MSG_PEEK)
+        except OSError:
+            head = b''
+        if not head:
+            self.drop(connection, selector)
+            return
+        if b'\r\n' not in head and len(head) < PEEK_SIZE:
+            # Request line incomplete; wait for more
+            return
+        self.dispatch(connection, selector, room_of(head))
+
+    def expire_pending(self, selector):
+        now = time.monotonic()
+        for connection, deadline in list(self.pending.items()):
+            if deadline <= now:
+                self.dispatch(connection, selector, None)
+
+    def dispatch(self, connection, selector, room_name):
+        if room_name is not None:
+            first = room_worker(room_name, len(self.workers))
+        else:
+            first = self.next_worker
+            self.next_worker = (self.next_worker + 1) % len(self.workers)
+        # Fall back to the next live worker while the owner restarts
+        for offset in range(len(self.workers)):
+            worker = self.workers[(first + offset) % len(self.workers)]
+            if worker.alive() and worker.hand_over(connection):
+                break
+        self.drop(connection, selector)
+
+    def drop(self, connection, selector):
+        selector.unregister(connection)
+        self.pending.pop(connection, None)
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = 'Run several Daphne workers on one port, optionally sharding WebSocket connections by room'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=int(os.getenv('WEB_CONCURRENCY', DEFAULT_WORKERS)))
+        parser.add_argument('--bind', default='0.0.0.0')
+        parser.add_argument('--port', type=int, default=int(os.getenv('PORT', '8000')))
+        parser.add_argument('--application', default='chat_project.asgi:application')
+        parser.add_argument('--affinity', action='store_true',
+                            help='Route each room to one worker and fan out locally within it')
+        parser.add_argument('--proxy-headers', action='store_true',
+                            help='Trust X-Forwarded-* headers from a reverse proxy')
+        # Used by the supervisor to start a worker
+        parser.add_argument('--handoff-fd', type=int, help=argparse.SUPPRESS)
+        parser.add_argument('--fd', type=int, help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['handoff_fd'] is not None or options['fd'] is not None:
+            serve_worker(options['application'], options['proxy_headers'], options['handoff_fd'], options['fd'])
+            return
+        if not 1 <= options['workers'] <= MAX_WORKER_ID + 1:
+            raise CommandError(f'--workers must be between 1 and {MAX_WORKER_ID + 1}')
+
+        application = options['application']
+        proxy = ['--proxy-headers'] if options['proxy_headers'] else []
+
+        def command(extra):
+            return [sys.executable, os.path.abspath(sys.argv[0]), 'runworkers',
+                    '--application', application, *proxy, *extra]
+
+        Supervisor(
+            command, options['workers'], options['bind'], options['port'], options['affinity'], self.stdout
+        ).run()
@@ -0,0 +1,305 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import math
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as RoomCounts
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+# Process-local metrics rendered in the Prometheus text format. Recording is a
+# dict lookup and an addition (plus a bisect for histograms) so it can stay on
+# in production; anything costlier is computed by collectors at scrape time.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+_registry = []
+_collectors = []
+
+
+def _format_labels(labelnames, values):
+    if not labelnames:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in zip(labelnames, values)
+    )
+    return '{' + pairs + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _header(self, name=None):
+        name = name or self.name
+        return [f'# HELP {name} {self.documentation}', f'# TYPE {name} {self.kind}']
+
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def render(self):
+        lines = self._header(f'{self.name}_total')
+        for values, child in list(self._children.items()):
+            lines.append(f'{self.name}_total{_format_labels(self.labelnames, values)} {_format_value(child.value)}')
+        return lines
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def render(self):
+        lines = self._header()
+        for values, child in list(self._children.items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}')
+        return lines
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def render(self):
+        lines = self._header()
+        labelnames = self.labelnames + ('le',)
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), list(child.counts)):
+                cumulative += count
+                lines.append(
+                    f'{self.name}_bucket{_format_labels(labelnames, values + (_format_value(bound),))} {cumulative}'
+                )
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f'{self.name}_sum{labels} {_format_value(child.sum)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+def collector(func):
+    """Register ``func`` to yield ``(name, kind, help, [(labels, value), ...])`` at scrape time."""
+    _collectors.append(func)
+    return func
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for func in _collectors:
+        for name, kind, documentation, samples in func():
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in samples:
+                lines.append(f'{name}{_format_labels(tuple(labels), tuple(labels.values()))} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+connections = Gauge('chat_connections', 'Open WebSocket connections on this worker')
+frames_received = Counter('chat_frames_received', 'Frames received from clients', ['type'])
+frame_db_queries = Histogram(
+    'chat_frame_db_queries', 'Database queries run while handling one frame', ['type'], buckets=COUNT_BUCKETS
+)
+db_call_seconds = Histogram('chat_db_call_seconds', 'Run time of database calls made from async code', ['call'])
+db_wait_seconds = Histogram('chat_db_wait_seconds', 'Time database_sync_to_async calls waited for the DB thread')
+db_in_flight = Gauge('chat_db_calls_in_flight', 'database_sync_to_async calls submitted and not yet finished')
+group_send_seconds = Histogram('chat_group_send_seconds', 'Latency of channel layer group_send', ['event'])
+
+
+# room -> open connections on this worker; exported only as aggregates so
+# room names stay private and label cardinality stays fixed
+_room_connections = RoomCounts()
+
+
+def connection_opened(room):
+    connections.inc()
+    _room_connections[room] += 1
+
+
+def connection_closed(room):
+    connections.dec()
+    _room_connections[room] -= 1
+    if _room_connections[room] <= 0:
+        del _room_connections[room]
+
+
+@collector
+def _collect_rooms():
+    yield ('chat_rooms_active', 'gauge', 'Rooms with open WebSocket connections on this worker',
+           [({}, len(_room_connections))])
+    yield ('chat_room_connections_max', 'gauge', 'Open WebSocket connections in the busiest room on this worker',
+           [({}, max(_room_connections.values(), default=0))])
+
+
+def pooled_connections():
+    """True when the default database hands out connections from a pool
+    (Postgres with ``OPTIONS['pool']``, see ``CHAT_DB_POOL``)."""
+    return bool(settings.DATABASES['default'].get('OPTIONS', {}).get('pool'))
+
+
+def db_call(func):
+    """``database_sync_to_async`` that records queue wait, run time and in-flight calls.
+
+    Works as a decorator on consumer methods and as a wrapper around plain
+    functions, like the original. With a connection pool, calls run on the
+    shared thread pool instead of queueing for the single DB thread. Coroutine
+    functions (async ORM calls) are only timed.
+    """
+    name = func.__name__
+
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def timed(*args, **kwargs):
+            db_in_flight.inc()
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                db_call_seconds.labels(name).observe(time.perf_counter() - started)
+                db_in_flight.dec()
+
+        return timed
+
+    def run(submitted, *args, **kwargs):
+        started = time.perf_counter()
+        db_wait_seconds.observe(started - submitted)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            db_call_seconds.labels(name).observe(time.perf_counter() - started)
+
+    run_in_thread = database_sync_to_async(run, thread_sensitive=not pooled_connections())
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        db_in_flight.inc()
+        try:
+            return await run_in_thread(time.perf_counter(), *args, **kwargs)
+        finally:
+            db_in_flight.dec()
+
+    return wrapper
+
+
+# Mutable per-frame query counter; database_sync_to_async copies the context
+# into the DB thread, so queries issued for a frame land in that frame's list
+_frame_queries = contextvars.ContextVar('chat_frame_queries', default=None)
+
+
+def _count_query(execute, sql, params, many, context):
+    counter = _frame_queries.get()
+    if counter is not None:
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+def _install_query_counter(sender, connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+connection_created.connect(_install_query_counter)
+
+
+@contextlib.contextmanager
+def frame(frame_type):
+    """Count a received frame and the queries run while handling it."""
+    frames_received.labels(frame_type).inc()
+    counter = [0]
+    token = _frame_queries.set(counter)
+    try:
+        yield
+    finally:
+        _frame_queries.reset(token)
+        frame_db_queries.labels(frame_type).observe(counter[0])
+
+
+@collector
+def _channel_layer_depth():
+    from channels.layers import get_channel_layer
+
+    layer = get_channel_layer()
+    # InMemoryChannelLayer keeps its queues in ``channels``, RedisChannelLayer
+    # buffers received messages per channel in ``receive_buffer``
+    queues = getattr(layer, 'receive_buffer', None) or getattr(layer, 'channels', None) or {}
+    depths = [queue.qsize() for queue in list(queues.values())]
+    yield ('chat_channel_layer_queued', 'gauge', 'Messages waiting in local channel layer queues',
+           [({}, sum(depths))])
+    yield ('chat_channel_layer_max_queue', 'gauge', 'Deepest local channel layer queue',
+           [({}, max(depths, default=0))])
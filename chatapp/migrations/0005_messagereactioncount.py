@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_counts(apps, schema_editor):
+    MessageReaction = apps.get_model('chatapp', 'MessageReaction')
+    MessageReactionCount = apps.get_model('chatapp', 'MessageReactionCount')
+    totals = MessageReaction.objects.values('message_id', 'emoji').annotate(total=models.Count('id'))
+    MessageReactionCount.objects.bulk_create(
+        (
+            MessageReactionCount(message_id=row['message_id'], emoji=row['emoji'], count=row['total'])
+            for row in totals.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0004_message_room_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageReactionCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('emoji', models.CharField(max_length=50)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reaction_counts', to='chatapp.message')),
+            ],
+            options={
+                'unique_together': {('message', 'emoji')},
+            },
+        ),
+        migrations.RunPython(backfill_counts, migrations.RunPython.noop),
+    ]
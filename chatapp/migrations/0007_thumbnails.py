@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0006_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='thumbnails',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='avatar_thumbnails',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,36 @@
+from django.db import migrations
+
+# Postgres only: a generated tsvector column kept current by the database on
+# every insert and edit, with a GIN index for ranked search. Other backends
+# use the in-process index in chatapp.search.
+FORWARD = [
+    """
+    ALTER TABLE chatapp_message ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('english', coalesce(content, ''))) STORED
+    """,
+    'CREATE INDEX chatapp_message_search_gin ON chatapp_message USING GIN (search_vector)',
+]
+BACKWARD = [
+    'DROP INDEX IF EXISTS chatapp_message_search_gin',
+    'ALTER TABLE chatapp_message DROP COLUMN IF EXISTS search_vector',
+]
+
+
+def run(statements):
+    def apply(apps, schema_editor):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+    return apply
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0007_thumbnails'),
+    ]
+
+    operations = [
+        migrations.RunPython(run(FORWARD), run(BACKWARD)),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:25
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_stats(apps, schema_editor):
+    Room = apps.get_model('chatapp', 'Room')
+    Message = apps.get_model('chatapp', 'Message')
+    RoomStats = apps.get_model('chatapp', 'RoomStats')
+    ReadCursor = apps.get_model('chatapp', 'ReadCursor')
+
+    def count(queryset, field):
+        # One correlated COUNT per total, rather than joining members x messages
+        return Coalesce(Subquery(
+            queryset.order_by().values(field).annotate(total=models.Count('*')).values('total')
+        ), 0)
+
+    rooms = Room.objects.annotate(
+        total_members=count(Room.members.through.objects.filter(room_id=OuterRef('pk')), 'room_id'),
+        total_messages=count(Message.objects.filter(room_id=OuterRef('pk')), 'room_id'),
+    )
+    stats = []
+    for room in rooms.iterator():
+        last = Message.objects.filter(room=room).order_by('-timestamp', '-id').first()
+        stats.append(RoomStats(
+            room=room,
+            member_count=room.total_members,
+            message_count=room.total_messages,
+            last_message_id=last.id if last else None,
+            last_message_preview=last.content[:100] if last else '',
+            last_activity=last.timestamp if last else room.created_at,
+        ))
+    RoomStats.objects.bulk_create(stats, batch_size=1000)
+    ReadCursor.objects.update(read_count=count(
+        Message.objects.filter(room_id=OuterRef('room_id'), id__lte=OuterRef('last_read_message_id')), 'room_id'
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0008_message_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='readcursor',
+            name='read_count',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='RoomStats',
+            fields=[
+                ('room', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='chatapp.room')),
+                ('member_count', models.PositiveIntegerField(default=0)),
+                ('message_count', models.BigIntegerField(default=0)),
+                ('last_message_id', models.BigIntegerField(blank=True, null=True)),
+                ('last_message_preview', models.CharField(blank=True, max_length=100)),
+                ('last_activity', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-last_activity', '-room'], name='chatapp_roomstats_activity')],
+            },
+        ),
+        migrations.RunPython(backfill_stats, migrations.RunPython.noop),
+    ]
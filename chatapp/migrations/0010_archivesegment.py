@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0009_roomstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.CharField(max_length=7)),
+                ('path', models.CharField(max_length=255)),
+                ('codec', models.CharField(max_length=8)),
+                ('message_count', models.PositiveIntegerField()),
+                ('first_timestamp', models.DateTimeField()),
+                ('first_message_id', models.BigIntegerField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('last_message_id', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archive_segments', to='chatapp.room')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room', 'last_timestamp', 'last_message_id'], name='chatapp_archive_room_last'), models.Index(fields=['room', 'month'], name='chatapp_archive_room_month')],
+            },
+        ),
+    ]
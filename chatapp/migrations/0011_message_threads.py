@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:43
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+
+
+def backfill_threads(apps, schema_editor):
+    Message = apps.get_model('chatapp', 'Message')
+    # Direct replies to top-level messages, then one reply level per pass
+    Message.objects.filter(
+        parent_message__isnull=False, parent_message__parent_message__isnull=True
+    ).update(thread_root=models.F('parent_message'))
+    parent_root = Message.objects.filter(pk=OuterRef('parent_message')).values('thread_root')[:1]
+    while Message.objects.filter(
+        thread_root__isnull=True, parent_message__thread_root__isnull=False
+    ).update(thread_root=Subquery(parent_root)):
+        pass
+    replies = Message.objects.filter(thread_root=OuterRef('pk')).order_by().values('thread_root')
+    Message.objects.filter(pk__in=Message.objects.filter(thread_root__isnull=False).values('thread_root')).update(
+        reply_count=Subquery(replies.annotate(total=Count('id')).values('total')),
+        last_reply_at=Subquery(replies.annotate(last=Max('timestamp')).values('last')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0010_archivesegment'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='last_reply_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='reply_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='thread_root',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='thread_messages', to='chatapp.message'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['thread_root', 'timestamp', 'id'], name='chatapp_msg_thread_ts_id'),
+        ),
+        migrations.RunPython(backfill_threads, migrations.RunPython.noop),
+    ]
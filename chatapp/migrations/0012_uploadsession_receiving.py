@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0011_message_threads'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='uploadsession',
+            name='status',
+            field=models.CharField(choices=[('uploading', 'Uploading'), ('receiving', 'Receiving'), ('processing', 'Processing'), ('complete', 'Complete'), ('failed', 'Failed')], default='uploading', max_length=10),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatapp', '0012_uploadsession_receiving'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThreadFollow',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('root_id', models.BigIntegerField()),
+                ('following', models.BooleanField(default=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='thread_follows', to='chatapp.room')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='thread_follows', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('root_id', 'user')},
+            },
+        ),
+    ]
@@ -1,12 +1,19 @@
+import uuid
+
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
 
+from .conf import get_config
+from .ids import MIN_ALLOCATED_ID, allocate_message_id
+
 # Create your models here.
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     avatar = models.ImageField(upload_to='avatars/', null=True, blank=True)
+    # {size label: storage name} of resized WebP copies (chatapp.thumbnails)
+    avatar_thumbnails = models.JSONField(default=dict, blank=True)
     is_online = models.BooleanField(default=False)
     last_seen = models.DateTimeField(default=timezone.now)
     theme_preference = models.CharField(max_length=10, choices=[('light', 'Light'), ('dark', 'Dark')], default='light')
@@ -22,21 +29,63 @@ class Room(models.Model):
     def __str__(self):
         return self.name
 
+_allocated_ids = None
+
+def allocates_ids():
+    """Whether new messages take their id from the allocator.
+
+    True with write-behind enabled, and also after it has been turned off
+    again once allocator ids are in the table: auto-increment ids would sort
+    below them and break everything ordered by id (read cursors, replay).
+    Checked once per process.
+    """
+    global _allocated_ids
+    if get_config('CHAT_WRITE_BEHIND', {}).get('ENABLED'):
+        return True
+    if _allocated_ids is None:
+        _allocated_ids = Message.objects.filter(pk__gte=MIN_ALLOCATED_ID).exists()
+    return _allocated_ids
+
 class Message(models.Model):
     room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='messages')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='messages')
     parent_message = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='replies')
+    # First message of the reply chain, None for messages in the main timeline.
+    # reply_count and last_reply_at are only maintained on thread roots
+    # (chatapp.threads).
+    thread_root = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='thread_messages')
+    reply_count = models.PositiveIntegerField(default=0)
+    last_reply_at = models.DateTimeField(null=True, blank=True)
     content = models.TextField()
     file = models.FileField(upload_to='chat_files/', null=True, blank=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    thumbnails = models.JSONField(default=dict, blank=True)
+    timestamp = models.DateTimeField(default=timezone.now)
     edited_at = models.DateTimeField(null=True, blank=True)
     is_deleted = models.BooleanField(default=False)
 
     def __str__(self):
         return f'{self.user.username}: {self.content[:50]}'
 
+    def save(self, *args, **kwargs):
+        # Once write-behind has been used every message id comes from the
+        # allocator so ids stay time-ordered whichever path created the row.
+        if self.pk is None and allocates_ids():
+            self.pk = allocate_message_id()
+            kwargs.setdefault('force_insert', True)
+        if self._state.adding and self.parent_message_id and self.thread_root_id is None:
+            # Callers that resolved the thread already (the consumer) pass it in
+            parent = self.parent_message
+            self.thread_root_id = parent.thread_root_id or parent.pk
+        super().save(*args, **kwargs)
+
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # Keyset pagination over a room's history (see chatapp.history)
+            models.Index(fields=['room', 'timestamp', 'id'], name='chatapp_msg_room_ts_id'),
+            # A whole thread in one range scan (see chatapp.history.load_thread)
+            models.Index(fields=['thread_root', 'timestamp', 'id'], name='chatapp_msg_thread_ts_id'),
+        ]
 
 class MessageReaction(models.Model):
     message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='reactions')
@@ -47,6 +96,16 @@ class MessageReaction(models.Model):
     class Meta:
         unique_together = ['message', 'user', 'emoji']
 
+class MessageReactionCount(models.Model):
+    # Denormalized number of MessageReaction rows per (message, emoji), kept
+    # in step by chatapp.reactions.toggle_reaction
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='reaction_counts')
+    emoji = models.CharField(max_length=50)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ['message', 'emoji']
+
 class ReadReceipt(models.Model):
     message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='read_receipts')
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -62,3 +121,88 @@ class TypingStatus(models.Model):
 
     class Meta:
         unique_together = ['room', 'user']
+
+class ThreadFollow(models.Model):
+    # Explicit follow or unfollow of a thread; posters follow implicitly
+    # (see chatapp.threads.participants)
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='thread_follows')
+    # Plain id rather than a foreign key: the root may still be queued by the
+    # write-behind buffer or already archived
+    root_id = models.BigIntegerField()
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='thread_follows')
+    following = models.BooleanField(default=True)
+
+    class Meta:
+        unique_together = ['root_id', 'user']
+
+class RoomStats(models.Model):
+    # Room directory aggregates, maintained incrementally by
+    # chatapp.room_directory instead of COUNT queries per request
+    room = models.OneToOneField(Room, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    member_count = models.PositiveIntegerField(default=0)
+    message_count = models.BigIntegerField(default=0)
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=100, blank=True)
+    last_activity = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-last_activity', '-room'], name='chatapp_roomstats_activity'),
+        ]
+
+class ReadCursor(models.Model):
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='read_cursors')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='read_cursors')
+    # Plain id rather than a foreign key: the message may still be queued by the
+    # write-behind buffer when the receipt arrives.
+    last_read_message_id = models.BigIntegerField(default=0)
+    # Room's RoomStats.message_count minus the messages after the cursor, as
+    # of the last cursor write; unread = message_count - read_count
+    read_count = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['room', 'user']
+
+class ArchiveSegment(models.Model):
+    # One compressed JSON-lines file of a room's archived messages, written by
+    # chatapp.retention; the key range lets history open only the files it needs
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='archive_segments')
+    month = models.CharField(max_length=7)
+    path = models.CharField(max_length=255)
+    codec = models.CharField(max_length=8)
+    message_count = models.PositiveIntegerField()
+    first_timestamp = models.DateTimeField()
+    first_message_id = models.BigIntegerField()
+    last_timestamp = models.DateTimeField()
+    last_message_id = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', 'last_timestamp', 'last_message_id'], name='chatapp_archive_room_last'),
+            models.Index(fields=['room', 'month'], name='chatapp_archive_room_month'),
+        ]
+
+class UploadSession(models.Model):
+    STATUS_CHOICES = [
+        ('uploading', 'Uploading'),
+        # A chunk is being written
+        ('receiving', 'Receiving'),
+        ('processing', 'Processing'),
+        ('complete', 'Complete'),
+        ('failed', 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='uploads')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='uploads')
+    file_name = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    # Hex SHA-256 the client expects; verified once all bytes have arrived
+    sha256 = models.CharField(max_length=64, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='uploading')
+    message = models.OneToOneField(Message, null=True, blank=True, on_delete=models.SET_NULL, related_name='upload')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import weakref
+from collections import OrderedDict
+
+from . import metrics
+from .conf import get_config
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'MAX_QUEUE': 500,
+    'SHED_THRESHOLD': 100,
+    'LAG_THRESHOLD': 50,
+}
+
+# Frames that only describe transient state; shed first when a client lags
+DROPPABLE = {'typing_status', 'user_status'}
+
+# WebSocket close code sent to clients disconnected for falling behind
+OVERFLOW_CLOSE_CODE = 4008
+
+counters = {
+    'dropped': 0,
+    'coalesced': 0,
+    'overflowed': 0,
+}
+_queues = weakref.WeakSet()
+
+
+def coalesce_key(event):
+    """Key under which a newer frame may replace a queued one, or None."""
+    if event['type'] == 'typing_status':
+        # Per worker: each snapshot is that worker's full list of typists
+        return ('typing_status', event.get('source'))
+    if event['type'] == 'message_reaction':
+        # Counts are absolute, so a newer event for the same emojis supersedes
+        return ('message_reaction', event.get('message_id'), tuple(sorted(event.get('reactions', ()))))
+    if event['type'] == 'thread_activity':
+        return ('thread_activity', event.get('message_id'))
+    return None
+
+
+class OutboundQueue:
+    """Bounded queue between a consumer's event handlers and its socket.
+
+    Handlers only enqueue, so a slow client never stalls the consumer's
+    channel-layer receive loop (where the layer would silently drop messages
+    once ``capacity`` is reached). Past ``shed_threshold`` frames transient
+    frames are dropped, repeated frames are coalesced while still queued, and
+    ``put`` returns False once ``max_queue`` is reached so the consumer can
+    disconnect the client and let it resume from ``last_message_id``.
+
+    The queue only fills if ``write`` waits for the socket. Workers started
+    by ``runworkers`` make a WebSocket send wait while the transport's write
+    buffer is full; plain ``daphne`` and ``runserver`` buffer every frame in
+    the transport, so there the queue only absorbs bursts.
+    """
+
+    def __init__(self, write, max_queue, shed_threshold, lag_threshold):
+        self.write = write
+        self.max_queue = max_queue
+        self.shed_threshold = shed_threshold
+        self.lag_threshold = lag_threshold
+        # key -> (event type, payload, message id)
+        self.items = OrderedDict()
+        self.last_message_id = None
+        self.closed = False
+        self._seq = 0
+        self._task = None
+        _queues.add(self)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def lagging(self):
+        return len(self.items) >= self.lag_threshold
+
+    def put(self, event_type, payload, key=None, message_id=None):
+        if self.closed:
+            return True
+        if key is not None and key in self.items:
+            self.items[key] = (event_type, payload, message_id)
+            counters['coalesced'] += 1
+            return True
+        if event_type in DROPPABLE and len(self.items) >= self.shed_threshold:
+            counters['dropped'] += 1
+            return True
+        if len(self.items) >= self.max_queue:
+            self._shed()
+            if len(self.items) >= self.max_queue:
+                counters['overflowed'] += 1
+                return False
+        if key is None:
+            self._seq += 1
+            key = self._seq
+        self.items[key] = (event_type, payload, message_id)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._drain())
+        return True
+
+    def _shed(self):
+        droppable = [key for key, (event_type, _, _) in self.items.items() if event_type in DROPPABLE]
+        for key in droppable:
+            del self.items[key]
+        counters['dropped'] += len(droppable)
+
+    def close(self):
+        """Discard queued frames and stop writing."""
+        self.closed = True
+        self.items.clear()
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    async def _drain(self):
+        while self.items and not self.closed:
+            _, (_, payload, message_id) = self.items.popitem(last=False)
+            try:
+                await self.write(payload)
+            except Exception:
+                logger.exception('Outbound write failed')
+                self.close()
+                return
+            if message_id is not None:
+                self.last_message_id = message_id
+
+
+def stats():
+    queues = list(_queues)
+    return dict(
+        counters,
+        connections=len(queues),
+        lagging=sum(1 for queue in queues if queue.lagging),
+        max_depth=max((len(queue) for queue in queues), default=0),
+    )
+
+
+@metrics.collector
+def _collect():
+    current = stats()
+    yield ('chat_outbound_lagging_connections', 'gauge', 'Connections whose outbound queue is at LAG_THRESHOLD or deeper',
+           [({}, current['lagging'])])
+    yield ('chat_outbound_max_depth', 'gauge', 'Deepest per-connection outbound queue', [({}, current['max_depth'])])
+    yield ('chat_outbound_dropped_total', 'counter', 'Typing/presence frames shed for lagging clients',
+           [({}, current['dropped'])])
+    yield ('chat_outbound_coalesced_total', 'counter', 'Queued frames replaced by a newer equivalent',
+           [({}, current['coalesced'])])
+    yield ('chat_outbound_overflowed_total', 'counter', 'Clients disconnected for a full outbound queue',
+           [({}, current['overflowed'])])
+
+
+_config = get_config('CHAT_OUTBOUND', DEFAULTS)
+
+
+def create_queue(write):
+    return OutboundQueue(write, _config['MAX_QUEUE'], _config['SHED_THRESHOLD'], _config['LAG_THRESHOLD'])
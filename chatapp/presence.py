@@ -0,0 +1,231 @@
+import asyncio
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.utils import timezone
+
+from . import metrics
+from .conf import get_config
+from .models import UserProfile
+from .protocol import group_send
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'BROADCAST_INTERVAL': 1.0,
+    'HEARTBEAT_INTERVAL': 20,
+    'TTL': 60,
+    'DB_FLUSH_INTERVAL': 30,
+}
+
+
+def _key(user_id, group=None):
+    if group is None:
+        return f'chat:presence:{user_id}'
+    return f'chat:presence:{user_id}:{group}'
+
+
+def flush_last_seen(statuses):
+    """Write ``{user_id: is_online}`` to UserProfile in at most three queries."""
+    if not statuses:
+        return
+    now = timezone.now()
+    UserProfile.objects.bulk_create(
+        [UserProfile(user_id=user_id) for user_id in statuses],
+        ignore_conflicts=True,
+    )
+    for is_online in (True, False):
+        user_ids = [user_id for user_id, online in statuses.items() if online is is_online]
+        if user_ids:
+            UserProfile.objects.filter(user_id__in=user_ids).update(is_online=is_online, last_seen=now)
+
+
+class PresenceTracker:
+    """Tracks who is online without touching the database per socket event.
+
+    Each user's open connections are counted in the shared cache (Redis in
+    production), in total and per room, under keys whose TTL is refreshed by
+    live heartbeats, so several tabs keep a user online and a crashed
+    worker's counts expire.
+    Online/offline transitions are collected per room and broadcast as one
+    ``user_status`` event per room per ``BROADCAST_INTERVAL``; profile rows are
+    updated in batches every ``DB_FLUSH_INTERVAL``.
+    """
+
+    def __init__(self, broadcast_interval, heartbeat_interval, ttl, db_flush_interval):
+        self.broadcast_interval = broadcast_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.ttl = ttl
+        self.db_flush_interval = db_flush_interval
+        # channel_name -> [user_id, group, last heartbeat]
+        self.connections = {}
+        # user_id -> {group: local connection count}
+        self.user_rooms = {}
+        # user_id -> rooms this worker last saw the user leave while the shared
+        # counts said they were still connected elsewhere; watched until the
+        # counts expire so the offline status is not lost with a crashed worker
+        self.lingering = {}
+        self.pending = {}
+        self.db_pending = {}
+        # user_id -> small avatar URL, announced with the user's online status
+        self.avatars = {}
+        self.channel_layer = None
+        self._task = None
+        self._loop = None
+
+    async def connect(self, channel_layer, group, channel_name, user_id, avatar=None):
+        self.channel_layer = channel_layer
+        if avatar:
+            self.avatars[user_id] = avatar
+        self.connections[channel_name] = [user_id, group, time.monotonic()]
+        rooms = self.user_rooms.setdefault(user_id, {})
+        first_in_room = group not in rooms
+        rooms[group] = rooms.get(group, 0) + 1
+        self.lingering.get(user_id, set()).discard(group)
+        count, room_count = await sync_to_async(self._incr, thread_sensitive=False)(user_id, group)
+        if count == 1:
+            self.db_pending[user_id] = True
+        if room_count == 1 or first_in_room:
+            self._queue(group, user_id, 'online')
+        self._ensure_running()
+
+    async def disconnect(self, channel_name):
+        connection = self.connections.pop(channel_name, None)
+        if connection is None:
+            return
+        user_id, group, _ = connection
+        rooms = self.user_rooms.get(user_id, {})
+        rooms[group] = rooms.get(group, 1) - 1
+        if rooms[group] <= 0:
+            del rooms[group]
+        count, room_count = await sync_to_async(self._decr, thread_sensitive=False)(user_id, group)
+        if group not in rooms:
+            # Last connection to this room here; other rooms don't keep it online
+            if room_count <= 0:
+                self._queue(group, user_id, 'offline')
+            else:
+                self.lingering.setdefault(user_id, set()).add(group)
+        if rooms:
+            return
+        del self.user_rooms[user_id]
+        if count <= 0:
+            self._went_offline(user_id)
+        else:
+            self.lingering.setdefault(user_id, set())
+
+    def heartbeat(self, channel_name):
+        connection = self.connections.get(channel_name)
+        if connection is not None:
+            connection[2] = time.monotonic()
+
+    def _went_offline(self, user_id):
+        self.db_pending[user_id] = False
+        self.avatars.pop(user_id, None)
+
+    def _queue(self, group, user_id, status):
+        changes = self.pending.setdefault(group, {})
+        changes[user_id] = status
+
+    def _incr(self, user_id, group):
+        """Count a connection; return the user's total and per-room counts."""
+        counts = []
+        for key in (_key(user_id), _key(user_id, group)):
+            cache.add(key, 0, self.ttl)
+            try:
+                counts.append(cache.incr(key))
+            except ValueError:
+                cache.set(key, 1, self.ttl)
+                counts.append(1)
+        return counts
+
+    def _decr(self, user_id, group):
+        counts = []
+        for key in (_key(user_id), _key(user_id, group)):
+            try:
+                count = cache.decr(key)
+            except ValueError:
+                count = 0
+            if count <= 0:
+                cache.delete(key)
+            counts.append(count)
+        return counts
+
+    def _refresh(self, user_rooms, lingering):
+        """Refresh TTLs of local connections' counts; return which of the
+        keys watched for ``lingering`` users still exist."""
+        for user_id, rooms in user_rooms.items():
+            counts = {_key(user_id): sum(rooms.values())}
+            counts.update({_key(user_id, group): count for group, count in rooms.items()})
+            for key, count in counts.items():
+                if not cache.touch(key, self.ttl):
+                    # Expired under us (e.g. a cache restart); restore this worker's share
+                    cache.add(key, count, self.ttl)
+        keys = [_key(user_id) for user_id in lingering]
+        keys += [_key(user_id, group) for user_id, groups in lingering.items() for group in groups]
+        return set(cache.get_many(keys))
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        last_heartbeat = last_db_flush = time.monotonic()
+        while self.connections or self.pending or self.lingering or self.db_pending:
+            await asyncio.sleep(self.broadcast_interval)
+            now = time.monotonic()
+            try:
+                if now - last_heartbeat >= self.heartbeat_interval:
+                    last_heartbeat = now
+                    await self._sweep(now)
+                await self._broadcast()
+                if now - last_db_flush >= self.db_flush_interval or not self.connections:
+                    last_db_flush = now
+                    statuses, self.db_pending = self.db_pending, {}
+                    await metrics.db_call(flush_last_seen)(statuses)
+            except Exception:
+                logger.exception('Presence maintenance failed')
+
+    async def _sweep(self, now):
+        for channel_name, (_, _, last_beat) in list(self.connections.items()):
+            if now - last_beat > self.ttl:
+                # The socket stopped heartbeating; close it so it is counted out
+                await self.channel_layer.send(channel_name, {'type': 'presence_expired'})
+        alive = await sync_to_async(self._refresh, thread_sensitive=False)(
+            {user_id: dict(rooms) for user_id, rooms in self.user_rooms.items()},
+            {user_id: set(groups) for user_id, groups in self.lingering.items()},
+        )
+        for user_id, groups in list(self.lingering.items()):
+            for group in [group for group in groups if _key(user_id, group) not in alive]:
+                groups.discard(group)
+                self._queue(group, user_id, 'offline')
+            if user_id in self.user_rooms:
+                # Connected here again; the last local disconnect decides
+                if not groups:
+                    del self.lingering[user_id]
+            elif _key(user_id) not in alive:
+                del self.lingering[user_id]
+                self._went_offline(user_id)
+
+    async def _broadcast(self):
+        pending, self.pending = self.pending, {}
+        for group, changes in pending.items():
+            online = [user_id for user_id, status in changes.items() if status == 'online']
+            await group_send(self.channel_layer, group, {
+                'type': 'user_status',
+                'online': online,
+                'offline': [user_id for user_id, status in changes.items() if status == 'offline'],
+                'avatars': {user_id: self.avatars[user_id] for user_id in online if user_id in self.avatars},
+            })
+
+
+_config = get_config('CHAT_PRESENCE', DEFAULTS)
+tracker = PresenceTracker(
+    _config['BROADCAST_INTERVAL'],
+    _config['HEARTBEAT_INTERVAL'],
+    _config['TTL'],
+    _config['DB_FLUSH_INTERVAL'],
+)
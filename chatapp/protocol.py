@@ -0,0 +1,164 @@
+import json
+import time
+from collections import Counter
+
+import msgpack
+
+from . import metrics
+
+try:
+    import cbor2
+except ImportError:  # optional
+    cbor2 = None
+
+# Long field name -> short wire key used by the binary encodings
+FIELD_KEYS = {
+    'type': 't',
+    'message': 'm',
+    'message_id': 'i',
+    'message_ids': 'is',
+    'messages': 'ms',
+    'username': 'u',
+    'user_id': 'ui',
+    'parent_id': 'p',
+    'parent_preview': 'pp',
+    'file_url': 'f',
+    'file_name': 'fn',
+    'thumbnails': 'th',
+    'avatars': 'av',
+    'timestamp': 'ts',
+    'edited_at': 'e',
+    'is_deleted': 'd',
+    'reactions': 'r',
+    'reply_count': 'rc',
+    'thread_root_id': 'tr',
+    'last_reply_at': 'lr',
+    'emoji': 'em',
+    'typing': 'ty',
+    'stopped': 'st',
+    'ttl': 'tl',
+    'cursors': 'c',
+    'online': 'on',
+    'offline': 'of',
+    'complete': 'co',
+    'last_message_id': 'l',
+    'frame': 'fr',
+    'scope': 'sc',
+    'retry_after': 'ra',
+    'source': 'so',
+}
+SHORT_KEYS = {short: field for field, short in FIELD_KEYS.items()}
+
+
+def remap(value, keys):
+    """Recursively rename dict keys found in ``keys``."""
+    if isinstance(value, dict):
+        return {keys.get(key, key): remap(item, keys) for key, item in value.items()}
+    if isinstance(value, list):
+        return [remap(item, keys) for item in value]
+    return value
+
+
+class JSONCodec:
+    subprotocol = 'chat.json.v1'
+    binary = False
+
+    def encode(self, event):
+        return json.dumps(event)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class MsgpackCodec:
+    subprotocol = 'chat.msgpack.v1'
+    binary = True
+
+    def encode(self, event):
+        return msgpack.packb(remap(event, FIELD_KEYS), use_bin_type=True)
+
+    def decode(self, data):
+        return remap(msgpack.unpackb(data, raw=False), SHORT_KEYS)
+
+
+class CBORCodec:
+    subprotocol = 'chat.cbor.v1'
+    binary = True
+
+    def encode(self, event):
+        return cbor2.dumps(remap(event, FIELD_KEYS))
+
+    def decode(self, data):
+        return remap(cbor2.loads(data), SHORT_KEYS)
+
+
+CODECS = {codec.subprotocol: codec for codec in (JSONCodec(), MsgpackCodec())}
+if cbor2 is not None:
+    CODECS[CBORCodec.subprotocol] = CBORCodec()
+
+DEFAULT_CODEC = CODECS[JSONCodec.subprotocol]
+
+
+def negotiate(requested):
+    """Pick the first supported subprotocol the client offered.
+
+    Returns ``(codec, subprotocol)``; ``subprotocol`` is None for clients that
+    offered none, which keep the plain JSON protocol.
+    """
+    for subprotocol in requested or ():
+        if subprotocol in CODECS:
+            return CODECS[subprotocol], subprotocol
+    return DEFAULT_CODEC, None
+
+
+# Open connections of this process per subprotocol
+in_use = Counter()
+
+
+def connection_opened(codec):
+    in_use[codec.subprotocol] += 1
+
+
+def connection_closed(codec):
+    in_use[codec.subprotocol] -= 1
+    if in_use[codec.subprotocol] <= 0:
+        del in_use[codec.subprotocol]
+
+
+def pre_encode(event, keep=()):
+    """Encode ``event`` once per codec in use, for a room-wide ``group_send``.
+
+    The result carries the handler ``type``, the ready-to-send ``frames`` keyed
+    by subprotocol and any ``keep`` fields receivers still need to inspect, so
+    each recipient's handler only picks its frame instead of re-serializing.
+    JSON is always included; other codecs only when a connection of this
+    process uses them, the rest is left to :func:`frame_for`.
+    """
+    message = {key: event[key] for key in keep if key in event}
+    message['type'] = event['type']
+    message['frames'] = {
+        subprotocol: CODECS[subprotocol].encode(event)
+        for subprotocol in {DEFAULT_CODEC.subprotocol, *in_use} if subprotocol in CODECS
+    }
+    return message
+
+
+def frame_for(message, codec):
+    """``codec``'s frame of a pre-encoded ``message``.
+
+    A frame the sender skipped (no such client on its worker, or a codec it
+    lacks) is encoded from the JSON frame and kept in ``frames``, which
+    local receivers of the same message share.
+    """
+    frames = message['frames']
+    payload = frames.get(codec.subprotocol)
+    if payload is None:
+        payload = frames[codec.subprotocol] = codec.encode(json.loads(frames[DEFAULT_CODEC.subprotocol]))
+    return payload
+
+
+async def group_send(channel_layer, group, event, keep=()):
+    message = pre_encode(event, keep)
+    started = time.perf_counter()
+    await channel_layer.group_send(group, message)
+    metrics.group_send_seconds.labels(event['type']).observe(time.perf_counter() - started)
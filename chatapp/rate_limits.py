@@ -0,0 +1,162 @@
+import math
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+
+from . import metrics
+from .conf import get_config, redis_client
+
+DEFAULTS = {
+    'ENABLED': True,
+    'BACKEND': 'local',
+    # frame type -> scope ('user' or 'room') -> (tokens per second, burst)
+    'LIMITS': {
+        'message': {'user': (2, 10), 'room': (50, 200)},
+        'reaction': {'user': (5, 20), 'room': (100, 400)},
+        'resume': {'user': (0.2, 3)},
+    },
+}
+
+throttled_frames = metrics.Counter(
+    'chat_frames_throttled', 'Frames rejected by rate limits', ['type', 'scope']
+)
+
+
+class LocalBuckets:
+    """Token buckets kept in this process's memory."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        # key -> [tokens, last refill]
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, requests):
+        """Take one token from each ``(key, rate, burst)`` bucket, or from none.
+
+        Return ``(index, seconds until a token is available)`` of the first
+        empty bucket, or None if the tokens were taken.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if len(self.buckets) >= self.max_keys and any(key not in self.buckets for key, _, _ in requests):
+                self._prune(now)
+            refilled = []
+            for index, (key, rate, burst) in enumerate(requests):
+                bucket = self.buckets.get(key)
+                tokens = burst if bucket is None else min(burst, bucket[0] + (now - bucket[1]) * rate)
+                if tokens < 1:
+                    return index, (1 - tokens) / rate
+                refilled.append(tokens)
+            for (key, _, _), tokens in zip(requests, refilled):
+                self.buckets[key] = [tokens - 1, now]
+            return None
+
+    def _prune(self, now):
+        # Buckets idle long enough to be full again carry no state
+        self.buckets = {
+            key: bucket for key, bucket in self.buckets.items() if now - bucket[1] < 60
+        }
+
+
+# Refill and take from every bucket of a frame in one round trip, so workers
+# sharing a bucket can't race and a frame rejected by one bucket costs no
+# token from the others
+TAKE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local refilled = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or burst
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    if tokens < 1 then
+        return {i - 1, tostring((1 - tokens) / rate)}
+    end
+    refilled[i] = tokens
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    redis.call('HSET', key, 'tokens', tostring(refilled[i] - 1), 'ts', tostring(now))
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+end
+return false
+"""
+
+
+class RedisBuckets:
+    """Token buckets shared by every worker through Redis."""
+
+    def __init__(self, client):
+        self.client = client
+        self.script = client.register_script(TAKE_SCRIPT)
+
+    def take(self, requests):
+        args = [time.time()]
+        for _, rate, burst in requests:
+            args += [rate, burst]
+        result = self.script(keys=[f'chat:ratelimit:{key}' for key, _, _ in requests], args=args)
+        if result is None:
+            return None
+        return int(result[0]), float(result[1])
+
+
+class RateLimiter:
+    """Token-bucket limits per frame type, applied per user and per room."""
+
+    def __init__(self, buckets, limits, enabled=True):
+        self.buckets = buckets
+        self.limits = limits
+        self.enabled = enabled
+        self.shared = isinstance(buckets, RedisBuckets)
+
+    def check(self, frame_type, user_id, room_name):
+        """Return ``(scope, retry_after)`` of the first exhausted bucket, or None.
+
+        Tokens are only taken when every bucket of the frame has one.
+        """
+        scopes = self.limits.get(frame_type)
+        if not self.enabled or not scopes:
+            return None
+        requests = []
+        for scope, (rate, burst) in scopes.items():
+            subject = user_id if scope == 'user' else room_name
+            requests.append((f'{frame_type}:{scope}:{subject}', rate, burst))
+        exhausted = self.buckets.take(requests)
+        if exhausted is None:
+            return None
+        index, wait = exhausted
+        scope = list(scopes)[index]
+        throttled_frames.labels(frame_type, scope).inc()
+        return scope, math.ceil(wait * 1000) / 1000
+
+    async def check_async(self, frame_type, user_id, room_name):
+        if not self.shared or frame_type not in self.limits:
+            return self.check(frame_type, user_id, room_name)
+        return await sync_to_async(self.check, thread_sensitive=False)(frame_type, user_id, room_name)
+
+
+def _build_limiter():
+    config = get_config('CHAT_RATE_LIMITS', DEFAULTS)
+    if config['BACKEND'] == 'cache':
+        buckets = RedisBuckets(redis_client())
+    else:
+        buckets = LocalBuckets()
+    return RateLimiter(buckets, config['LIMITS'], config['ENABLED'])
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter():
+    global _limiter
+    if _limiter is None:
+        with _limiter_lock:
+            if _limiter is None:
+                _limiter = _build_limiter()
+    return _limiter
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from . import metrics
+from .conf import get_config
+from .models import Message, MessageReaction, MessageReactionCount
+from .protocol import group_send
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'FLUSH_INTERVAL': 0.25,
+    'CACHE_TTL': 3600,
+}
+
+
+def _key(message_id):
+    return f'chat:reactions:{message_id}'
+
+
+def toggle_reaction(message_id, user, emoji, room_id):
+    """Add ``user``'s ``emoji`` to a message, or remove it if already there.
+
+    The matching MessageReactionCount row is adjusted with an ``F()`` update
+    in the same transaction, so counts stay exact under concurrent clicks
+    without reading every reaction row. Returns True if the reaction was
+    added, False if it was removed and None if there is no such message in
+    room ``room_id``.
+    """
+    if not 0 < len(emoji) <= MessageReaction._meta.get_field('emoji').max_length:
+        return None
+    if not Message.objects.filter(pk=message_id, room_id=room_id).exists():
+        return None
+    try:
+        with transaction.atomic():
+            deleted, _ = MessageReaction.objects.filter(message_id=message_id, user=user, emoji=emoji).delete()
+            if deleted:
+                delta = -1
+            else:
+                try:
+                    with transaction.atomic():
+                        MessageReaction.objects.create(message_id=message_id, user=user, emoji=emoji)
+                except IntegrityError:
+                    # A concurrent click by the same user already added it
+                    return True
+                delta = 1
+            counts = MessageReactionCount.objects.filter(message_id=message_id, emoji=emoji)
+            if not counts.update(count=F('count') + delta):
+                _, created = MessageReactionCount.objects.get_or_create(
+                    message_id=message_id, emoji=emoji, defaults={'count': max(delta, 0)}
+                )
+                if not created:
+                    counts.update(count=F('count') + delta)
+    except IntegrityError:
+        # The message was deleted since the check (deferred foreign keys)
+        return None
+    return delta > 0
+
+
+def message_counts(message_ids):
+    """``{message_id: {emoji: count}}`` for the given messages, in one query."""
+    counts = {message_id: {} for message_id in message_ids}
+    rows = MessageReactionCount.objects.filter(message_id__in=message_ids, count__gt=0)
+    for message_id, emoji, count in rows.values_list('message_id', 'emoji', 'count'):
+        counts[message_id][emoji] = count
+    return counts
+
+
+def with_current_counts(entries):
+    """Copies of serialized ``entries`` carrying counts changed since they were cached.
+
+    Ring-buffer entries are not rewritten on every reaction; instead the
+    flusher stores each changed message's counts under a cache key that this
+    overlays with a single ``get_many``.
+    """
+    if not entries:
+        return entries
+    current = cache.get_many([_key(entry['message_id']) for entry in entries])
+    if not current:
+        return entries
+    return [
+        dict(entry, reactions=current[_key(entry['message_id'])])
+        if _key(entry['message_id']) in current else entry
+        for entry in entries
+    ]
+
+
+class ReactionBroadcaster:
+    """Batches reaction changes into one ``message_reaction`` event per message.
+
+    Every toggle only marks ``(message, emoji)`` as changed; once per
+    ``flush_interval`` the current counts of all changed messages are read in
+    one query and each room gets the ``{emoji: count}`` values that changed,
+    so a viral message costs a few broadcasts per second however fast it is
+    clicked.
+    """
+
+    def __init__(self, flush_interval, cache_ttl):
+        self.flush_interval = flush_interval
+        self.cache_ttl = cache_ttl
+        # (group, message_id) -> set of changed emojis
+        self.pending = {}
+        self._task = None
+        self._loop = None
+
+    def changed(self, channel_layer, group, message_id, emoji):
+        self.pending.setdefault((group, message_id), set()).add(emoji)
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._task = loop.create_task(self._run(channel_layer))
+
+    async def _run(self, channel_layer):
+        while self.pending:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush(channel_layer)
+            except Exception:
+                logger.exception('Reaction broadcast failed')
+
+    async def flush(self, channel_layer):
+        batch, self.pending = self.pending, {}
+        if not batch:
+            return
+        counts = await metrics.db_call(message_counts)({message_id for _, message_id in batch})
+        await sync_to_async(cache.set_many, thread_sensitive=False)(
+            {_key(message_id): counts[message_id] for message_id in counts}, self.cache_ttl
+        )
+        for (group, message_id), emojis in batch.items():
+            await group_send(channel_layer, group, {
+                'type': 'message_reaction',
+                'message_id': message_id,
+                'reactions': {emoji: counts[message_id].get(emoji, 0) for emoji in emojis},
+            }, keep=('message_id',))
+
+
+_config = get_config('CHAT_REACTIONS', DEFAULTS)
+broadcaster = ReactionBroadcaster(_config['FLUSH_INTERVAL'], _config['CACHE_TTL'])
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+from functools import reduce
+from operator import or_
+
+from django.db.models import BigIntegerField, Case, F, Max, Q, Value, When
+from django.utils import timezone
+
+from . import metrics
+from .conf import get_config
+from .models import Message, ReadCursor
+from .protocol import group_send
+from .room_directory import refresh_read_counts
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'FLUSH_INTERVAL': 1.0,
+}
+
+
+def upsert_cursors(cursors):
+    """Advance ``{(room_id, user_id): message_id}`` read cursors in four queries:
+    insert the missing rows, move the cursors forward, refresh their
+    ``read_count`` for the room directory's unread badges and read them back.
+
+    Cursors only ever move forward: the update compares against the stored
+    value inside the statement, so concurrent writers cannot move one back.
+    Returns the stored ``{(room_id, user_id): message_id}``.
+    """
+    if not cursors:
+        return {}
+    now = timezone.now()
+    ReadCursor.objects.bulk_create(
+        [
+            ReadCursor(room_id=room_id, user_id=user_id, last_read_message_id=message_id, updated_at=now)
+            for (room_id, user_id), message_id in cursors.items()
+        ],
+        ignore_conflicts=True,
+    )
+    rows = ReadCursor.objects.filter(
+        reduce(or_, (Q(room_id=room_id, user_id=user_id) for room_id, user_id in cursors))
+    )
+    rows.update(
+        last_read_message_id=Case(
+            *(
+                When(room_id=room_id, user_id=user_id, last_read_message_id__lt=message_id, then=Value(message_id))
+                for (room_id, user_id), message_id in cursors.items()
+            ),
+            default=F('last_read_message_id'),
+            output_field=BigIntegerField(),
+        ),
+        updated_at=now,
+    )
+    refresh_read_counts(cursors.keys())
+    return {
+        (room_id, user_id): message_id
+        for room_id, user_id, message_id in rows.values_list('room_id', 'user_id', 'last_read_message_id')
+    }
+
+
+def clamp_cursors(cursors):
+    """Clamp ``{(room_id, user_id): message_id}`` to each room's newest message.
+
+    A cursor past the newest message would mark messages not yet sent as
+    read. Cursors for rooms without messages are dropped.
+    """
+    latest = dict(
+        Message.objects.filter(room_id__in={room_id for room_id, _ in cursors})
+        .order_by().values('room_id').annotate(latest=Max('id')).values_list('room_id', 'latest')
+    )
+    return {
+        key: min(message_id, latest[key[0]])
+        for key, message_id in cursors.items()
+        if key[0] in latest
+    }
+
+
+def message_readers(message):
+    """Users who have read ``message``, derived from the room's read cursors."""
+    return ReadCursor.objects.filter(
+        room_id=message.room_id,
+        last_read_message_id__gte=message.id,
+    ).select_related('user')
+
+
+class ReadCursorBuffer:
+    """Collects read-up-to marks and writes/broadcasts them once per interval.
+
+    Marks for the same (room, user) collapse to the highest message id, so a
+    client acknowledging a hundred messages costs one upsert row and one entry
+    in a single ``read_receipt`` event for the room.
+    """
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self._task = None
+        self._loop = None
+
+    def mark(self, channel_layer, group, room_id, user_id, username, message_id):
+        key = (room_id, user_id)
+        current = self.pending.get(key)
+        if current is None or message_id > current[0]:
+            self.pending[key] = (message_id, group, username)
+        self._ensure_flusher(channel_layer)
+
+    def _ensure_flusher(self, channel_layer):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._task = loop.create_task(self._run(channel_layer))
+
+    async def _run(self, channel_layer):
+        while self.pending:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush(channel_layer)
+
+    async def flush(self, channel_layer):
+        batch, self.pending = self.pending, {}
+        if not batch:
+            return
+        try:
+            cursors = await metrics.db_call(clamp_cursors)(
+                {key: message_id for key, (message_id, _, _) in batch.items()}
+            )
+            stored = await metrics.db_call(upsert_cursors)(cursors)
+        except Exception:
+            logger.exception('Failed to store %d read cursors', len(batch))
+            # Retried next interval; nothing is broadcast that wasn't stored
+            for key, pending in batch.items():
+                current = self.pending.get(key)
+                if current is None or pending[0] > current[0]:
+                    self.pending[key] = pending
+            return
+        events = {}
+        for key, (_, group, username) in batch.items():
+            message_id = cursors.get(key)
+            if message_id is None or stored.get(key) != message_id:
+                # Behind the stored cursor, which was broadcast when it was written
+                continue
+            events.setdefault(group, []).append({
+                'user_id': key[1],
+                'username': username,
+                'message_id': message_id,
+            })
+        for group, cursors in events.items():
+            await group_send(channel_layer, group, {
+                'type': 'read_receipt',
+                'cursors': cursors,
+            })
+
+
+buffer = ReadCursorBuffer(get_config('CHAT_READ_RECEIPTS', DEFAULTS)['FLUSH_INTERVAL'])
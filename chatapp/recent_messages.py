@@ -0,0 +1,224 @@
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.utils.dateparse import parse_datetime
+
+from .conf import get_config, redis_client
+
+DEFAULTS = {
+    'BACKEND': 'auto',
+    'SIZE': 200,
+    'TTL': 3600,
+    'MAX_ROOMS': 1000,
+}
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def order_key(entry):
+    """Fixed-width key of a serialized message; sorts in (timestamp, id) order."""
+    micros = (parse_datetime(entry['timestamp']) - EPOCH) // timedelta(microseconds=1)
+    return f'{micros:017d}:{entry["message_id"]:020d}'
+
+
+class LocalRingBuffer:
+    """Recent messages per room in process memory; suitable for one worker.
+
+    Same contract as :class:`RedisRingBuffer`: entries stay in (timestamp,
+    id) order, appends to a cold room are kept aside and merged by the next
+    fill, and a fill loses to an invalidation that happened after its
+    :meth:`version`.
+    """
+
+    def __init__(self, size, max_rooms):
+        self.size = size
+        self.max_rooms = max_rooms
+        # room id -> {order key: entry}, in key order
+        self._rooms = OrderedDict()
+        self._pending = OrderedDict()
+        self._versions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, room_id):
+        with self._lock:
+            entries = self._rooms.get(room_id)
+            if entries is None:
+                return None
+            self._rooms.move_to_end(room_id)
+            return list(entries.values())
+
+    def version(self, room_id):
+        with self._lock:
+            return self._versions.get(room_id, 0)
+
+    def fill(self, room_id, entries, version=0):
+        with self._lock:
+            if room_id in self._rooms or self._versions.get(room_id, 0) != version:
+                return
+            merged = self._pending.pop(room_id, {})
+            merged.update((order_key(entry), entry) for entry in entries)
+            keys = sorted(merged)[-self.size:]
+            self._rooms[room_id] = {key: merged[key] for key in keys}
+            self._trim(self._rooms)
+
+    def append(self, room_id, entry):
+        with self._lock:
+            entries = self._rooms.get(room_id)
+            if entries is None:
+                entries = self._pending.setdefault(room_id, {})
+                self._pending.move_to_end(room_id)
+                self._trim(self._pending)
+            key = order_key(entry)
+            if entries and key < next(reversed(entries)):
+                # Out of order (e.g. another thread's earlier message)
+                entries[key] = entry
+                ordered = sorted(entries.items())[-self.size:]
+                entries.clear()
+                entries.update(ordered)
+            else:
+                entries[key] = entry
+                while len(entries) > self.size:
+                    del entries[next(iter(entries))]
+
+    def invalidate(self, room_id):
+        with self._lock:
+            self._rooms.pop(room_id, None)
+            self._pending.pop(room_id, None)
+            self._versions[room_id] = self._versions.get(room_id, 0) + 1
+            self._versions.move_to_end(room_id)
+            self._trim(self._versions)
+
+    def _trim(self, rooms):
+        while len(rooms) > self.max_rooms:
+            rooms.popitem(last=False)
+
+
+# KEYS: list, pending, version. ARGV: expected version, ttl, size, members.
+# Only fills a cold list nobody invalidated since the caller read the version,
+# and merges appends that arrived meanwhile unless the fill has that message.
+FILL_LUA = r"""
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+if (redis.call('GET', KEYS[3]) or '0') ~= ARGV[1] then
+    return 0
+end
+for i = 4, #ARGV do
+    redis.call('ZADD', KEYS[1], 0, ARGV[i])
+end
+for _, member in ipairs(redis.call('ZRANGE', KEYS[2], 0, -1)) do
+    local prefix = string.sub(member, 1, string.find(member, '\t', 1, true))
+    if #redis.call('ZRANGEBYLEX', KEYS[1], '[' .. prefix, '(' .. prefix .. '\255', 'LIMIT', 0, 1) == 0 then
+        redis.call('ZADD', KEYS[1], 0, member)
+    end
+end
+redis.call('DEL', KEYS[2])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[3]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# KEYS: list, pending. ARGV: ttl, size, member. Cold rooms collect appends
+# in the pending set for the next fill.
+APPEND_LUA = """
+local key = KEYS[1]
+if redis.call('EXISTS', key) == 0 then
+    key = KEYS[2]
+end
+redis.call('ZADD', key, 0, ARGV[3])
+redis.call('ZREMRANGEBYRANK', key, 0, -tonumber(ARGV[2]) - 1)
+redis.call('EXPIRE', key, ARGV[1])
+return 1
+"""
+
+
+class RedisRingBuffer:
+    """Recent messages per room in a capped Redis list shared by all workers.
+
+    The "list" is a sorted set of ``order_key(entry)``, a tab and the JSON
+    entry, all with score 0, so Redis keeps it in (timestamp, id) order
+    whichever worker appends first. A room that was never loaded (or was invalidated)
+    stays cold until the next read fills it from the database; appends in
+    the meantime wait in a pending set that the fill merges, and a fill
+    started before an invalidation is discarded (see :meth:`version`).
+    """
+
+    def __init__(self, client, size, ttl):
+        self.client = client
+        self.size = size
+        self.ttl = ttl
+        self._fill = client.register_script(FILL_LUA)
+        self._append = client.register_script(APPEND_LUA)
+
+    def _key(self, room_id):
+        return f'chat:recent:z:{room_id}'
+
+    def _keys(self, room_id):
+        key = self._key(room_id)
+        return [key, f'{key}:pending', f'{key}:version']
+
+    def _member(self, entry):
+        return f'{order_key(entry)}\t{json.dumps(entry)}'
+
+    def get(self, room_id):
+        raw = self.client.zrange(self._key(room_id), 0, -1)
+        if not raw:
+            return None
+        return [json.loads(item.split(b'\t', 1)[1]) for item in raw]
+
+    def version(self, room_id):
+        """Read before loading the entries to :meth:`fill` with."""
+        return int(self.client.get(self._keys(room_id)[2]) or 0)
+
+    def fill(self, room_id, entries, version=0):
+        members = [self._member(entry) for entry in entries[-self.size:]]
+        self._fill(keys=self._keys(room_id), args=[version, self.ttl, self.size, *members])
+
+    def append(self, room_id, entry):
+        self._append(keys=self._keys(room_id)[:2], args=[self.ttl, self.size, self._member(entry)])
+
+    def invalidate(self, room_id):
+        key, pending, version = self._keys(room_id)
+        pipe = self.client.pipeline()
+        pipe.delete(key, pending)
+        pipe.incr(version)
+        pipe.expire(version, self.ttl)
+        pipe.execute()
+
+
+def _build_buffer():
+    config = get_config('CHAT_RECENT_MESSAGES', DEFAULTS)
+    backend = config['BACKEND']
+    if backend == 'auto':
+        cache = caches['default']
+        backend = 'cache' if cache.__class__.__module__ == 'django.core.cache.backends.redis' else 'local'
+    if backend == 'cache':
+        return RedisRingBuffer(redis_client(), config['SIZE'], config['TTL'])
+    return LocalRingBuffer(config['SIZE'], config['MAX_ROOMS'])
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                _buffer = _build_buffer()
+    return _buffer
+
+
+async def append_async(room_id, entry):
+    """Append from async code without blocking the event loop on Redis."""
+    buffer = get_buffer()
+    if isinstance(buffer, RedisRingBuffer):
+        await sync_to_async(buffer.append, thread_sensitive=False)(room_id, entry)
+    else:
+        buffer.append(room_id, entry)
@@ -0,0 +1,179 @@
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from . import archive, history, uploads
+from .conf import get_config
+from .models import ArchiveSegment, Message, ReadReceipt, Room, TypingStatus
+from .serializers import serialize_message
+
+DEFAULTS = dict(
+    archive.DEFAULTS,
+    # Per room (overridable in ROOMS); None keeps messages in the table forever
+    ARCHIVE_AFTER_DAYS=90,
+    PURGE_DELETED_AFTER_DAYS=7,
+    # Global
+    RECEIPTS_AFTER_DAYS=30,
+    TYPING_AFTER_SECONDS=300,
+    BATCH_SIZE=1000,
+    INTERVAL=3600,
+    # room name -> {ARCHIVE_AFTER_DAYS, PURGE_DELETED_AFTER_DAYS}
+    ROOMS={},
+)
+
+ROOM_POLICY = ('ARCHIVE_AFTER_DAYS', 'PURGE_DELETED_AFTER_DAYS')
+
+
+def get_settings():
+    return get_config('CHAT_RETENTION', DEFAULTS)
+
+
+def room_policy(room_name, config=None):
+    config = config or get_settings()
+    policy = {key: config[key] for key in ROOM_POLICY}
+    policy.update(config['ROOMS'].get(room_name, {}))
+    return policy
+
+
+def purge_in_batches(queryset, batch_size):
+    """Delete ``queryset`` ``batch_size`` rows per statement so no single
+    transaction holds locks on a large part of the table."""
+    total = 0
+    while True:
+        ids = list(queryset.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return total
+        queryset.model.objects.filter(pk__in=ids).delete()
+        total += len(ids)
+
+
+def archive_cutoff(room, days, now):
+    """Messages of ``room`` older than this are archived.
+
+    Stops short of the oldest message that still has replies in the table,
+    so archived messages stay older than everything left behind (which
+    ``chatapp.history`` relies on) and no hot reply loses its parent or
+    thread root.
+    """
+    cutoff = now - timedelta(days=days)
+    pinned = (
+        Message.objects.filter(room=room, timestamp__lt=cutoff)
+        .filter(Q(replies__timestamp__gte=cutoff) | Q(thread_messages__timestamp__gte=cutoff))
+        .order_by('timestamp').values_list('timestamp', flat=True).first()
+    )
+    return min(cutoff, pinned) if pinned is not None else cutoff
+
+
+def archive_room(room, days, now, batch_size):
+    """Move ``room``'s messages older than ``days`` into archive segments.
+
+    Works newest first, so replies leave the table before the messages they
+    answer. Each batch writes one segment per month, then records the
+    segments and deletes the rows in one transaction; a failed transaction
+    removes the files it wrote. Returns the number of messages archived.
+    """
+    candidates = Message.objects.filter(room=room, timestamp__lt=archive_cutoff(room, days, now))
+    total = 0
+    while True:
+        ids = list(candidates.order_by('-timestamp', '-id').values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return total
+        months = defaultdict(list)
+        for message in history.message_queryset().filter(pk__in=ids).order_by('timestamp', 'id'):
+            # The stored name too, so exports can restore the file field
+            months[message.timestamp.strftime('%Y-%m')].append(
+                dict(serialize_message(message), file=message.file.name or None)
+            )
+        segments = [archive.write_segment(room.id, month, entries) for month, entries in months.items()]
+        try:
+            with transaction.atomic():
+                ArchiveSegment.objects.bulk_create(segments)
+                Message.objects.filter(pk__in=ids).delete()
+        except Exception:
+            for segment in segments:
+                archive.delete_file(segment.path)
+            raise
+        total += len(ids)
+
+
+def month_end(month):
+    year, number = map(int, month.split('-'))
+    year, number = (year + 1, 1) if number == 12 else (year, number + 1)
+    return datetime(year, number, 1, tzinfo=dt_timezone.utc)
+
+
+def compact_room(room, cutoff):
+    """Merge the segments of each month that can no longer grow into one file.
+
+    A month is complete once it ends before ``cutoff``. Returns the number
+    of segments replaced.
+    """
+    split = (
+        ArchiveSegment.objects.filter(room=room).values('month')
+        .annotate(segments=Count('id')).filter(segments__gt=1)
+    )
+    replaced = 0
+    for row in split:
+        if month_end(row['month']) > cutoff:
+            continue
+        old = list(ArchiveSegment.objects.filter(room=room, month=row['month']))
+        entries = sorted(
+            (entry for segment in old for entry in archive.read_segment(segment)), key=archive.entry_key
+        )
+        merged = archive.write_segment(room.id, row['month'], entries)
+        try:
+            with transaction.atomic():
+                # post_delete removes the old files once this commits
+                ArchiveSegment.objects.filter(pk__in=[segment.pk for segment in old]).delete()
+                merged.save()
+        except Exception:
+            archive.delete_file(merged.path)
+            raise
+        replaced += len(old)
+    return replaced
+
+
+def run(room_names=None, now=None):
+    """Apply the retention policy once and return counts of what was done.
+
+    Limited to ``room_names`` when given, in which case the table-wide
+    typing and receipt purges are skipped.
+    """
+    config = get_settings()
+    now = now or timezone.now()
+    batch_size = config['BATCH_SIZE']
+    report = defaultdict(int)
+    rooms = Room.objects.all()
+    if room_names:
+        rooms = rooms.filter(name__in=room_names)
+    for room in rooms.iterator():
+        policy = room_policy(room.name, config)
+        if policy['ARCHIVE_AFTER_DAYS'] is not None:
+            report['archived'] += archive_room(room, policy['ARCHIVE_AFTER_DAYS'], now, batch_size)
+            report['compacted'] += compact_room(room, now - timedelta(days=policy['ARCHIVE_AFTER_DAYS']))
+        if policy['PURGE_DELETED_AFTER_DAYS'] is not None:
+            deleted_before = now - timedelta(days=policy['PURGE_DELETED_AFTER_DAYS'])
+            report['purged_deleted'] += purge_in_batches(
+                # Tombstones that replies point at stay, or the replies would lose their parent
+                Message.objects.filter(
+                    room=room, is_deleted=True, replies__isnull=True, thread_messages__isnull=True
+                ).filter(
+                    Q(edited_at__lt=deleted_before) | Q(edited_at__isnull=True, timestamp__lt=deleted_before)
+                ),
+                batch_size,
+            )
+    if room_names is None:
+        report['purged_typing'] = purge_in_batches(
+            TypingStatus.objects.filter(timestamp__lt=now - timedelta(seconds=config['TYPING_AFTER_SECONDS'])),
+            batch_size,
+        )
+        report['purged_receipts'] = purge_in_batches(
+            ReadReceipt.objects.filter(timestamp__lt=now - timedelta(days=config['RECEIPTS_AFTER_DAYS'])),
+            batch_size,
+        )
+        for name, count in uploads.recover_stale(now=now).items():
+            report[f'uploads_{name}'] = count
+    return dict(report)
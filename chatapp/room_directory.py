@@ -0,0 +1,222 @@
+import asyncio
+import logging
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import BigIntegerField, Count, F, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce, Greatest
+
+from . import metrics
+from .conf import get_config
+from .models import ArchiveSegment, Message, ReadCursor, RoomStats
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'FLUSH_INTERVAL': 1.0,
+    'PAGE_SIZE': 50,
+    'MAX_PAGE_SIZE': 200,
+    'CACHE_TTL': 10,
+}
+
+PREVIEW_LENGTH = 100
+
+
+def get_settings():
+    return get_config('CHAT_ROOM_DIRECTORY', DEFAULTS)
+
+
+def ensure_stats(room):
+    RoomStats.objects.get_or_create(room=room, defaults={'last_activity': room.created_at})
+
+
+@transaction.atomic
+def apply_activity(activity):
+    """Fold ``{room_id: (new messages, last id, preview, timestamp)}`` into RoomStats.
+
+    Counts are added with ``F()`` so workers flushing at the same time don't
+    lose increments; the last-message fields only move forward. Runs in one
+    transaction so a failed batch can be retried without double counting.
+    """
+    for room_id, (count, message_id, preview, timestamp) in activity.items():
+        stats = RoomStats.objects.filter(room_id=room_id)
+        if not stats.update(message_count=F('message_count') + count):
+            _, created = RoomStats.objects.get_or_create(room_id=room_id, defaults={'message_count': count})
+            if not created:
+                stats.update(message_count=F('message_count') + count)
+        stats.filter(Q(last_message_id__isnull=True) | Q(last_message_id__lt=message_id)).update(
+            last_message_id=message_id,
+            last_message_preview=preview[:PREVIEW_LENGTH],
+            last_activity=timestamp,
+        )
+
+
+def members_changed(room_id, delta):
+    stats = RoomStats.objects.filter(room_id=room_id)
+    if not stats.update(member_count=F('member_count') + delta):
+        RoomStats.objects.get_or_create(room_id=room_id, defaults={'member_count': max(delta, 0)})
+
+
+def rebuild_stats(room):
+    """Recount ``room``'s stats from scratch, after rows were added in bulk."""
+    last = Message.objects.filter(room=room).order_by('-timestamp', '-id').only('id', 'content', 'timestamp').first()
+    archived = ArchiveSegment.objects.filter(room=room).aggregate(total=Sum('message_count'))['total'] or 0
+    RoomStats.objects.update_or_create(room=room, defaults={
+        'member_count': room.members.count(),
+        'message_count': Message.objects.filter(room=room).count() + archived,
+        'last_message_id': last.id if last else None,
+        'last_message_preview': last.content[:PREVIEW_LENGTH] if last else '',
+        'last_activity': last.timestamp if last else room.created_at,
+    })
+
+
+def refresh_read_counts(cursor_keys):
+    """Recompute ``read_count`` for the ``(room_id, user_id)`` cursors just written.
+
+    One UPDATE for the whole batch: each cursor counts only the messages
+    after it, through the room/timestamp index, so the cost follows how far
+    behind the readers are rather than the size of their rooms.
+    """
+    if not cursor_keys:
+        return
+    query = Q()
+    for room_id, user_id in cursor_keys:
+        query |= Q(room_id=room_id, user_id=user_id)
+    anchor = Message.objects.filter(pk=OuterRef(OuterRef('last_read_message_id'))).values('timestamp')[:1]
+    newer = (
+        Message.objects.filter(
+            room_id=OuterRef('room_id'),
+            timestamp__gte=Subquery(anchor),
+            id__gt=OuterRef('last_read_message_id'),
+        )
+        .order_by().values('room_id').annotate(total=Count('*')).values('total')
+    )
+    total = RoomStats.objects.filter(room_id=OuterRef('room_id')).values('message_count')[:1]
+    ReadCursor.objects.filter(query).update(read_count=Greatest(
+        Coalesce(Subquery(total), 0) - Coalesce(Subquery(newer), 0), 0, output_field=BigIntegerField()
+    ))
+
+
+def page_size(limit):
+    config = get_settings()
+    if limit in (None, ''):
+        return config['PAGE_SIZE']
+    return max(1, min(int(limit), config['MAX_PAGE_SIZE']))
+
+
+def _cache_key(page, limit):
+    return f'chat:directory:{page}:{limit}'
+
+
+def directory_page(page=1, limit=None):
+    """One page of rooms by most recent activity, shared by every user.
+
+    Cached for ``CACHE_TTL`` seconds, so a busy lobby costs one query per
+    page per TTL. Returns ``(rooms, has_more)``.
+    """
+    limit = page_size(limit)
+    page = max(1, int(page or 1))
+    key = _cache_key(page, limit)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    offset = (page - 1) * limit
+    rows = list(
+        RoomStats.objects.select_related('room')
+        .order_by('-last_activity', '-room_id')[offset:offset + limit + 1]
+    )
+    rooms = [
+        {
+            'room_id': stats.room_id,
+            'name': stats.room.name,
+            'member_count': stats.member_count,
+            'message_count': stats.message_count,
+            'last_activity': stats.last_activity.isoformat(),
+            'last_message_preview': stats.last_message_preview,
+        }
+        for stats in rows[:limit]
+    ]
+    result = (rooms, len(rows) > limit)
+    cache.set(key, result, get_settings()['CACHE_TTL'])
+    return result
+
+
+def with_unread(rooms, user):
+    """Copies of directory ``rooms`` with ``unread`` for ``user``.
+
+    Two indexed lookups for the whole page: the user's read cursors and
+    memberships. Rooms the user hasn't joined get ``None``.
+    """
+    room_ids = [room['room_id'] for room in rooms]
+    read = dict(
+        ReadCursor.objects.filter(user=user, room_id__in=room_ids).values_list('room_id', 'read_count')
+    )
+    joined = set(user.rooms.filter(id__in=room_ids).values_list('id', flat=True))
+    return [
+        dict(room, unread=max(0, room['message_count'] - read.get(room['room_id'], 0)))
+        if room['room_id'] in joined or room['room_id'] in read else dict(room, unread=None)
+        for room in rooms
+    ]
+
+
+class ActivityBuffer:
+    """Collects new messages per room and folds them into RoomStats once per interval.
+
+    A busy room costs one pair of UPDATEs per flush however many messages
+    were posted, instead of a write per message.
+    """
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        # room_id -> [count, last message id, preview, timestamp]
+        self.pending = {}
+        self._task = None
+        self._loop = None
+
+    def record(self, room_id, message_id, content, timestamp):
+        current = self.pending.get(room_id)
+        if current is None:
+            self.pending[room_id] = [1, message_id, content, timestamp]
+        else:
+            current[0] += 1
+            if message_id > current[1]:
+                current[1:] = [message_id, content, timestamp]
+        self._ensure_running()
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while self.pending:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        batch, self.pending = self.pending, {}
+        if not batch:
+            return
+        try:
+            await metrics.db_call(apply_activity)({room_id: tuple(values) for room_id, values in batch.items()})
+        except Exception:
+            logger.exception('Failed to update room stats for %d rooms', len(batch))
+            # Retried next interval, merged with whatever arrived meanwhile
+            for room_id, values in batch.items():
+                current = self.pending.get(room_id)
+                if current is None:
+                    self.pending[room_id] = values
+                else:
+                    current[0] += values[0]
+                    if values[1] > current[1]:
+                        current[1:] = values[1:]
+
+
+def record_now(message):
+    """Synchronous counterpart of ``activity.record`` for messages created
+    outside the consumer (uploads)."""
+    apply_activity({message.room_id: (1, message.id, message.content, message.timestamp)})
+
+
+activity = ActivityBuffer(get_settings()['FLUSH_INTERVAL'])
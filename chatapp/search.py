@@ -0,0 +1,215 @@
+import heapq
+import math
+import re
+import threading
+from array import array
+from collections import OrderedDict
+
+from django.db import connection
+from django.db.models import BooleanField, FloatField
+from django.db.models.expressions import RawSQL
+
+from .conf import get_config
+from .history import message_queryset
+from .models import Message
+from .serializers import serialize_message
+
+DEFAULTS = {
+    'BACKEND': 'auto',
+    'PAGE_SIZE': 20,
+    'MAX_PAGE_SIZE': 100,
+    'MAX_ROOMS': 100,
+}
+
+# Text search configuration baked into the generated tsvector column
+# (migration 0008); changing it needs a new migration
+SEARCH_CONFIG = 'english'
+
+TOKEN_RE = re.compile(r'\w+')
+STOPWORDS = frozenset(
+    'a an and are as at be but by for from has have i in is it its of on or that the this to was were will with you'
+    .split()
+)
+
+
+def tokenize(text):
+    return [token for token in TOKEN_RE.findall(text.lower()) if len(token) > 1 and token not in STOPWORDS]
+
+
+def page_size(limit):
+    config = get_config('CHAT_SEARCH', DEFAULTS)
+    if limit in (None, ''):
+        return config['PAGE_SIZE']
+    return max(1, min(int(limit), config['MAX_PAGE_SIZE']))
+
+
+class RoomIndex:
+    """Inverted index of one room: term -> ids of messages containing it.
+
+    Postings are append-only arrays; edits append the new terms and remember
+    the message's current term set, deletes leave a tombstone, and both are
+    checked when a posting is read.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.current_terms = {}
+        self.deleted = set()
+        self.size = 0
+
+    def add(self, message_id, text):
+        for term in set(tokenize(text)):
+            self.postings.setdefault(term, array('q')).append(message_id)
+        self.size += 1
+
+    def update(self, message_id, text):
+        terms = set(tokenize(text))
+        self.current_terms[message_id] = terms
+        for term in terms:
+            self.postings.setdefault(term, array('q')).append(message_id)
+
+    def remove(self, message_id):
+        self.deleted.add(message_id)
+
+    def search(self, terms, count):
+        """Top ``count`` ``(score, message_id)`` pairs, best first.
+
+        Messages matching any term are scored by the summed IDF of the terms
+        they contain, so rarer and more terms rank higher; ties go to the
+        newer message.
+        """
+        scores = {}
+        for term in set(terms):
+            ids = self.postings.get(term)
+            if not ids:
+                continue
+            idf = math.log(1 + self.size / len(ids))
+            for message_id in set(ids):
+                if message_id in self.deleted:
+                    continue
+                current = self.current_terms.get(message_id)
+                if current is not None and term not in current:
+                    continue
+                scores[message_id] = scores.get(message_id, 0) + idf
+        return heapq.nlargest(count, ((score, message_id) for message_id, score in scores.items()))
+
+
+class MemoryIndex:
+    """Per-process inverted indexes for the fallback backend.
+
+    A room is indexed from the database the first time it is searched and
+    kept current from then on through :func:`message_saved` /
+    :func:`message_deleted`; at most ``max_rooms`` rooms are kept. Changes
+    made by other processes are not seen, so this suits single-process
+    development on SQLite.
+    """
+
+    def __init__(self, max_rooms):
+        self.max_rooms = max_rooms
+        self.rooms = OrderedDict()
+        self._lock = threading.Lock()
+
+    def build(self, room_id):
+        index = RoomIndex()
+        rows = Message.objects.filter(room_id=room_id, is_deleted=False).values_list('id', 'content')
+        for message_id, content in rows.iterator(chunk_size=5000):
+            index.add(message_id, content)
+        return index
+
+    def get(self, room_id):
+        with self._lock:
+            index = self.rooms.get(room_id)
+            if index is not None:
+                self.rooms.move_to_end(room_id)
+                return index
+        index = self.build(room_id)
+        with self._lock:
+            index = self.rooms.setdefault(room_id, index)
+            while len(self.rooms) > self.max_rooms:
+                self.rooms.popitem(last=False)
+        return index
+
+    def search(self, room_id, terms, count):
+        index = self.get(room_id)
+        with self._lock:
+            return index.search(terms, count)
+
+    def apply(self, room_id, change, *args):
+        with self._lock:
+            index = self.rooms.get(room_id)
+            if index is not None:
+                getattr(index, change)(*args)
+
+
+def backend():
+    configured = get_config('CHAT_SEARCH', DEFAULTS)['BACKEND']
+    if configured == 'auto':
+        return 'postgres' if connection.vendor == 'postgresql' else 'memory'
+    return configured
+
+
+_index = MemoryIndex(get_config('CHAT_SEARCH', DEFAULTS)['MAX_ROOMS'])
+
+
+def message_saved(message, created):
+    if backend() != 'memory':
+        # The tsvector column is generated by the database
+        return
+    if created:
+        _index.apply(message.room_id, 'add', message.id, message.content)
+    elif message.is_deleted:
+        _index.apply(message.room_id, 'remove', message.id)
+    else:
+        _index.apply(message.room_id, 'update', message.id, message.content)
+
+
+def message_deleted(message):
+    if backend() == 'memory':
+        _index.apply(message.room_id, 'remove', message.id)
+
+
+def index_messages(messages):
+    """Index messages inserted without ``save()`` (write-behind batches)."""
+    for message in messages:
+        message_saved(message, created=True)
+
+
+def _postgres_ranked(room_id, terms, count):
+    query = ' | '.join(terms)
+    table = Message._meta.db_table
+    ranked = Message.objects.filter(room_id=room_id, is_deleted=False).annotate(
+        matched=RawSQL(
+            f'{table}.search_vector @@ to_tsquery(%s::regconfig, %s)', [SEARCH_CONFIG, query],
+            output_field=BooleanField(),
+        ),
+        rank=RawSQL(
+            f'ts_rank({table}.search_vector, to_tsquery(%s::regconfig, %s))', [SEARCH_CONFIG, query],
+            output_field=FloatField(),
+        ),
+    ).filter(matched=True).order_by('-rank', '-id')
+    return [(rank, message_id) for message_id, rank in ranked.values_list('id', 'rank')[:count]]
+
+
+def search(room_id, text, offset=0, limit=None):
+    """Ranked search of one room. Returns ``(results, has_more)`` where each
+    result is a serialized message with its ``rank``."""
+    limit = page_size(limit)
+    offset = max(0, int(offset or 0))
+    terms = tokenize(text)
+    if not terms:
+        return [], False
+    count = offset + limit + 1
+    if backend() == 'postgres':
+        ranked = _postgres_ranked(room_id, terms, count)
+    else:
+        ranked = _index.search(room_id, terms, count)
+    page = ranked[offset:offset + limit]
+    # Ids are already scoped to the room; filtering on room_id again would
+    # steer SQLite onto the room index instead of the primary key
+    messages = message_queryset().in_bulk([message_id for _, message_id in page])
+    results = [
+        dict(serialize_message(messages[message_id]), rank=round(rank, 4))
+        for rank, message_id in page
+        if message_id in messages
+    ]
+    return results, len(ranked) > offset + limit
@@ -0,0 +1,76 @@
+import os
+
+from . import thumbnails
+
+
+def file_url(message):
+    if not message.file:
+        return None
+    if message.file.name.startswith(('/', 'http://', 'https://')):
+        # Messages sent over the socket store the URL returned by upload_file
+        return message.file.name
+    return message.file.url
+
+
+def file_name(message):
+    return os.path.basename(message.file.name) if message.file else None
+
+
+def parent_preview(parent):
+    if parent is None or parent.is_deleted:
+        return None
+    return parent.content[:50]
+
+
+def serialize_message(message):
+    """Serialize a Message in the same shape as the ``chat_message`` event.
+
+    Expects ``user`` and ``parent_message`` to be selected and ``reaction_counts``
+    prefetched, as :func:`chatapp.history.history_queryset` does.
+    """
+    return {
+        'message_id': message.id,
+        'message': '' if message.is_deleted else message.content,
+        'username': message.user.username,
+        'user_id': message.user_id,
+        'parent_id': message.parent_message_id,
+        'parent_preview': parent_preview(message.parent_message) if message.parent_message_id else None,
+        'file_url': file_url(message),
+        'file_name': file_name(message),
+        'thumbnails': thumbnails.urls(message.thumbnails) if message.thumbnails else {},
+        'timestamp': message.timestamp.isoformat(),
+        'edited_at': message.edited_at.isoformat() if message.edited_at else None,
+        'is_deleted': message.is_deleted,
+        'reactions': {row.emoji: row.count for row in message.reaction_counts.all()},
+        'thread_root_id': message.thread_root_id,
+        'reply_count': message.reply_count,
+        'last_reply_at': message.last_reply_at.isoformat() if message.last_reply_at else None,
+    }
+
+
+def serialize_new_message(message):
+    """Serialize a message that was just created, without touching the database.
+
+    ``user`` must already be set on the instance; the parent preview is only
+    included when the parent instance is loaded.
+    """
+    parent_field = message._meta.get_field('parent_message')
+    parent = parent_field.get_cached_value(message) if parent_field.is_cached(message) else None
+    return {
+        'message_id': message.id,
+        'message': message.content,
+        'username': message.user.username,
+        'user_id': message.user_id,
+        'parent_id': message.parent_message_id,
+        'parent_preview': parent_preview(parent),
+        'file_url': file_url(message),
+        'file_name': file_name(message),
+        'thumbnails': thumbnails.urls(message.thumbnails) if message.thumbnails else {},
+        'timestamp': message.timestamp.isoformat(),
+        'edited_at': None,
+        'is_deleted': False,
+        'reactions': {},
+        'thread_root_id': message.thread_root_id,
+        'reply_count': 0,
+        'last_reply_at': None,
+    }
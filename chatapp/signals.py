@@ -0,0 +1,105 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from . import archive, identity_cache, room_directory, search, threads
+from .models import ArchiveSegment, Message, Room, UserProfile
+from .recent_messages import get_buffer as recent_messages
+from .serializers import serialize_new_message
+
+
+@receiver([post_save, post_delete], sender=Room)
+def invalidate_room(sender, instance, **kwargs):
+    identity_cache.rooms.invalidate_pk(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=get_user_model())
+def invalidate_user(sender, instance, **kwargs):
+    identity_cache.users.invalidate_pk(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=UserProfile)
+def invalidate_avatar(sender, instance, **kwargs):
+    identity_cache.avatars.invalidate(instance.user_id)
+
+
+@receiver(m2m_changed, sender=Room.members.through)
+def update_membership_cache(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_clear':
+        identity_cache.memberships.clear()
+    elif action in ('post_add', 'post_remove') and pk_set:
+        keys = [(pk, instance.pk) if reverse else (instance.pk, pk) for pk in pk_set]
+        for key in keys:
+            if action == 'post_add':
+                identity_cache.memberships.set(key, True)
+            else:
+                identity_cache.memberships.invalidate(key)
+
+
+@receiver(post_save, sender=Message)
+def update_recent_messages(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        if instance.thread_root_id is None:
+            entry = serialize_new_message(instance)
+            transaction.on_commit(lambda: recent_messages().append(instance.room_id, entry))
+    else:
+        # Edits and soft deletes change an entry in place; reload on next read
+        threads.parents.invalidate(instance.pk)
+        transaction.on_commit(lambda: recent_messages().invalidate(instance.room_id))
+
+
+@receiver(post_delete, sender=Message)
+def invalidate_recent_messages(sender, instance, **kwargs):
+    transaction.on_commit(lambda: recent_messages().invalidate(instance.room_id))
+
+
+@receiver(post_save, sender=Message)
+def update_search_index(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        transaction.on_commit(lambda: search.message_saved(instance, created))
+
+
+@receiver(post_delete, sender=Message)
+def remove_from_search_index(sender, instance, **kwargs):
+    transaction.on_commit(lambda: search.message_deleted(instance))
+
+
+@receiver(post_save, sender=Room)
+def create_room_stats(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        room_directory.ensure_stats(instance)
+
+
+@receiver(m2m_changed, sender=Room.members.through)
+def update_member_count(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # pk_set is not provided for clear(); count what is about to go
+        if reverse:
+            instance._cleared_room_ids = list(instance.rooms.values_list('id', flat=True))
+        else:
+            instance._cleared_member_count = instance.members.count()
+        return
+    if action == 'post_clear':
+        if reverse:
+            for room_id in getattr(instance, '_cleared_room_ids', ()):
+                room_directory.members_changed(room_id, -1)
+        else:
+            room_directory.members_changed(instance.pk, -getattr(instance, '_cleared_member_count', 0))
+        return
+    if action not in ('post_add', 'post_remove') or not pk_set:
+        return
+    delta = 1 if action == 'post_add' else -1
+    if reverse:
+        # user.rooms.add(...): pk_set holds room ids
+        for room_id in pk_set:
+            room_directory.members_changed(room_id, delta)
+    else:
+        room_directory.members_changed(instance.pk, delta * len(pk_set))
+
+
+@receiver(post_delete, sender=ArchiveSegment)
+def delete_archive_file(sender, instance, **kwargs):
+    transaction.on_commit(lambda: archive.delete_file(instance.path))
@@ -1,22 +1,57 @@
 // Chat Application
+
+// Short wire keys used by the binary protocol; mirrors chatapp/protocol.py
+const FIELD_KEYS = {
+    type: 't', message: 'm', message_id: 'i', message_ids: 'is', messages: 'ms',
+    username: 'u', user_id: 'ui', parent_id: 'p', parent_preview: 'pp',
+    file_url: 'f', file_name: 'fn', thumbnails: 'th', avatars: 'av', timestamp: 'ts', edited_at: 'e',
+    is_deleted: 'd', reactions: 'r', reply_count: 'rc', thread_root_id: 'tr', last_reply_at: 'lr', emoji: 'em',
+    typing: 'ty', stopped: 'st', ttl: 'tl', cursors: 'c', online: 'on',
+    offline: 'of', complete: 'co', last_message_id: 'l', frame: 'fr', scope: 'sc',
+    retry_after: 'ra', source: 'so'
+};
+const SHORT_KEYS = Object.fromEntries(Object.entries(FIELD_KEYS).map(([field, key]) => [key, field]));
+
+function remapKeys(value, keys) {
+    if (Array.isArray(value)) {
+        return value.map(item => remapKeys(item, keys));
+    }
+    if (value && typeof value === 'object') {
+        return Object.fromEntries(Object.entries(value).map(([key, item]) => [keys[key] || key, remapKeys(item, keys)]));
+    }
+    return value;
+}
+
 const ChatApp = {
     roomName: null,
     username: null,
     chatLog: null,
     chatSocket: null,
     typingTimeout: null,
+    typingRenderTimeout: null,
+    lastTypingSent: 0,
+    typingUsers: new Map(),
+    reconnectAttempts: 0,
+    heartbeatInterval: null,
     replyingToMessage: null,
     editingMessage: null,
     userStatuses: new Map(),
+    wsTicket: null,
+    wsTicketExpires: 0,
+    threadRootId: null,
 
-    init: function(roomName, username) {
+    init: function(roomName, username, ticket, ticketTtl) {
         this.roomName = roomName;
         this.username = username;
+        this.setTicket(ticket, ticketTtl);
         this.chatLog = document.querySelector('#chat-log');
         this.typingTimeout = null;
+        this.lastTypingSent = 0;
+        this.typingUsers = new Map();
         this.replyingToMessage = null;
         this.editingMessage = null;
         this.userStatuses = new Map();
+        this.threadRootId = null;
         
         this.initWebSocket();
         this.initEventListeners();
@@ -26,11 +61,36 @@ const ChatApp = {
 
     initWebSocket: function() {
         const wsStart = window.location.protocol === 'https:' ? 'wss://' : 'ws://';
+        // On reconnect, ask the server to replay whatever was missed since the
+        // last message on screen
+        const params = new URLSearchParams();
+        const lastMessageId = this.getLastMessageId();
+        if (lastMessageId) {
+            params.set('last_message_id', lastMessageId);
+        }
+        // A fresh ticket lets the server skip the session lookup; without one
+        // the handshake falls back to the session cookie
+        if (this.wsTicket && Date.now() < this.wsTicketExpires) {
+            params.set('ticket', this.wsTicket);
+        }
+        const query = params.toString() ? '?' + params.toString() : '';
+        // Prefer the compact MessagePack protocol when the library is loaded
+        const protocols = window.MessagePack ? ['chat.msgpack.v1', 'chat.json.v1'] : ['chat.json.v1'];
         this.chatSocket = new WebSocket(
-            wsStart + window.location.host + '/ws/chat/' + this.roomName + '/'
+            wsStart + window.location.host + '/ws/chat/' + this.roomName + '/' + query,
+            protocols
         );
-
-        this.chatSocket.onopen = () => console.log('WebSocket connection established');
+        this.chatSocket.binaryType = 'arraybuffer';
+
+        this.chatSocket.onopen = () => {
+            this.reconnectAttempts = 0;
+            console.log('WebSocket connection established');
+            // Keeps this connection counted as online by the presence tracker
+            clearInterval(this.heartbeatInterval);
+            this.heartbeatInterval = setInterval(() => {
+                this.sendFrame({ type: 'heartbeat' });
+            }, 20000);
+        };
         this.chatSocket.onerror = (e) => console.error('WebSocket error:', e);
         this.chatSocket.onmessage = this.handleWebSocketMessage.bind(this);
         this.chatSocket.onclose = this.handleWebSocketClose.bind(this);
@@ -45,9 +105,16 @@ const ChatApp = {
         document.querySelector('#chat-message-submit').onclick = this.handleMessageSubmit.bind(this);
         document.querySelector('#file-upload').addEventListener('change', this.handleFileUpload.bind(this));
         document.querySelector('.theme-toggle').onclick = this.toggleTheme.bind(this);
+        document.querySelector('#thread-close').onclick = this.closeThread.bind(this);
 
         // Add event delegation for message actions
         document.querySelector('#chat-log').addEventListener('click', (e) => {
+            const reaction = e.target.closest('.reaction');
+            if (reaction) {
+                // Clicking an existing reaction toggles our own
+                this.addReaction(reaction.closest('.message').dataset.messageId, reaction.dataset.emoji);
+                return;
+            }
             const button = e.target.closest('.action-button');
             if (!button) return;
             
@@ -59,12 +126,15 @@ const ChatApp = {
                 case 'react': this.showReactionPicker(messageId); break;
                 case 'edit': this.editMessage(messageId); break;
                 case 'delete': this.deleteMessage(messageId); break;
+                case 'thread': this.openThread(messageId); break;
             }
         });
 
-        document.querySelectorAll('.message').forEach(message => {
-            this.sendReadReceipt(message.dataset.messageId);
-        });
+        const messageIds = Array.from(document.querySelectorAll('.message'))
+            .map(message => Number(message.dataset.messageId));
+        if (messageIds.length > 0) {
+            this.chatSocket.addEventListener('open', () => this.sendReadReceipt(Math.max(...messageIds)));
+        }
     },
 
     loadTheme: function() {
@@ -83,24 +153,46 @@ const ChatApp = {
         }
     },
 
+    sendFrame: function(data) {
+        if (this.chatSocket.protocol === 'chat.msgpack.v1') {
+            this.chatSocket.send(MessagePack.encode(remapKeys(data, FIELD_KEYS)));
+        } else {
+            this.chatSocket.send(JSON.stringify(data));
+        }
+    },
+
+    decodeFrame: function(raw) {
+        if (raw instanceof ArrayBuffer) {
+            return remapKeys(MessagePack.decode(new Uint8Array(raw)), SHORT_KEYS);
+        }
+        return JSON.parse(raw);
+    },
+
     handleWebSocketMessage: function(e) {
-        const data = JSON.parse(e.data);
+        const data = this.decodeFrame(e.data);
         
         switch(data.type) {
             case 'chat_message':
                 this.handleNewMessage(data);
                 break;
+            case 'history_replay':
+                this.handleHistoryReplay(data);
+                break;
             case 'typing_status':
                 this.handleTypingStatus(data);
                 break;
             case 'message_reaction':
                 this.handleMessageReaction(data);
                 break;
+            case 'thread_activity':
+                this.updateThreadSummary(data.message_id, data.reply_count);
+                break;
             case 'read_receipt':
                 this.handleReadReceipt(data);
                 break;
             case 'user_status':
-                this.updateUserStatus(data.user_id, data.status);
+                (data.online || []).forEach(userId => this.updateUserStatus(userId, 'online'));
+                (data.offline || []).forEach(userId => this.updateUserStatus(userId, 'offline'));
                 break;
             case 'message_edit':
                 this.handleMessageEdit(data);
@@ -108,15 +200,67 @@ const ChatApp = {
             case 'message_delete':
                 this.handleMessageDelete(data);
                 break;
+            case 'throttled':
+                console.warn(`Sending ${data.frame} too fast; retry in ${data.retry_after}s`);
+                break;
+            case 'reaction_rejected':
+                console.warn(`Reaction ${data.emoji} to message ${data.message_id} was rejected`);
+                break;
         }
     },
 
     handleWebSocketClose: function(e) {
+        clearInterval(this.heartbeatInterval);
+        if (e.code === 4008) {
+            // Disconnected for falling behind; resume right away from the last
+            // message on screen
+            console.warn('Chat socket fell behind, resuming');
+            this.initWebSocket();
+            return;
+        }
         console.error('Chat socket closed unexpectedly');
+        // Exponential backoff with jitter so a deploy doesn't reconnect every
+        // client at the same instant
+        const delay = Math.min(30000, 1000 * Math.pow(2, this.reconnectAttempts)) * (0.5 + Math.random());
+        this.reconnectAttempts += 1;
         setTimeout(() => {
             console.log('Attempting to reconnect...');
+            this.refreshTicket().then(() => this.initWebSocket());
+        }, delay);
+    },
+
+    setTicket: function(ticket, ttl) {
+        this.wsTicket = ticket || null;
+        // Leave a margin for clock drift and the handshake itself
+        this.wsTicketExpires = Date.now() + Math.max(0, (ttl || 0) - 5) * 1000;
+    },
+
+    refreshTicket: function() {
+        if (this.wsTicket && Date.now() < this.wsTicketExpires) {
+            return Promise.resolve();
+        }
+        return fetch('/chat/api/rooms/' + encodeURIComponent(this.roomName) + '/ticket/')
+            .then(response => response.ok ? response.json() : null)
+            .then(data => {
+                if (data && data.ticket) {
+                    this.setTicket(data.ticket, data.expires_in);
+                }
+            })
+            .catch(() => {});
+    },
+
+    getLastMessageId: function() {
+        const messages = this.chatLog ? this.chatLog.querySelectorAll('.message') : [];
+        return messages.length ? messages[messages.length - 1].dataset.messageId : null;
+    },
+
+    handleHistoryReplay: function(data) {
+        if (!data.complete) {
+            // Too much was missed to replay; fall back to a full reload
             window.location.reload();
-        }, 1000);
+            return;
+        }
+        data.messages.forEach(message => this.handleNewMessage(message));
     },
 
     toggleTheme: function() {
@@ -147,72 +291,149 @@ const ChatApp = {
                 messageData.message_id = this.editingMessage;
             }
 
-            this.chatSocket.send(JSON.stringify(messageData));
+            this.sendFrame(messageData);
             messageInput.value = '';
             fileInput.value = '';
-            this.replyingToMessage = null;
+            // Inside an open thread, further messages keep replying to it
+            this.replyingToMessage = this.threadRootId;
             this.editingMessage = null;
-            messageInput.placeholder = 'Type your message...';
+            messageInput.placeholder = this.threadRootId ? 'Reply in thread...' : 'Type your message...';
         }
     },
 
     handleFileUpload: async function(e) {
         const file = e.target.files[0];
         if (file) {
-            const formData = new FormData();
-            formData.append('file', file);
-            formData.append('room_id', this.roomName);
+            try {
+                await this.uploadInChunks(file);
+            } catch (error) {
+                console.error('Error uploading file:', error);
+            }
+        }
+    },
 
+    uploadInChunks: async function(file) {
+        // Chunks are sent in order with their offset; after a failure we ask the
+        // server how far it got and continue from there. The server announces
+        // the file message over the socket once the upload is stored.
+        const headers = { 'X-CSRFToken': document.querySelector('[name=csrfmiddlewaretoken]').value };
+        const upload = {
+            room: this.roomName,
+            file_name: file.name,
+            size: file.size
+        };
+        if (file.size <= 64 * 1024 * 1024 && window.crypto && crypto.subtle) {
+            const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+            upload.sha256 = Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+        }
+        let response = await fetch('/chat/api/uploads/', {
+            method: 'POST',
+            headers: Object.assign({ 'Content-Type': 'application/json' }, headers),
+            body: JSON.stringify(upload)
+        });
+        let state = await response.json();
+        const url = `/chat/api/uploads/${state.upload_id}/`;
+        let failures = 0;
+        while (state.status === 'uploading') {
+            const chunk = file.slice(state.offset, state.offset + state.chunk_size);
             try {
-                const response = await fetch('/chat/upload/', {
-                    method: 'POST',
-                    body: formData,
-                    headers: {
-                        'X-CSRFToken': document.querySelector('[name=csrfmiddlewaretoken]').value
-                    }
+                response = await fetch(url, {
+                    method: 'PUT',
+                    headers: Object.assign({ 'Upload-Offset': String(state.offset) }, headers),
+                    body: chunk
                 });
-                
-                const data = await response.json();
-                if (data.status === 'success') {
-                    this.chatSocket.send(JSON.stringify({
-                        type: 'message',
-                        message: `Shared a file: ${file.name}`,
-                        username: this.username,
-                        file_url: data.file_url
-                    }));
+                state = await response.json();
+                if (response.status >= 400 && response.status !== 409) {
+                    throw new Error(state.error || response.statusText);
                 }
+                failures = 0;
             } catch (error) {
-                console.error('Error uploading file:', error);
+                failures += 1;
+                if (failures > 5) throw error;
+                await new Promise(resolve => setTimeout(resolve, 1000 * failures));
+                state = await (await fetch(url, { headers: headers })).json();
             }
         }
+        if (state.status === 'failed') {
+            throw new Error('Upload failed');
+        }
     },
 
     sendTypingStatus: function() {
+        // The server keeps typing state alive on its own, so only refresh it
+        // every couple of seconds instead of on every keystroke
         clearTimeout(this.typingTimeout);
-        this.chatSocket.send(JSON.stringify({
-            type: 'typing',
-            username: this.username
-        }));
+        const now = Date.now();
+        if (now - this.lastTypingSent > 2000) {
+            this.lastTypingSent = now;
+            this.sendFrame({
+                type: 'typing',
+                username: this.username
+            });
+        }
         this.typingTimeout = setTimeout(() => {
-            this.chatSocket.send(JSON.stringify({
+            this.lastTypingSent = 0;
+            this.sendFrame({
                 type: 'typing_stopped',
                 username: this.username
-            }));
+            });
         }, 1000);
     },
 
     handleTypingStatus: function(data) {
+        const expires = Date.now() + (data.ttl || 5) * 1000;
+        // A snapshot lists everyone typing on its worker, so anyone it
+        // previously listed and now leaves out has stopped
+        const typing = new Set((data.typing || []).map(user => user.user_id));
+        this.typingUsers.forEach((user, userId) => {
+            if (user.source === data.source && !typing.has(userId)) {
+                this.typingUsers.delete(userId);
+            }
+        });
+        (data.typing || []).forEach(user => {
+            if (user.username !== this.username) {
+                this.typingUsers.set(user.user_id, { username: user.username, expires: expires, source: data.source });
+            }
+        });
+        (data.stopped || []).forEach(userId => this.typingUsers.delete(userId));
+        this.renderTypingIndicator();
+    },
+
+    renderTypingIndicator: function() {
+        const now = Date.now();
+        this.typingUsers.forEach((user, userId) => {
+            if (user.expires <= now) {
+                this.typingUsers.delete(userId);
+            }
+        });
+
+        const names = Array.from(this.typingUsers.values()).map(user => user.username);
         const typingIndicator = document.querySelector('.typing-indicator');
-        if (data.username !== this.username) {
-            typingIndicator.textContent = `${data.username} is typing...`;
-            clearTimeout(window.typingTimeout);
-            window.typingTimeout = setTimeout(() => {
-                typingIndicator.textContent = '';
-            }, 1000);
+        if (names.length === 0) {
+            typingIndicator.textContent = '';
+        } else if (names.length === 1) {
+            typingIndicator.textContent = `${names[0]} is typing...`;
+        } else {
+            typingIndicator.textContent = `${names.join(', ')} are typing...`;
+        }
+
+        clearTimeout(this.typingRenderTimeout);
+        if (names.length > 0) {
+            this.typingRenderTimeout = setTimeout(() => this.renderTypingIndicator(), 1000);
         }
     },
 
     handleNewMessage: function(data) {
+        if (data.thread_root_id) {
+            // Replies are only sent to thread participants and shown in the thread panel
+            if (Number(data.thread_root_id) === this.threadRootId) {
+                this.appendToThread(data);
+            }
+            return;
+        }
+        if (this.chatLog.querySelector(`[data-message-id="${data.message_id}"]`)) {
+            return;
+        }
         const messageDiv = this.createMessageElement(data);
         this.chatLog.appendChild(messageDiv);
         this.scrollToBottom();
@@ -242,7 +463,12 @@ const ChatApp = {
         if (data.file_url) {
             const file = document.createElement('div');
             file.className = 'message-file';
-            file.innerHTML = `
+            const thumbnail = data.thumbnails && data.thumbnails.thumb;
+            file.innerHTML = thumbnail ? `
+                <a href="${data.file_url}" target="_blank">
+                    <img src="${thumbnail}" alt="" class="message-thumbnail" loading="lazy">
+                </a>
+            ` : `
                 <a href="${data.file_url}" target="_blank">
                     <i class="fas fa-file"></i> ${data.file_url.split('/').pop()}
                 </a>
@@ -255,6 +481,14 @@ const ChatApp = {
         div.appendChild(this.createMessageActions(data));
         div.appendChild(document.createElement('div')).className = 'message-reactions';
         div.appendChild(document.createElement('div')).className = 'read-receipts';
+        this.updateReactionCounts(div, data.reactions || {});
+        if (!data.thread_root_id) {
+            const summary = div.appendChild(document.createElement('button'));
+            summary.className = 'action-button thread-summary';
+            summary.dataset.action = 'thread';
+            summary.dataset.messageId = data.message_id;
+            this.setThreadSummary(summary, data.reply_count || 0);
+        }
 
         return div;
     },
@@ -286,6 +520,59 @@ const ChatApp = {
         return actions;
     },
 
+    setThreadSummary: function(summary, count) {
+        summary.hidden = !count;
+        summary.innerHTML = `<i class="fas fa-comments"></i> ${count} ${count === 1 ? 'reply' : 'replies'}`;
+    },
+
+    updateThreadSummary: function(messageId, count) {
+        const summary = this.chatLog.querySelector(`.thread-summary[data-message-id="${messageId}"]`);
+        if (summary) {
+            this.setThreadSummary(summary, count);
+        }
+    },
+
+    openThread: function(messageId) {
+        // The whole thread comes from one request; live replies arrive over
+        // the socket once we follow it
+        const url = '/chat/api/rooms/' + encodeURIComponent(this.roomName) + '/threads/' + messageId + '/';
+        return fetch(url)
+            .then(response => response.json())
+            .then(data => {
+                if (data.status !== 'success') return;
+                if (this.threadRootId && this.threadRootId !== data.thread_root_id) {
+                    this.sendFrame({ type: 'thread_unfollow', message_id: this.threadRootId });
+                }
+                this.threadRootId = data.thread_root_id;
+                this.sendFrame({ type: 'thread_follow', message_id: this.threadRootId });
+                const threadLog = document.querySelector('#thread-log');
+                threadLog.innerHTML = '';
+                data.messages.forEach(message => this.appendToThread(message));
+                document.querySelector('#thread-panel').hidden = false;
+                this.replyToMessage(this.threadRootId);
+            });
+    },
+
+    appendToThread: function(data) {
+        const threadLog = document.querySelector('#thread-log');
+        if (threadLog.querySelector(`[data-message-id="${data.message_id}"]`)) {
+            return;
+        }
+        const messageDiv = this.createMessageElement(data);
+        threadLog.appendChild(messageDiv);
+        threadLog.scrollTop = threadLog.scrollHeight;
+    },
+
+    closeThread: function() {
+        if (this.threadRootId) {
+            this.sendFrame({ type: 'thread_unfollow', message_id: this.threadRootId });
+        }
+        this.threadRootId = null;
+        this.replyingToMessage = null;
+        document.querySelector('#thread-panel').hidden = true;
+        document.querySelector('#chat-message-input').placeholder = 'Type your message...';
+    },
+
     replyToMessage: function(messageId) {
         this.replyingToMessage = messageId;
         const messageElement = document.querySelector(`[data-message-id="${messageId}"]`);
@@ -304,10 +591,10 @@ const ChatApp = {
 
     deleteMessage: function(messageId) {
         if (confirm('Are you sure you want to delete this message?')) {
-            this.chatSocket.send(JSON.stringify({
+            this.sendFrame({
                 type: 'delete_message',
                 message_id: messageId
-            }));
+            });
         }
     },
 
@@ -333,56 +620,70 @@ const ChatApp = {
     },
 
     addReaction: function(messageId, emoji) {
-        this.chatSocket.send(JSON.stringify({
+        // The server toggles: sending an emoji we already reacted with removes it
+        this.sendFrame({
             type: 'reaction',
-            message_id: messageId,
+            message_id: Number(messageId),
             emoji: emoji
-        }));
+        });
+        const message = document.querySelector(`[data-message-id="${messageId}"]`);
+        const reaction = message && message.querySelector(`.reaction[data-emoji="${emoji}"]`);
+        if (reaction) {
+            reaction.classList.toggle('active');
+        }
     },
 
     handleMessageReaction: function(data) {
         const message = document.querySelector(`[data-message-id="${data.message_id}"]`);
         if (message) {
-            const reactions = message.querySelector('.message-reactions');
-            const existingReaction = reactions.querySelector(`[data-emoji="${data.emoji}"]`);
-            
-            if (existingReaction) {
-                const count = parseInt(existingReaction.getAttribute('data-count')) + 1;
-                existingReaction.setAttribute('data-count', count);
-                existingReaction.querySelector('.reaction-count').textContent = count;
-            } else {
-                const reaction = document.createElement('span');
+            this.updateReactionCounts(message, data.reactions);
+        }
+    },
+
+    updateReactionCounts: function(message, counts) {
+        // Counts are absolute per emoji; a count of 0 removes the reaction
+        const reactions = message.querySelector('.message-reactions');
+        Object.entries(counts).forEach(([emoji, count]) => {
+            let reaction = reactions.querySelector(`[data-emoji="${emoji}"]`);
+            if (!count) {
+                if (reaction) reaction.remove();
+                return;
+            }
+            if (!reaction) {
+                reaction = document.createElement('span');
                 reaction.className = 'reaction';
-                reaction.setAttribute('data-emoji', data.emoji);
-                reaction.setAttribute('data-count', '1');
-                reaction.innerHTML = `${data.emoji}<span class="reaction-count">1</span>`;
-                reaction.onclick = () => this.addReaction(data.message_id, data.emoji);
+                reaction.setAttribute('data-emoji', emoji);
+                reaction.innerHTML = `${emoji}<span class="reaction-count"></span>`;
                 reactions.appendChild(reaction);
             }
-        }
+            reaction.setAttribute('data-count', count);
+            reaction.querySelector('.reaction-count').textContent = count;
+        });
     },
 
     sendReadReceipt: function(messageId) {
-        this.chatSocket.send(JSON.stringify({
-            type: 'read_receipt',
-            message_id: messageId
-        }));
+        // Receipts are "read up to" marks, so one frame covers every earlier message
+        this.sendFrame({
+            type: 'read_up_to',
+            message_id: Number(messageId)
+        });
     },
 
     handleReadReceipt: function(data) {
-        const message = document.querySelector(`[data-message-id="${data.message_id}"]`);
-        if (message) {
-            const readReceipts = message.querySelector('.read-receipts');
-            const existingReceipt = readReceipts.querySelector(`[data-user-id="${data.user_id}"]`);
-            if (!existingReceipt) {
+        const messages = Array.from(this.chatLog.querySelectorAll('.message'));
+        (data.cursors || []).forEach(cursor => {
+            messages.forEach(message => {
+                if (Number(message.dataset.messageId) > cursor.message_id) return;
+                const readReceipts = message.querySelector('.read-receipts');
+                if (!readReceipts || readReceipts.querySelector(`[data-user-id="${cursor.user_id}"]`)) return;
                 const receipt = document.createElement('span');
                 receipt.className = 'read-receipt';
-                receipt.setAttribute('data-user-id', data.user_id);
+                receipt.setAttribute('data-user-id', cursor.user_id);
                 receipt.innerHTML = '<i class="fas fa-check"></i>';
-                receipt.title = `Read by ${data.username}`;
+                receipt.title = `Read by ${cursor.username}`;
                 readReceipts.appendChild(receipt);
-            }
-        }
+            });
+        });
     },
 
     updateUserStatus: function(userId, status) {
@@ -1,3 +1,877 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import (
+    archive, consumers, history, identity_cache, layers, metrics, outbound, presence, protocol, rate_limits,
+    read_receipts, recent_messages, retention, room_directory, threads, thumbnails, tickets,
+    transfer, typing_indicators, uploads, write_behind,
+)
+from .management.commands import runworkers
+from .models import Message, MessageReactionCount, ReadCursor, Room, UploadSession, UserProfile
+from .reactions import toggle_reaction
+from .serializers import serialize_message
+
+
+class OutboundQueueTests(SimpleTestCase):
+    async def test_blocked_socket_fills_queue_until_overflow(self):
+        # Stands in for a runworkers send waiting on a full socket buffer
+        resumed = asyncio.Event()
+        written = []
+
+        async def write(payload):
+            await resumed.wait()
+            written.append(payload)
+
+        queue = outbound.OutboundQueue(write, max_queue=5, shed_threshold=3, lag_threshold=2)
+        for number in range(4):
+            self.assertTrue(queue.put('chat_message', f'm{number}', message_id=number))
+        await asyncio.sleep(0)
+        # The first frame is being written; the rest wait in the queue
+        self.assertEqual(len(queue), 3)
+        self.assertTrue(queue.lagging)
+        self.assertTrue(queue.put('typing_status', 'typing', key='typing_status'))
+        self.assertEqual(len(queue), 3)
+        self.assertTrue(queue.put('chat_message', 'm4', message_id=4))
+        self.assertTrue(queue.put('chat_message', 'm5', message_id=5))
+        self.assertFalse(queue.put('chat_message', 'm6', message_id=6))
+
+        resumed.set()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        self.assertEqual(written, ['m0', 'm1', 'm2', 'm3', 'm4', 'm5'])
+        self.assertEqual(queue.last_message_id, 5)
+        self.assertFalse(queue.lagging)
+
+    async def test_newer_equivalent_frame_replaces_queued_one(self):
+        resumed = asyncio.Event()
+        written = []
+
+        async def write(payload):
+            await resumed.wait()
+            written.append(payload)
+
+        queue = outbound.OutboundQueue(write, max_queue=10, shed_threshold=10, lag_threshold=10)
+        queue.put('chat_message', 'm0', message_id=0)
+        await asyncio.sleep(0)
+        event = {'type': 'thread_activity', 'message_id': 7}
+        queue.put('thread_activity', 'a1', outbound.coalesce_key(event))
+        queue.put('thread_activity', 'a2', outbound.coalesce_key(event))
+        resumed.set()
+        for _ in range(5):
+            await asyncio.sleep(0)
+        self.assertEqual(written, ['m0', 'a2'])
+
+    def test_typing_snapshots_coalesce_per_worker(self):
+        first = outbound.coalesce_key({'type': 'typing_status', 'source': 'a'})
+        self.assertEqual(first, outbound.coalesce_key({'type': 'typing_status', 'source': 'a'}))
+        self.assertNotEqual(first, outbound.coalesce_key({'type': 'typing_status', 'source': 'b'}))
+
+    def test_fanout_benchmark_runs(self):
+        output = io.StringIO()
+        call_command('bench_fanout', sizes='3', messages=2, stdout=output)
+        self.assertEqual(json.loads(output.getvalue())['results'][0]['room_size'], 3)
+
+
+class MembershipTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='lobby')
+        self.member = User.objects.create_user('member', password='pw')
+        self.outsider = User.objects.create_user('outsider', password='pw')
+        self.room.members.add(self.member)
+        Message.objects.create(room=self.room, user=self.member, content='hello')
+
+    def tearDown(self):
+        identity_cache.memberships.clear()
+
+    def test_history_requires_membership(self):
+        url = reverse('chatapp:message_history', args=['lobby'])
+        self.client.force_login(self.outsider)
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_login(self.member)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([entry['message'] for entry in response.json()['messages']], ['hello'])
+
+    def test_room_page_does_not_join_outsiders(self):
+        url = reverse('chatapp:room', args=['lobby'])
+        self.client.force_login(self.outsider)
+        response = self.client.get(url)
+        self.assertTemplateUsed(response, 'chatapp/join_room.html')
+        self.assertNotContains(response, 'hello')
+        self.assertFalse(self.room.members.filter(pk=self.outsider.pk).exists())
+        self.assertRedirects(self.client.post(url), url)
+        self.assertTrue(self.room.members.filter(pk=self.outsider.pk).exists())
+        self.assertContains(self.client.get(url), 'hello')
+
+    def test_uploads_require_membership(self):
+        self.client.force_login(self.outsider)
+        response = self.client.post(
+            reverse('chatapp:create_upload'),
+            json.dumps({'room': 'lobby', 'file_name': 'a.txt', 'size': 3}),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 403)
+        response = self.client.post(reverse('chatapp:upload_file'), {
+            'room_id': 'lobby', 'file': SimpleUploadedFile('a.txt', b'abc'),
+        })
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_creating_a_room_joins_it(self):
+        self.client.force_login(self.outsider)
+        response = self.client.get(reverse('chatapp:room', args=['fresh']))
+        self.assertTemplateUsed(response, 'chatapp/room.html')
+        self.assertTrue(Room.objects.get(name='fresh').members.filter(pk=self.outsider.pk).exists())
+
+
+class TicketTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='lobby')
+        self.other = Room.objects.create(name='other')
+        self.member = User.objects.create_user('member')
+        self.outsider = User.objects.create_user('outsider')
+        self.room.members.add(self.member)
+
+    def tearDown(self):
+        identity_cache.memberships.clear()
+        identity_cache.rooms.clear()
+        identity_cache.users.clear()
+
+    def authorize(self, user, room_name, **scope):
+        consumer = consumers.ChatConsumer()
+        consumer.scope, consumer.user, consumer.room_name = scope, user, room_name
+        return async_to_sync(consumer.authorize)()
+
+    def test_tickets_expire_and_reject_tampering(self):
+        ticket = tickets.issue(self.member, self.room)
+        self.assertEqual(tickets.verify(ticket), {'u': self.member.pk, 'n': 'member', 'r': 'lobby'})
+        self.assertIsNone(tickets.verify(ticket[:-1] + ('A' if ticket[-1] != 'A' else 'B')))
+        later = time.time() + tickets.get_settings()['TTL'] + 1
+        with mock.patch('django.core.signing.time.time', return_value=later):
+            self.assertIsNone(tickets.verify(ticket))
+
+    def test_authorize_requires_membership_or_a_ticket_for_the_room(self):
+        self.assertTrue(self.authorize(self.member, 'lobby'))
+        self.assertFalse(self.authorize(self.outsider, 'lobby'))
+        self.assertFalse(self.authorize(self.outsider, 'missing'))
+        self.assertFalse(self.authorize(AnonymousUser(), 'lobby'))
+        # A ticket only vouches for the room it was issued for
+        self.assertTrue(self.authorize(self.outsider, 'other', ticket_room='other'))
+        self.assertFalse(self.authorize(self.outsider, 'lobby', ticket_room='other'))
+
+    def test_ticket_view_is_for_members_only(self):
+        url = reverse('chatapp:ws_ticket', args=['lobby'])
+        self.client.force_login(self.outsider)
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_login(self.member)
+        claims = tickets.verify(self.client.get(url).json()['ticket'])
+        self.assertEqual((claims['u'], claims['r']), (self.member.pk, 'lobby'))
+
+
+class ToggleReactionTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='lobby')
+        self.other_room = Room.objects.create(name='other')
+        self.user = User.objects.create_user('user')
+        self.message = Message.objects.create(room=self.room, user=self.user, content='hi')
+
+    def count(self, emoji):
+        return MessageReactionCount.objects.get(message=self.message, emoji=emoji).count
+
+    def test_toggle_adds_then_removes(self):
+        other = User.objects.create_user('other')
+        self.assertIs(toggle_reaction(self.message.id, self.user, '👍', self.room.id), True)
+        self.assertIs(toggle_reaction(self.message.id, other, '👍', self.room.id), True)
+        self.assertEqual(self.count('👍'), 2)
+        self.assertIs(toggle_reaction(self.message.id, self.user, '👍', self.room.id), False)
+        self.assertEqual(self.count('👍'), 1)
+
+    def test_rejects_message_of_another_room_or_unknown(self):
+        self.assertIsNone(toggle_reaction(self.message.id, self.user, '👍', self.other_room.id))
+        self.assertIsNone(toggle_reaction(self.message.id + 1000, self.user, '👍', self.room.id))
+        self.assertIsNone(toggle_reaction(self.message.id, self.user, 'x' * 51, self.room.id))
+        self.assertFalse(MessageReactionCount.objects.exists())
+
+
+class PreEncodeTests(SimpleTestCase):
+    event = {'type': 'chat_message', 'message_id': 1, 'message': 'hi'}
+
+    def test_encodes_json_and_codecs_in_use_only(self):
+        msgpack_codec = protocol.CODECS['chat.msgpack.v1']
+        message = protocol.pre_encode(self.event, keep=('message_id',))
+        self.assertEqual(set(message['frames']), {'chat.json.v1'})
+        protocol.connection_opened(msgpack_codec)
+        try:
+            message = protocol.pre_encode(self.event)
+        finally:
+            protocol.connection_closed(msgpack_codec)
+        self.assertEqual(set(message['frames']), {'chat.json.v1', 'chat.msgpack.v1'})
+        self.assertNotIn('chat.msgpack.v1', protocol.in_use)
+
+    def test_missing_frame_is_encoded_from_json_once(self):
+        msgpack_codec = protocol.CODECS['chat.msgpack.v1']
+        message = protocol.pre_encode(self.event)
+        payload = protocol.frame_for(message, msgpack_codec)
+        self.assertEqual(msgpack_codec.decode(payload), self.event)
+        self.assertIs(message['frames']['chat.msgpack.v1'], payload)
+
+    def test_negotiate_picks_the_first_supported_subprotocol(self):
+        self.assertEqual(protocol.negotiate(None), (protocol.DEFAULT_CODEC, None))
+        self.assertEqual(protocol.negotiate(['chat.xml.v1']), (protocol.DEFAULT_CODEC, None))
+        codec, subprotocol = protocol.negotiate(['chat.xml.v1', 'chat.msgpack.v1', 'chat.json.v1'])
+        self.assertEqual((codec.subprotocol, subprotocol), ('chat.msgpack.v1', 'chat.msgpack.v1'))
+
+    def test_binary_codecs_round_trip_with_short_keys(self):
+        event = {
+            'type': 'read_receipt',
+            'cursors': [{'user_id': 1, 'username': 'alice', 'message_id': 2 ** 52}],
+            'extra': {'emoji': '👍'},
+        }
+        for codec in (protocol.MsgpackCodec(), protocol.CBORCodec()):
+            if codec.subprotocol not in protocol.CODECS:
+                continue
+            with self.subTest(codec=codec.subprotocol):
+                payload = codec.encode(event)
+                self.assertIsInstance(payload, bytes)
+                self.assertNotIn(b'username', payload)
+                self.assertEqual(codec.decode(payload), event)
+
+
+class UploadChunkTests(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        settings = override_settings(CHAT_UPLOADS={'TEMP_DIR': self.temp_dir.name, 'CHUNK_SIZE': 4})
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(self.temp_dir.cleanup)
+        self.user = User.objects.create_user('uploader')
+        self.session = UploadSession.objects.create(
+            room=Room.objects.create(name='lobby'), user=self.user, file_name='a.txt', size=6
+        )
+
+    def test_chunks_append_at_the_expected_offset(self):
+        self.assertEqual(uploads.append_chunk(self.session, 0, io.BytesIO(b'abcd'), 4), 4)
+        with self.assertRaises(uploads.UploadError) as raised:
+            uploads.append_chunk(self.session, 0, io.BytesIO(b'abcd'), 4)
+        self.assertEqual(raised.exception.status, 409)
+        self.assertEqual(uploads.append_chunk(self.session, 4, io.BytesIO(b'ef'), 2), 6)
+        self.session.refresh_from_db()
+        self.assertEqual((self.session.received, self.session.status), (6, 'processing'))
+        with open(uploads.part_path(self.session), 'rb') as part:
+            self.assertEqual(part.read(), b'abcdef')
+
+    def test_short_chunk_releases_the_claim(self):
+        with self.assertRaises(uploads.UploadError):
+            uploads.append_chunk(self.session, 0, io.BytesIO(b'ab'), 4)
+        self.session.refresh_from_db()
+        self.assertEqual((self.session.received, self.session.status), (0, 'uploading'))
+        self.assertEqual(uploads.append_chunk(self.session, 0, io.BytesIO(b'abcd'), 4), 4)
+
+    def test_recover_stale_sessions(self):
+        later = timezone.now() + timedelta(seconds=uploads.get_settings()['STALE_AFTER'] + 1)
+        UploadSession.objects.filter(pk=self.session.pk).update(status='receiving')
+        self.assertEqual(uploads.recover_stale(now=later)['released'], 1)
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.status, 'uploading')
+
+        UploadSession.objects.filter(pk=self.session.pk).update(status='processing', updated_at=timezone.now())
+        with mock.patch.object(uploads, 'schedule_finalize') as schedule:
+            with open(uploads.part_path(self.session), 'wb'):
+                pass
+            self.assertEqual(uploads.recover_stale(now=later)['retried'], 1)
+            schedule.assert_called_once()
+            os.remove(uploads.part_path(self.session))
+            later += timedelta(seconds=uploads.get_settings()['STALE_AFTER'] + 1)
+            self.assertEqual(uploads.recover_stale(now=later)['failed'], 1)
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.status, 'failed')
+
+
+class ThreadTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='lobby')
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.root = Message.objects.create(room=self.room, user=self.alice, content='root')
+        cache.clear()
+
+    def test_participants_follow_and_unfollow(self):
+        participants = async_to_sync(threads.participants)
+        self.assertEqual(participants(self.room.id, self.root.id), {self.alice.id})
+        self.assertEqual(participants(self.room.id, self.root.id, joining=self.bob.id), {self.alice.id, self.bob.id})
+        cache.clear()
+        self.assertEqual(participants(self.room.id, self.root.id), {self.alice.id, self.bob.id})
+        async_to_sync(threads.unfollow)(self.room.id, self.root.id, self.alice.id)
+        self.assertEqual(participants(self.room.id, self.root.id), {self.bob.id})
+
+    def test_archived_thread_is_read_from_the_archive(self):
+        old = timezone.now() - timedelta(days=30)
+        reply = Message.objects.create(
+            room=self.room, user=self.bob, content='reply', parent_message=self.root, timestamp=old
+        )
+        Message.objects.filter(pk=self.root.pk).update(timestamp=old - timedelta(minutes=1), last_reply_at=old)
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            self.assertEqual(retention.archive_room(self.room, 7, timezone.now(), 100), 2)
+            threads.parents.clear()
+            root_id, messages, has_more = history.load_thread(self.room.id, reply.id)
+        self.assertEqual(root_id, self.root.id)
+        self.assertEqual([message['message_id'] for message in messages], [self.root.id, reply.id])
+        self.assertFalse(has_more)
+
+
+class ReadCountTests(TestCase):
+    def test_read_counts_are_refreshed_in_one_query(self):
+        room = Room.objects.create(name='lobby')
+        other = Room.objects.create(name='other')
+        alice = User.objects.create_user('alice')
+        bob = User.objects.create_user('bob')
+        messages = [Message.objects.create(room=room, user=alice, content=str(n)) for n in range(5)]
+        room_directory.rebuild_stats(room)
+        room_directory.rebuild_stats(other)
+        ReadCursor.objects.create(room=room, user=alice, last_read_message_id=messages[1].id)
+        ReadCursor.objects.create(room=room, user=bob, last_read_message_id=messages[4].id)
+        ReadCursor.objects.create(room=other, user=alice, last_read_message_id=0)
+        with self.assertNumQueries(1):
+            room_directory.refresh_read_counts([(room.id, alice.id), (room.id, bob.id), (other.id, alice.id)])
+        counts = dict(ReadCursor.objects.filter(room=room).values_list('user_id', 'read_count'))
+        self.assertEqual(counts, {alice.id: 2, bob.id: 5})
+        self.assertEqual(ReadCursor.objects.get(room=other).read_count, 0)
+
+
+class ActivityBufferTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='lobby')
+        self.user = User.objects.create_user('alice')
+
+    def test_failed_flush_is_requeued(self):
+        buffer = room_directory.ActivityBuffer(flush_interval=60)
+        now = timezone.now()
+
+        async def run():
+            buffer.record(self.room.id, 1, 'one', now)
+            buffer._task.cancel()
+            with mock.patch.object(room_directory, 'apply_activity', side_effect=DatabaseError):
+                await buffer.flush()
+            buffer.record(self.room.id, 2, 'two', now)
+            buffer._task.cancel()
+
+        with self.assertLogs('chatapp.room_directory', 'ERROR'):
+            async_to_sync(run)()
+        self.assertEqual(buffer.pending[self.room.id], [2, 2, 'two', now])
+
+    def test_thread_flush_failure_is_requeued(self):
+        buffer = threads.ThreadActivity(flush_interval=60, cache_ttl=60)
+        layer = mock.Mock(group_send=mock.AsyncMock())
+        now = timezone.now()
+
+        async def run():
+            buffer.record(layer, 'chat_lobby', 7, now)
+            buffer._task.cancel()
+            with mock.patch.object(threads, 'apply_replies', side_effect=DatabaseError):
+                await buffer.flush(layer)
+            buffer.record(layer, 'chat_lobby', 7, now)
+            buffer._task.cancel()
+
+        with self.assertLogs('chatapp.threads', 'ERROR'):
+            async_to_sync(run)()
+        self.assertEqual(buffer.pending[('chat_lobby', 7)], [2, now])
+        layer.group_send.assert_not_called()
+
+    def test_legacy_upload_counts_as_activity(self):
+        self.room.members.add(self.user)
+        room_directory.rebuild_stats(self.room)
+        self.client.force_login(self.user)
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            response = self.client.post(reverse('chatapp:upload_file'), {
+                'room_id': 'lobby', 'file': SimpleUploadedFile('a.txt', b'abc'),
+            })
+        stats = self.room.stats
+        stats.refresh_from_db()
+        self.assertEqual((stats.message_count, stats.last_message_id), (1, response.json()['message_id']))
+
+
+class ReadCursorBufferTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='lobby')
+        self.user = User.objects.create_user('alice')
+        self.layer = mock.Mock(group_send=mock.AsyncMock())
+        self.buffer = read_receipts.ReadCursorBuffer(flush_interval=60)
+
+    def flush(self, *message_ids):
+        async def run():
+            for message_id in message_ids:
+                self.buffer.mark(self.layer, 'chat_lobby', self.room.id, self.user.id, 'alice', message_id)
+            await self.buffer.flush(self.layer)
+            self.buffer._task.cancel()
+        async_to_sync(run)()
+
+    def test_failed_store_is_requeued_and_not_broadcast(self):
+        with mock.patch.object(read_receipts, 'upsert_cursors', autospec=True, side_effect=DatabaseError):
+            with self.assertLogs('chatapp.read_receipts', 'ERROR'):
+                self.flush(5)
+        self.layer.group_send.assert_not_called()
+        self.assertEqual(self.buffer.pending[(self.room.id, self.user.id)][0], 5)
+
+    def test_only_stored_cursors_are_broadcast(self):
+        first, second, third = [
+            Message.objects.create(room=self.room, user=self.user, content=str(n)).id for n in range(3)
+        ]
+        ReadCursor.objects.create(room=self.room, user=self.user, last_read_message_id=second)
+        self.flush(first)
+        self.layer.group_send.assert_not_called()
+        self.assertEqual(ReadCursor.objects.get().last_read_message_id, second)
+        self.flush(third)
+        self.layer.group_send.assert_called_once()
+        self.assertEqual(ReadCursor.objects.get().last_read_message_id, third)
+
+    def test_cursors_are_clamped_to_the_newest_message(self):
+        self.flush(10 ** 15)
+        self.layer.group_send.assert_not_called()
+        self.assertFalse(ReadCursor.objects.exists())
+        latest = Message.objects.create(room=self.room, user=self.user, content='hi').id
+        self.flush(10 ** 15)
+        self.assertEqual(ReadCursor.objects.get().last_read_message_id, latest)
+        self.layer.group_send.assert_called_once()
+
+    def test_frames_with_bad_ids_are_dropped(self):
+        consumer = consumers.ChatConsumer()
+        consumer.channel_layer, consumer.room_group_name, consumer.user = self.layer, 'chat_lobby', self.user
+        consumer.get_room = mock.AsyncMock(return_value=self.room)
+        with mock.patch.object(read_receipts.buffer, 'mark') as mark:
+            for data in ({'message_id': 'x'}, {'message_id': None}, {'message_ids': '12'}, {'message_ids': [-1, 1e400]}):
+                async_to_sync(consumer.handle_frame)('read_up_to', data)
+            mark.assert_not_called()
+            async_to_sync(consumer.handle_frame)('read_up_to', {'message_ids': ['bad', '4', 7]})
+            self.assertEqual(mark.call_args.args[-1], 7)
+        for message_type in ('reaction', 'thread_follow'):
+            async_to_sync(consumer.handle_frame)(message_type, {'message_id': 'x', 'emoji': '👍'})
+        self.assertEqual(
+            [consumers.parse_message_id(value) for value in ('12', 12.0, True, 0, 2 ** 63, [1])],
+            [12, 12, None, None, None, None],
+        )
+
+
+@override_settings(CHAT_WORKER_ID='1')
+class MessageIdTests(TestCase):
+    def test_ids_stay_allocated_after_write_behind_is_turned_off(self):
+        room = Room.objects.create(name='lobby')
+        user = User.objects.create_user('alice')
+        with override_settings(CHAT_WRITE_BEHIND={'ENABLED': True}):
+            first = Message.objects.create(room=room, user=user, content='a')
+        with mock.patch('chatapp.models._allocated_ids', None):
+            second = Message.objects.create(room=room, user=user, content='b')
+        self.assertGreater(second.id, first.id)
+
+
+class ArchiveExportTests(TestCase):
+    def test_archived_file_is_exported_as_stored_name(self):
+        room = Room.objects.create(name='lobby')
+        user = User.objects.create_user('alice')
+        Message.objects.create(
+            room=room, user=user, content='a', file='chat_files/a b.png', timestamp=timezone.now() - timedelta(days=30)
+        )
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            retention.archive_room(room, 7, timezone.now(), 100)
+            records = [json.loads(line) for line in transfer.export_room(room)]
+        self.assertEqual([record['file'] for record in records if record['type'] == 'message'], ['chat_files/a b.png'])
+
+    def test_stored_name_is_recovered_from_older_segments(self):
+        entry = {'file_url': settings.MEDIA_URL + 'chat_files/a%20b.png'}
+        self.assertEqual(archive.stored_file(entry), 'chat_files/a b.png')
+        self.assertEqual(archive.stored_file({'file_url': 'https://cdn.example/a.png'}), 'https://cdn.example/a.png')
+
+
+class LRUCacheTests(SimpleTestCase):
+    def test_invalidate_pk_drops_every_key_of_the_instance(self):
+        lru = identity_cache.LRUCache(maxsize=2, ttl=60)
+        alice, bob = User(pk=1, username='alice'), User(pk=2, username='bob')
+        lru.set('alice', alice)
+        lru.set('alice@example.com', alice)
+        lru.invalidate_pk(1)
+        self.assertIsNone(lru.get('alice'))
+        self.assertIsNone(lru.get('alice@example.com'))
+        lru.set('alice', alice)
+        lru.set('bob', bob)
+        lru.set('carol', True)
+        self.assertEqual(lru._pks, {2: {'bob'}})
+        lru.invalidate_pk(2)
+        self.assertEqual((lru.get('bob'), lru.get('carol')), (None, True))
+
+
+class HistoryPagingTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='lobby')
+        self.user = User.objects.create_user('alice')
+        self.buffer = recent_messages.LocalRingBuffer(size=3, max_rooms=10)
+        patcher = mock.patch.object(history, 'get_buffer', return_value=self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, count, timestamp=None):
+        timestamp = timestamp or timezone.now()
+        return [
+            Message.objects.create(room=self.room, user=self.user, content=str(n), timestamp=timestamp).id
+            for n in range(count)
+        ]
+
+    def ids(self, page):
+        return [entry['message_id'] for entry in page]
+
+    def test_keyset_pages_split_equal_timestamps_by_id(self):
+        ids = self.post(5)
+        messages, has_more = history.fetch_page(self.room.id, limit=2)
+        self.assertEqual(([message.id for message in messages], has_more), (ids[3:], True))
+        before = history.encode_cursor(serialize_message(messages[0]))
+        messages, has_more = history.fetch_page(self.room.id, before=before, limit=2)
+        self.assertEqual(([message.id for message in messages], has_more), (ids[1:3], True))
+        before = history.encode_cursor(serialize_message(messages[0]))
+        messages, has_more = history.fetch_page(self.room.id, before=before, limit=2)
+        self.assertEqual(([message.id for message in messages], has_more), (ids[:1], False))
+
+    def test_buffer_answers_only_pages_it_holds(self):
+        ids = self.post(5)
+        page, has_more = history.load_page(self.room.id, limit=2)
+        self.assertEqual((self.ids(page), has_more), (ids[3:], True))
+        self.assertEqual(self.ids(self.buffer.get(self.room.id)), ids[2:])
+        # One entry left in the buffer before the cursor: still served from it
+        page, has_more = history.load_page(self.room.id, before=history.encode_cursor(page[0]), limit=1)
+        self.assertEqual((self.ids(page), has_more), (ids[2:3], True))
+        # Older than the buffer reaches: falls through to the table
+        page, has_more = history.load_page(self.room.id, before=history.encode_cursor(page[0]), limit=5)
+        self.assertEqual((self.ids(page), has_more), (ids[:2], False))
+
+    def test_pages_continue_across_the_archive_boundary(self):
+        archived = self.post(3, timezone.now() - timedelta(days=30))
+        live = self.post(2)
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            retention.archive_room(self.room, 7, timezone.now(), 100)
+            page, has_more = history.load_page(self.room.id, before=history.encode_cursor(
+                serialize_message(Message.objects.get(pk=live[0]))
+            ), limit=2)
+            self.assertEqual((self.ids(page), has_more), (archived[1:], True))
+            page, has_more = history.load_page(self.room.id, before=history.encode_cursor(page[0]), limit=2)
+            self.assertEqual((self.ids(page), has_more), (archived[:1], False))
+            page, has_more = history.load_page(self.room.id, after=history.encode_cursor(page[0]), limit=3)
+            self.assertEqual((self.ids(page), has_more), (archived[1:] + live[:1], True))
+
+    @override_settings(CHAT_HISTORY={'MAX_REPLAY': 2})
+    def test_resume_replays_missed_messages(self):
+        ids = self.post(5)
+        # Still in the ring buffer, then only in the table
+        self.assertEqual(self.ids(history.load_after_message(self.room.id, ids[3])[0]), ids[4:])
+        messages, complete = history.load_after_message(self.room.id, ids[1])
+        self.assertEqual((self.ids(messages), complete), (ids[2:4], False))
+        messages, complete = history.load_after_message(self.room.id, ids[0])
+        self.assertEqual((self.ids(messages), complete), (ids[1:3], False))
+        self.assertEqual(history.load_after_message(self.room.id, 10 ** 12), ([], False))
+
+    def test_replayed_messages_are_not_delivered_twice(self):
+        ids = self.post(3)
+        consumer = consumers.ChatConsumer()
+        consumer.replayed_ids = set()
+        consumer.get_room = mock.AsyncMock(return_value=self.room)
+        consumer.send_event = mock.AsyncMock()
+        async_to_sync(consumer.replay_since)(str(ids[0]))
+        replay = consumer.send_event.call_args.args[0]
+        self.assertEqual((replay['type'], self.ids(replay['messages'])), ('history_replay', ids[1:]))
+        # The group broadcast of a replayed message arrives after the replay
+        for message_id in (ids[1], ids[2], ids[2]):
+            async_to_sync(consumer.chat_message)({'type': 'chat_message', 'message_id': message_id})
+        self.assertEqual(consumer.send_event.call_count, 2)
+        self.assertEqual(consumer.send_event.call_args.args[0]['message_id'], ids[2])
+
+
+class RateLimitTests(SimpleTestCase):
+    def test_room_rejection_does_not_spend_the_user_token(self):
+        limiter = rate_limits.RateLimiter(
+            rate_limits.LocalBuckets(), {'message': {'user': (0.001, 2), 'room': (0.001, 1)}}
+        )
+        self.assertIsNone(limiter.check('message', 1, 'lobby'))
+        scope, retry_after = limiter.check('message', 1, 'lobby')
+        self.assertEqual(scope, 'room')
+        self.assertGreater(retry_after, 0)
+        self.assertIsNone(limiter.check('message', 1, 'other'))
+        self.assertEqual(limiter.check('message', 1, 'third')[0], 'user')
+
+
+class PresenceTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.tracker = presence.PresenceTracker(60, 60, 60, 60)
+        self.layer = mock.Mock()
+
+    async def test_offline_is_per_room_until_the_last_connection_closes(self):
+        await self.tracker.connect(self.layer, 'chat_a', 'a1', 1)
+        await self.tracker.connect(self.layer, 'chat_b', 'b1', 1)
+        await self.tracker.connect(self.layer, 'chat_b', 'b2', 1)
+        self.tracker._task.cancel()
+        self.assertEqual(self.tracker.pending, {'chat_a': {1: 'online'}, 'chat_b': {1: 'online'}})
+        self.tracker.pending.clear()
+
+        await self.tracker.disconnect('a1')
+        self.assertEqual(self.tracker.pending, {'chat_a': {1: 'offline'}})
+        self.assertEqual(self.tracker.db_pending, {1: True})
+        await self.tracker.disconnect('b1')
+        self.assertNotIn('chat_b', self.tracker.pending)
+        await self.tracker.disconnect('b2')
+        self.assertEqual(self.tracker.pending['chat_b'], {1: 'offline'})
+        self.assertEqual(self.tracker.db_pending, {1: False})
+
+
+class TypingTrackerTests(SimpleTestCase):
+    def setUp(self):
+        self.tracker = typing_indicators.TypingTracker(interval=60, ttl=4)
+        self.layer = mock.Mock()
+        self.now = 100.0
+        clock = mock.patch.object(typing_indicators.time, 'monotonic', side_effect=lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def tearDown(self):
+        for task in self.tracker._tasks.values():
+            task.cancel()
+
+    async def test_frames_coalesce_into_one_event_per_interval(self):
+        for _ in range(5):
+            self.tracker.start(self.layer, 'chat_a', 1, 'alice')
+        self.tracker.start(self.layer, 'chat_a', 2, 'bob')
+        self.tracker.stop(self.layer, 'chat_a', 2)
+        event = self.tracker.collect('chat_a')
+        self.assertEqual(event['typing'], [{'user_id': 1, 'username': 'alice'}])
+        self.assertEqual(event['stopped'], [2])
+        self.assertEqual(event['source'], self.tracker.source)
+        self.tracker.start(self.layer, 'chat_a', 1, 'alice')
+        self.assertIsNone(self.tracker.collect('chat_a'))
+
+    async def test_idle_typists_expire_and_ongoing_ones_are_refreshed(self):
+        self.tracker.start(self.layer, 'chat_a', 1, 'alice')
+        self.tracker.start(self.layer, 'chat_a', 2, 'bob')
+        self.tracker.collect('chat_a')
+        self.now += 2
+        self.tracker.start(self.layer, 'chat_a', 1, 'alice')
+        self.assertEqual(len(self.tracker.collect('chat_a')['typing']), 2)
+        self.now += 2
+        event = self.tracker.collect('chat_a')
+        self.assertEqual(event['typing'], [{'user_id': 1, 'username': 'alice'}])
+        self.assertEqual(event['stopped'], [2])
+
+
+class ReadCursorTests(TestCase):
+    def test_cursors_only_move_forward(self):
+        room = Room.objects.create(name='lobby')
+        alice = User.objects.create_user('alice')
+        bob = User.objects.create_user('bob')
+        read_receipts.upsert_cursors({(room.id, alice.id): 10})
+        stored = read_receipts.upsert_cursors({(room.id, alice.id): 5, (room.id, bob.id): 7})
+        self.assertEqual(stored, {(room.id, alice.id): 10, (room.id, bob.id): 7})
+        self.assertEqual(read_receipts.upsert_cursors({(room.id, alice.id): 11})[(room.id, alice.id)], 11)
+
+
+class WriteBehindRecoveryTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name='lobby')
+        self.user = User.objects.create_user('alice')
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.directory = temp_dir.name
+
+    def crash_with(self, rows):
+        # A previous process that journaled rows and died before flushing them
+        journal = write_behind.MessageJournal(self.directory)
+        for row in rows:
+            journal.append(row)
+        journal.rotate()
+        os.close(journal._lock_fd)
+
+    def row(self, message_id, **extra):
+        return dict({
+            'id': message_id, 'room_id': self.room.id, 'user_id': self.user.id,
+            'content': f'message {message_id}', 'timestamp': timezone.now().isoformat(),
+        }, **extra)
+
+    def test_journaled_rows_are_replayed_once(self):
+        root, reply = self.row(1 << 41), self.row((1 << 41) + 1)
+        reply.update(parent_message_id=root['id'], thread_root_id=root['id'])
+        # The reply was journaled first; replay still inserts its parent first
+        self.crash_with([reply, root])
+        buffer = write_behind.WriteBehindBuffer(10, 60, journal=write_behind.MessageJournal(self.directory))
+        self.assertEqual(buffer.recover(), 2)
+        self.assertEqual(Message.objects.get(pk=reply['id']).parent_message_id, root['id'])
+        self.assertEqual(buffer.journal.orphaned_segments(), [])
+        self.assertEqual(buffer.pending, [])
+
+    def test_rows_already_stored_are_not_duplicated(self):
+        row = self.row(1 << 41)
+        write_behind.write_rows([row])
+        # Crashed between the commit and removing the segment
+        self.crash_with([row])
+        buffer = write_behind.WriteBehindBuffer(10, 60, journal=write_behind.MessageJournal(self.directory))
+        self.assertEqual(buffer.recover(), 0)
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 1)
+        self.assertEqual(buffer.journal.orphaned_segments(), [])
+
+
+class ImportTests(TestCase):
+    def test_export_imports_into_a_second_room_of_the_same_database(self):
+        room = Room.objects.create(name='lobby')
+        alice = User.objects.create_user('alice')
+        bob = User.objects.create_user('bob')
+        root = Message.objects.create(room=room, user=alice, content='root')
+        reply = Message.objects.create(room=room, user=bob, content='reply', parent_message=root)
+        toggle_reaction(root.id, bob, '👍', room.id)
+        ReadCursor.objects.create(room=room, user=bob, last_read_message_id=reply.id)
+        lines = list(transfer.export_room(room))
+
+        counts = transfer.Importer('copy').run(lines)
+        self.assertEqual((counts['message'], counts['reaction'], counts['cursor']), (2, 1, 1))
+        copy = Room.objects.get(name='copy')
+        new_root, new_reply = Message.objects.filter(room=copy).order_by('id')
+        self.assertNotIn(new_root.id, (root.id, reply.id))
+        self.assertEqual((new_reply.parent_message_id, new_reply.thread_root_id), (new_root.id, new_root.id))
+        self.assertEqual(list(new_root.reactions.values_list('user__username', 'emoji')), [('bob', '👍')])
+        self.assertEqual(MessageReactionCount.objects.get(message=new_root).count, 1)
+        self.assertEqual(ReadCursor.objects.get(room=copy).last_read_message_id, new_reply.id)
+        # The original room is untouched
+        self.assertEqual(MessageReactionCount.objects.get(message=root).count, 1)
+        self.assertEqual(list(Message.objects.filter(room=room).values_list('id', flat=True)), [root.id, reply.id])
+
+    def test_skip_existing_only_skips_the_rooms_own_messages(self):
+        room = Room.objects.create(name='lobby')
+        message = Message.objects.create(room=room, user=User.objects.create_user('alice'), content='a')
+        lines = list(transfer.export_room(room))
+        transfer.Importer('lobby', skip_existing=True).run(lines)
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [message.id])
+
+
+class AvatarUploadTests(TestCase):
+    def test_thumbnails_are_scheduled_after_the_new_avatar_is_saved(self):
+        user = User.objects.create_user('alice')
+        UserProfile.objects.create(user=user, avatar_thumbnails={'small': 'avatars/old.webp'})
+        self.client.force_login(user)
+        seen = []
+
+        def schedule(profile_id):
+            seen.append(UserProfile.objects.filter(pk=profile_id).values_list('avatar', 'avatar_thumbnails').get())
+
+        avatar = SimpleUploadedFile('new.png', b'png', content_type='image/png')
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            with mock.patch.object(thumbnails, 'schedule_avatar', side_effect=schedule):
+                with self.captureOnCommitCallbacks(execute=True):
+                    response = self.client.post(reverse('chatapp:profile'), {'avatar': avatar})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(seen), 1)
+        self.assertTrue(seen[0][0].startswith('avatars/new'))
+        self.assertEqual(seen[0][1], {})
+
+
+class MetricsViewTests(TestCase):
+    def test_without_a_token_only_staff_may_scrape(self):
+        with override_settings(CHAT_METRICS={'TOKEN': None}):
+            self.assertEqual(self.client.get(reverse('chatapp:metrics')).status_code, 403)
+            self.client.force_login(User.objects.create_user('alice'))
+            self.assertEqual(self.client.get(reverse('chatapp:metrics')).status_code, 403)
+            self.client.force_login(User.objects.create_user('admin', is_staff=True))
+            self.assertEqual(self.client.get(reverse('chatapp:metrics')).status_code, 200)
+
+    def test_token_is_required_when_configured(self):
+        with override_settings(CHAT_METRICS={'TOKEN': 'secret'}):
+            self.assertEqual(self.client.get(reverse('chatapp:metrics')).status_code, 403)
+            response = self.client.get(reverse('chatapp:metrics'), HTTP_AUTHORIZATION='Bearer wrong')
+            self.assertEqual(response.status_code, 403)
+            response = self.client.get(reverse('chatapp:metrics'), HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, 200)
+
+    def test_exposition_aggregates_rooms(self):
+        metrics.connection_opened('private-room')
+        metrics.connection_opened('private-room')
+        metrics.connection_opened('other-room')
+        try:
+            output = metrics.render()
+        finally:
+            for room in ('private-room', 'private-room', 'other-room'):
+                metrics.connection_closed(room)
+        self.assertNotIn('private-room', output)
+        self.assertIn('# TYPE chat_connections gauge', output)
+        self.assertIn('chat_rooms_active 2', output)
+        self.assertIn('chat_room_connections_max 2', output)
+        self.assertIn('chat_rooms_active 0', metrics.render())
+
+
+class RoomRoutingTests(SimpleTestCase):
+    def test_room_is_read_from_room_paths_only(self):
+        self.assertEqual(runworkers.room_of(b'GET /ws/chat/lobby/?last_message_id=1 HTTP/1.1\r\n'), b'lobby')
+        self.assertEqual(runworkers.room_of(b'GET /chat/lobby/ HTTP/1.1\r\n'), b'lobby')
+        self.assertEqual(runworkers.room_of(b'GET /chat/api/rooms/lobby/messages/?before=x HTTP/1.1\r\n'), b'lobby')
+        for path in (b'/chat/api/rooms/?page=2', b'/chat/api/uploads/', b'/chat/upload/', b'/chat/profile/',
+                     b'/chat/metrics/', b'/chat/', b'/static/js/chat.js'):
+            self.assertIsNone(runworkers.room_of(b'GET ' + path + b' HTTP/1.1\r\n'), path)
+
+    def test_requests_without_a_room_are_spread_round_robin(self):
+        supervisor = runworkers.Supervisor([], 3, '127.0.0.1', 0, True, io.StringIO())
+        for worker in supervisor.workers:
+            worker.alive = mock.Mock(return_value=True)
+            worker.hand_over = mock.Mock(return_value=True)
+        selector = mock.Mock()
+        for _ in range(3):
+            supervisor.dispatch(mock.Mock(), selector, None)
+        self.assertEqual([worker.hand_over.call_count for worker in supervisor.workers], [1, 1, 1])
+        for _ in range(2):
+            supervisor.dispatch(mock.Mock(), selector, b'lobby')
+        owner = supervisor.workers[runworkers.room_worker(b'lobby', 3)]
+        self.assertEqual(owner.hand_over.call_count, 3)
+
+
+class LocalFanoutLayerTests(SimpleTestCase):
+    def setUp(self):
+        self.layer = layers.LocalFanoutChannelLayer()
+
+    async def local_channel(self):
+        channel = await self.layer.new_channel()
+        # Present while a consumer is receiving on the channel
+        return channel, self.layer.receive_buffer[channel]
+
+    async def test_send_to_a_local_channel_skips_redis(self):
+        channel, buffer = await self.local_channel()
+        message = {'type': 'chat_message', 'message_id': 1}
+        with mock.patch.object(self.layer, 'connection') as connection:
+            await self.layer.send(channel, message)
+        connection.assert_not_called()
+        delivered = buffer.get_nowait()
+        self.assertEqual(delivered, message)
+        self.assertIsNot(delivered, message)
+
+    async def test_group_send_splits_local_and_remote_members(self):
+        channel, buffer = await self.local_channel()
+        remote = 'specific.other!abc'
+        pipe = mock.Mock(execute=mock.AsyncMock(return_value=[0, [channel.encode(), remote.encode()]]))
+        with mock.patch.object(self.layer, 'connection', return_value=mock.Mock(pipeline=lambda: pipe)), \
+                mock.patch.object(self.layer, '_send_remote', new_callable=mock.AsyncMock) as send_remote:
+            await self.layer.group_send('chat_lobby', {'type': 'chat_message'})
+        self.assertEqual(buffer.get_nowait(), {'type': 'chat_message'})
+        send_remote.assert_awaited_once_with('chat_lobby', [remote], {'type': 'chat_message'})
+
+    async def test_delivery_from_another_thread_runs_on_the_receiving_loop(self):
+        channel, buffer = await self.local_channel()
+        self.layer.receive_event_loop = asyncio.get_running_loop()
+        self.layer._local_wakeup = wakeup = asyncio.Event()
+        await asyncio.to_thread(asyncio.run, self.layer.send(channel, {'type': 'chat_message'}))
+        await asyncio.wait_for(wakeup.wait(), 1)
+        self.assertEqual(buffer.get_nowait(), {'type': 'chat_message'})
@@ -0,0 +1,254 @@
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, Max, OuterRef, Q, Subquery
+
+from . import metrics
+from .conf import get_config
+from .identity_cache import LRUCache
+from .models import Message, ThreadFollow
+from .protocol import group_send, pre_encode
+from .serializers import parent_preview
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'FLUSH_INTERVAL': 1.0,
+    'CACHE_TTL': 3600,
+    'PARENT_MAXSIZE': 100000,
+    'PAGE_SIZE': 100,
+    'MAX_PAGE_SIZE': 500,
+}
+
+
+def get_settings():
+    return get_config('CHAT_THREADS', DEFAULTS)
+
+
+def _counts_key(root_id):
+    return f'chat:thread:{root_id}'
+
+
+def _participants_key(root_id):
+    return f'chat:thread:{root_id}:participants'
+
+
+def user_group(room_group, user_id):
+    """Group of one user's connections to a room; thread replies go here."""
+    return f'{room_group}_user_{user_id}'
+
+
+_config = get_settings()
+# message id -> (room_id, thread_root_id, preview), so replying to a recent
+# message needs no lookup and a queued (write-behind) parent can be found at all
+parents = LRUCache(_config['PARENT_MAXSIZE'], _config['CACHE_TTL'])
+
+
+def remember(message):
+    parents.set(message.id, (message.room_id, message.thread_root_id, parent_preview(message)))
+
+
+def get_parent(message_id):
+    message = (
+        Message.objects.filter(pk=message_id).only('room_id', 'thread_root_id', 'content', 'is_deleted').first()
+    )
+    if message is None:
+        return None
+    parent = (message.room_id, message.thread_root_id, parent_preview(message))
+    parents.set(message_id, parent)
+    return parent
+
+
+async def resolve_parent(message_id):
+    """``(room_id, thread_root_id, preview)`` of the message being replied to, or None."""
+    parent = parents.get(message_id)
+    if parent is None:
+        parent = await metrics.db_call(get_parent)(message_id)
+    return parent
+
+
+def thread_root_of(message_id, parent):
+    return parent[1] or message_id
+
+
+def load_participants(root_id):
+    """Everyone who posted in thread ``root_id`` or follows it, minus those
+    who unfollowed it."""
+    users = set(
+        Message.objects.filter(Q(pk=root_id) | Q(thread_root_id=root_id))
+        .order_by().values_list('user_id', flat=True).distinct()
+    )
+    for user_id, following in ThreadFollow.objects.filter(root_id=root_id).values_list('user_id', 'following'):
+        if following:
+            users.add(user_id)
+        else:
+            users.discard(user_id)
+    return users
+
+
+def set_following(room_id, root_id, user_id, following):
+    ThreadFollow.objects.update_or_create(
+        root_id=root_id, user_id=user_id, defaults={'room_id': room_id, 'following': following}
+    )
+
+
+async def participants(room_id, root_id, joining=None):
+    """Ids of the users notified of replies in thread ``root_id``, with
+    ``joining`` (a user posting in it) made a follower.
+
+    The set is cached as a whole and dropped on every change, so the table
+    stays the only copy that is ever modified.
+    """
+    key = _participants_key(root_id)
+    users = await cache.aget(key)
+    if users is None:
+        users = await metrics.db_call(load_participants)(root_id)
+        await cache.aset(key, users, get_settings()['CACHE_TTL'])
+    if joining is not None and joining not in users:
+        await follow(room_id, root_id, joining)
+        users = users | {joining}
+    return users
+
+
+async def follow(room_id, root_id, user_id):
+    await metrics.db_call(set_following)(room_id, root_id, user_id, True)
+    await cache.adelete(_participants_key(root_id))
+
+
+async def unfollow(room_id, root_id, user_id):
+    await metrics.db_call(set_following)(room_id, root_id, user_id, False)
+    await cache.adelete(_participants_key(root_id))
+
+
+async def send_reply(channel_layer, room_group, room_id, root_id, sender_id, event):
+    """Deliver a reply to the thread's participants only, encoded once."""
+    message = pre_encode(event, keep=('message_id',))
+    for user_id in await participants(room_id, root_id, joining=sender_id):
+        await channel_layer.group_send(user_group(room_group, user_id), message)
+
+
+@transaction.atomic
+def apply_replies(replies):
+    """Add ``{root_id: (count, last timestamp)}`` to the roots' counters and
+    return ``{root_id: (reply_count, last_reply_at)}`` as stored.
+
+    Runs in one transaction so a failed batch can be retried without
+    double counting.
+    """
+    for root_id, (count, last_reply_at) in replies.items():
+        Message.objects.filter(pk=root_id).update(reply_count=F('reply_count') + count)
+        # Only ever moves forward, whatever order workers flush in
+        Message.objects.filter(pk=root_id).filter(
+            Q(last_reply_at__isnull=True) | Q(last_reply_at__lt=last_reply_at)
+        ).update(last_reply_at=last_reply_at)
+    rows = Message.objects.filter(pk__in=replies).values_list('id', 'reply_count', 'last_reply_at')
+    return {root_id: (reply_count, last_reply_at) for root_id, reply_count, last_reply_at in rows}
+
+
+def rebuild(room_id):
+    """Fill in missing ``thread_root`` links of a room's replies, then
+    recompute ``reply_count`` and ``last_reply_at`` of every thread root."""
+    messages = Message.objects.filter(room_id=room_id)
+    messages.filter(
+        thread_root__isnull=True, parent_message__isnull=False, parent_message__parent_message__isnull=True
+    ).update(thread_root=F('parent_message'))
+    # One reply level per pass
+    parent_root = Message.objects.filter(pk=OuterRef('parent_message')).values('thread_root')[:1]
+    while messages.filter(thread_root__isnull=True, parent_message__thread_root__isnull=False).update(
+        thread_root=Subquery(parent_root)
+    ):
+        pass
+    replies = Message.objects.filter(thread_root=OuterRef('pk')).order_by().values('thread_root')
+    roots = Message.objects.filter(room_id=room_id, thread_root__isnull=False).values('thread_root')
+    Message.objects.filter(pk__in=roots).update(
+        reply_count=Subquery(replies.annotate(total=Count('id')).values('total')),
+        last_reply_at=Subquery(replies.annotate(last=Max('timestamp')).values('last')),
+    )
+
+
+def with_current_threads(entries):
+    """Copies of serialized ``entries`` carrying reply counts changed since
+    they were cached, like :func:`chatapp.reactions.with_current_counts`."""
+    if not entries:
+        return entries
+    current = cache.get_many([_counts_key(entry['message_id']) for entry in entries])
+    if not current:
+        return entries
+    return [
+        dict(entry, **current[_counts_key(entry['message_id'])])
+        if _counts_key(entry['message_id']) in current else entry
+        for entry in entries
+    ]
+
+
+class ThreadActivity:
+    """Folds replies into their roots' counters once per ``flush_interval``.
+
+    Each flush updates every active root with one ``F()`` increment, caches
+    the new values for :func:`with_current_threads` and sends the room one
+    ``thread_activity`` event per root, so a busy thread costs the room a
+    badge update per interval rather than a frame per reply.
+    """
+
+    def __init__(self, flush_interval, cache_ttl):
+        self.flush_interval = flush_interval
+        self.cache_ttl = cache_ttl
+        # (group, root_id) -> [replies, last timestamp]
+        self.pending = {}
+        self._task = None
+        self._loop = None
+
+    def record(self, channel_layer, group, root_id, timestamp):
+        pending = self.pending.setdefault((group, root_id), [0, timestamp])
+        pending[0] += 1
+        pending[1] = max(pending[1], timestamp)
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._task = loop.create_task(self._run(channel_layer))
+
+    async def _run(self, channel_layer):
+        while self.pending:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush(channel_layer)
+            except Exception:
+                logger.exception('Thread activity flush failed')
+
+    async def flush(self, channel_layer):
+        batch, self.pending = self.pending, {}
+        if not batch:
+            return
+        try:
+            current = await metrics.db_call(apply_replies)(
+                {root_id: tuple(pending) for (_, root_id), pending in batch.items()}
+            )
+        except Exception:
+            logger.exception('Failed to update %d thread counters', len(batch))
+            # Retried next interval, merged with whatever arrived meanwhile
+            for key, (replies, timestamp) in batch.items():
+                pending = self.pending.setdefault(key, [0, timestamp])
+                pending[0] += replies
+                pending[1] = max(pending[1], timestamp)
+            return
+        values = {
+            root_id: {
+                'reply_count': reply_count,
+                'last_reply_at': last_reply_at.isoformat() if last_reply_at else None,
+            }
+            for root_id, (reply_count, last_reply_at) in current.items()
+        }
+        await sync_to_async(cache.set_many, thread_sensitive=False)(
+            {_counts_key(root_id): value for root_id, value in values.items()}, self.cache_ttl
+        )
+        for group, root_id in batch:
+            if root_id in values:
+                await group_send(channel_layer, group, dict(
+                    values[root_id], type='thread_activity', message_id=root_id
+                ), keep=('message_id',))
+
+
+activity = ThreadActivity(_config['FLUSH_INTERVAL'], _config['CACHE_TTL'])
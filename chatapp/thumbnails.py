@@ -0,0 +1,129 @@
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .conf import get_config
+from .identity_cache import LRUCache
+from .models import Message, UserProfile
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    # label -> longest side in pixels
+    'AVATAR_SIZES': {'small': 48, 'medium': 128},
+    'IMAGE_SIZES': {'thumb': 320, 'preview': 1024},
+    'QUALITY': 80,
+    'WORKERS': 2,
+    'URL_CACHE_SIZE': 10000,
+    'URL_CACHE_TTL': 300,
+}
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp'}
+
+
+def get_settings():
+    return get_config('CHAT_THUMBNAILS', DEFAULTS)
+
+
+def is_image(name):
+    return os.path.splitext(name or '')[1].lower() in IMAGE_EXTENSIONS
+
+
+def derivative_name(name, label):
+    directory, base = os.path.split(name)
+    return os.path.join(directory, 'derived', f'{os.path.splitext(base)[0]}.{label}.webp')
+
+
+def make_derivatives(name, sizes):
+    """Write a WebP copy of image ``name`` per ``{label: max side}``.
+
+    Returns ``{label: storage name}``, or ``{}`` when ``name`` isn't a
+    readable image.
+    """
+    try:
+        with default_storage.open(name, 'rb') as source:
+            image = ImageOps.exif_transpose(Image.open(source))
+            image.load()
+    except (OSError, UnidentifiedImageError, Image.DecompressionBombError):
+        logger.warning('Cannot make thumbnails for %s', name)
+        return {}
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if image.mode in ('LA', 'P', 'PA') else 'RGB')
+    derived = {}
+    for label, side in sizes.items():
+        copy = image.copy()
+        copy.thumbnail((side, side), Image.LANCZOS)
+        output = io.BytesIO()
+        copy.save(output, 'WEBP', quality=get_settings()['QUALITY'])
+        target = derivative_name(name, label)
+        if default_storage.exists(target):
+            default_storage.delete(target)
+        derived[label] = default_storage.save(target, ContentFile(output.getvalue()))
+    return derived
+
+
+_urls = LRUCache(get_settings()['URL_CACHE_SIZE'], get_settings()['URL_CACHE_TTL'])
+
+
+def urls(derived):
+    """``{label: url}`` for stored derivatives, caching ``storage.url()``
+    which signs every URL on S3."""
+    result = {}
+    for label, name in derived.items():
+        url = _urls.get(name)
+        if url is None:
+            url = default_storage.url(name)
+            _urls.set(name, url)
+        result[label] = url
+    return result
+
+
+def generate_for_message(message_id):
+    message = Message.objects.get(pk=message_id)
+    if message.file and is_image(message.file.name):
+        message.thumbnails = make_derivatives(message.file.name, get_settings()['IMAGE_SIZES'])
+        message.save(update_fields=['thumbnails'])
+
+
+def generate_for_avatar(profile_id):
+    profile = UserProfile.objects.get(pk=profile_id)
+    if profile.avatar:
+        profile.avatar_thumbnails = make_derivatives(profile.avatar.name, get_settings()['AVATAR_SIZES'])
+        profile.save(update_fields=['avatar_thumbnails'])
+
+
+def _run(func, pk):
+    try:
+        func(pk)
+    except Exception:
+        logger.exception('Thumbnail generation failed for %s %s', func.__name__, pk)
+    finally:
+        close_old_connections()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(get_settings()['WORKERS'], thread_name_prefix='chat-thumbnails')
+    return _executor
+
+
+def schedule_message(message_id):
+    return get_executor().submit(_run, generate_for_message, message_id)
+
+
+def schedule_avatar(profile_id):
+    return get_executor().submit(_run, generate_for_avatar, profile_id)
@@ -0,0 +1,56 @@
+from urllib.parse import parse_qs
+
+from channels.auth import AuthMiddlewareStack
+from channels.middleware import BaseMiddleware
+from django.contrib.auth import get_user_model
+from django.core import signing
+
+from .conf import get_config
+
+DEFAULTS = {
+    'TTL': 60,
+}
+
+SALT = 'chatapp.ws-ticket'
+
+
+def get_settings():
+    return get_config('CHAT_WS_TICKETS', DEFAULTS)
+
+
+def issue(user, room):
+    """Signed, timestamped ticket that lets ``user`` open ``room``'s WebSocket."""
+    return signing.dumps({'u': user.pk, 'n': user.get_username(), 'r': room.name}, salt=SALT)
+
+
+def verify(ticket):
+    """Claims of a ticket issued within ``TTL`` seconds, or None."""
+    try:
+        return signing.loads(ticket, salt=SALT, max_age=get_settings()['TTL'])
+    except signing.BadSignature:
+        return None
+
+
+class TicketAuthMiddleware(BaseMiddleware):
+    """Authenticates WebSocket handshakes carrying a ``ticket`` query parameter.
+
+    A valid ticket is checked with the secret key alone: ``scope['user']``
+    becomes an unsaved ``User`` with the ticket's id and username and
+    ``scope['ticket_room']`` the room it was issued for, so the handshake
+    skips the session and user queries. Anything else goes through the
+    usual session authentication. A ticket stays usable until it expires
+    even if the user is deactivated in the meantime, hence the short TTL.
+    """
+
+    def __init__(self, inner):
+        super().__init__(inner)
+        self.session_auth = AuthMiddlewareStack(inner)
+
+    async def __call__(self, scope, receive, send):
+        query = parse_qs(scope.get('query_string', b'').decode())
+        ticket = query.get('ticket', [None])[0]
+        claims = verify(ticket) if ticket else None
+        if claims is None:
+            return await self.session_auth(scope, receive, send)
+        user = get_user_model()(pk=claims['u'], username=claims['n'])
+        return await super().__call__(dict(scope, user=user, ticket_room=claims['r']), receive, send)
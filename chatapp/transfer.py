@@ -0,0 +1,332 @@
+import json
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Count, Max
+from django.utils.dateparse import parse_datetime
+
+from . import archive, room_directory, search, threads
+from .conf import get_config
+from .ids import allocate_message_id
+from .models import (
+    ArchiveSegment, Message, MessageReaction, MessageReactionCount, ReadCursor, ReadReceipt, Room, ThreadFollow,
+    allocates_ids,
+)
+from .recent_messages import get_buffer
+
+DEFAULTS = {
+    'BATCH_SIZE': 2000,
+    'CHUNK_BYTES': 65536,
+}
+
+FORMAT_VERSION = 1
+
+
+class InvalidExport(ValueError):
+    pass
+
+
+def get_settings():
+    return get_config('CHAT_TRANSFER', DEFAULTS)
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(value)
+
+
+def _line(record):
+    return json.dumps(record, separators=(',', ':'), default=_encode).encode() + b'\n'
+
+
+def export_room(room):
+    """NDJSON lines describing ``room``: a header, then members, messages
+    (archived ones first), reactions, receipts, read cursors and thread follows.
+
+    Every query streams through ``iterator()``, which uses server-side
+    cursors on PostgreSQL, and archive segments are read one at a time, so
+    memory stays flat however large the room is.
+    """
+    chunk_size = get_settings()['BATCH_SIZE']
+    yield _line({'type': 'room', 'version': FORMAT_VERSION, 'name': room.name, 'created_at': room.created_at})
+    for username in room.members.values_list('username', flat=True).iterator(chunk_size=chunk_size):
+        yield _line({'type': 'member', 'user': username})
+
+    for segment in ArchiveSegment.objects.filter(room=room).order_by('first_timestamp', 'first_message_id'):
+        for entry in archive.read_segment(segment, cache=False):
+            yield _line({
+                'type': 'message',
+                'id': entry['message_id'],
+                'user': entry['username'],
+                'parent_id': entry['parent_id'],
+                'thread_root_id': entry.get('thread_root_id'),
+                'content': entry['message'],
+                'file': archive.stored_file(entry),
+                'thumbnails': {},
+                'timestamp': entry['timestamp'],
+                'edited_at': entry['edited_at'],
+                'is_deleted': entry['is_deleted'],
+                # Archived messages keep counts only, not who reacted
+                'reaction_counts': entry['reactions'],
+            })
+    messages = Message.objects.filter(room=room).order_by('timestamp', 'id').values_list(
+        'id', 'user__username', 'parent_message_id', 'thread_root_id', 'content', 'file', 'thumbnails',
+        'timestamp', 'edited_at', 'is_deleted',
+    )
+    fields = (
+        'type', 'id', 'user', 'parent_id', 'thread_root_id', 'content', 'file', 'thumbnails',
+        'timestamp', 'edited_at', 'is_deleted',
+    )
+    for row in messages.iterator(chunk_size=chunk_size):
+        yield _line(dict(zip(
+            fields,
+            ('message', *row),
+        )))
+
+    reactions = MessageReaction.objects.filter(message__room=room).order_by('id').values_list(
+        'message_id', 'user__username', 'emoji', 'created_at'
+    )
+    for message_id, username, emoji, created_at in reactions.iterator(chunk_size=chunk_size):
+        yield _line({'type': 'reaction', 'message_id': message_id, 'user': username, 'emoji': emoji,
+                     'created_at': created_at})
+    receipts = ReadReceipt.objects.filter(message__room=room).order_by('id').values_list(
+        'message_id', 'user__username', 'timestamp'
+    )
+    for message_id, username, timestamp in receipts.iterator(chunk_size=chunk_size):
+        yield _line({'type': 'receipt', 'message_id': message_id, 'user': username, 'timestamp': timestamp})
+    cursors = ReadCursor.objects.filter(room=room).values_list('user__username', 'last_read_message_id')
+    for username, message_id in cursors.iterator(chunk_size=chunk_size):
+        yield _line({'type': 'cursor', 'user': username, 'last_read_message_id': message_id})
+    follows = ThreadFollow.objects.filter(room=room).order_by('id').values_list('root_id', 'user__username', 'following')
+    for root_id, username, following in follows.iterator(chunk_size=chunk_size):
+        yield _line({'type': 'follow', 'root_id': root_id, 'user': username, 'following': following})
+
+
+def chunked(lines, size=None):
+    """Join ``lines`` into chunks of about ``size`` bytes."""
+    size = size or get_settings()['CHUNK_BYTES']
+    chunk = []
+    length = 0
+    for line in lines:
+        chunk.append(line)
+        length += len(line)
+        if length >= size:
+            yield b''.join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield b''.join(chunk)
+
+
+async def stream(lines):
+    """Async iterator over ``chunked(lines)`` for StreamingHttpResponse.
+
+    Django buffers a synchronous iterator completely before serving it
+    under ASGI; this pulls one chunk at a time on the sync thread instead.
+    """
+    chunks = chunked(lines)
+    next_chunk = sync_to_async(next)
+    try:
+        while (chunk := await next_chunk(chunks, None)) is not None:
+            yield chunk
+    finally:
+        await sync_to_async(chunks.close)()
+
+
+class Users:
+    """username -> id, creating accounts (without a usable password) for
+    names this database doesn't have."""
+
+    def __init__(self):
+        self.ids = {}
+
+    def __getitem__(self, username):
+        user_id = self.ids.get(username)
+        if user_id is None:
+            user, _ = get_user_model().objects.get_or_create(
+                username=username, defaults={'password': make_password(None)}
+            )
+            user_id = self.ids[username] = user.id
+        return user_id
+
+
+class Importer:
+    """Loads NDJSON produced by :func:`export_room` with batched ``bulk_create``.
+
+    Message ids are kept where they are free, so a restore needs no id map
+    and memory use doesn't grow with the room. Ids taken by another room's
+    messages (an import into a second room of the same database) get new
+    ones, and replies, reactions, receipts, cursors and follows are
+    remapped to match; only those ids are held in memory. Importing over
+    the room's own messages fails unless ``skip_existing`` is set.
+    """
+
+    def __init__(self, room_name=None, batch_size=None, skip_existing=False):
+        self.room_name = room_name
+        self.batch_size = batch_size or get_settings()['BATCH_SIZE']
+        self.skip_existing = skip_existing
+        self.room = None
+        self.users = Users()
+        self.pending = []
+        self.pending_type = None
+        self.cursor_users = set()
+        # exported id -> new id, for ids that belonged to another room
+        self.remapped = {}
+        self._next_id = None
+        self.counts = {'member': 0, 'message': 0, 'reaction': 0, 'receipt': 0, 'cursor': 0, 'follow': 0}
+
+    def run(self, lines):
+        lines = iter(lines)
+        try:
+            header = json.loads(next(lines))
+        except (StopIteration, ValueError) as exc:
+            raise InvalidExport('Missing room header') from exc
+        if header.get('type') != 'room' or header.get('version') != FORMAT_VERSION:
+            raise InvalidExport(f'Unsupported header: {header}')
+        self.room, _ = Room.objects.get_or_create(name=self.room_name or header['name'])
+
+        for number, line in enumerate(lines, start=2):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                kind = record['type']
+            except (ValueError, KeyError, TypeError) as exc:
+                raise InvalidExport(f'Line {number}: {exc!r}') from exc
+            if kind not in self.counts:
+                raise InvalidExport(f'Line {number}: unknown record type {kind!r}')
+            if kind != self.pending_type:
+                self.flush()
+                self.pending_type = kind
+            self.pending.append(record)
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+        self.flush()
+        self.finish()
+        return self.counts
+
+    def flush(self):
+        if not self.pending:
+            return
+        records, self.pending = self.pending, []
+        with transaction.atomic():
+            getattr(self, f'create_{self.pending_type}s')(records)
+        self.counts[self.pending_type] += len(records)
+
+    def create_members(self, records):
+        Room.members.through.objects.bulk_create(
+            [Room.members.through(room_id=self.room.id, user_id=self.users[record['user']]) for record in records],
+            ignore_conflicts=True,
+        )
+
+    def message_id(self, message_id):
+        return self.remapped.get(message_id, message_id) if message_id is not None else None
+
+    def new_message_id(self):
+        if allocates_ids():
+            return allocate_message_id()
+        if self._next_id is None:
+            self._next_id = (Message.objects.aggregate(last=Max('id'))['last'] or 0) + 1
+        self._next_id += 1
+        return self._next_id - 1
+
+    def create_messages(self, records):
+        taken = dict(
+            Message.objects.filter(pk__in=[record['id'] for record in records]).values_list('pk', 'room_id')
+        )
+        for record in records:
+            if taken.get(record['id'], self.room.id) != self.room.id:
+                self.remapped[record['id']] = self.new_message_id()
+        messages = [
+            Message(
+                id=self.message_id(record['id']),
+                room_id=self.room.id,
+                user_id=self.users[record['user']],
+                parent_message_id=self.message_id(record['parent_id']),
+                thread_root_id=self.message_id(record.get('thread_root_id')),
+                content=record['content'],
+                file=record['file'] or None,
+                thumbnails=record['thumbnails'] or {},
+                timestamp=parse_datetime(record['timestamp']),
+                edited_at=parse_datetime(record['edited_at']) if record['edited_at'] else None,
+                is_deleted=record['is_deleted'],
+            )
+            for record in records
+        ]
+        Message.objects.bulk_create(messages, ignore_conflicts=self.skip_existing)
+        counts = [
+            MessageReactionCount(message_id=message.id, emoji=emoji, count=count)
+            for record, message in zip(records, messages)
+            for emoji, count in (record.get('reaction_counts') or {}).items()
+        ]
+        if counts:
+            MessageReactionCount.objects.bulk_create(counts, ignore_conflicts=True)
+        search.index_messages(messages)
+
+    def create_reactions(self, records):
+        MessageReaction.objects.bulk_create([
+            MessageReaction(message_id=self.message_id(record['message_id']),
+                            user_id=self.users[record['user']], emoji=record['emoji'])
+            for record in records
+        ], ignore_conflicts=True)
+
+    def create_receipts(self, records):
+        ReadReceipt.objects.bulk_create([
+            ReadReceipt(message_id=self.message_id(record['message_id']), user_id=self.users[record['user']])
+            for record in records
+        ], ignore_conflicts=True)
+
+    def create_cursors(self, records):
+        cursors = [
+            ReadCursor(room_id=self.room.id, user_id=self.users[record['user']],
+                       last_read_message_id=self.message_id(record['last_read_message_id']))
+            for record in records
+        ]
+        ReadCursor.objects.bulk_create(
+            cursors, update_conflicts=True, unique_fields=['room', 'user'], update_fields=['last_read_message_id']
+        )
+        self.cursor_users.update(cursor.user_id for cursor in cursors)
+
+    def create_follows(self, records):
+        ThreadFollow.objects.bulk_create([
+            ThreadFollow(room_id=self.room.id, root_id=self.message_id(record['root_id']),
+                         user_id=self.users[record['user']], following=record['following'])
+            for record in records
+        ], ignore_conflicts=True)
+
+    def finish(self):
+        # Explicit ids don't advance the primary key sequence on PostgreSQL
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [Message]):
+                cursor.execute(sql)
+        if self.counts['reaction']:
+            self.rebuild_reaction_counts()
+        # Also links replies from exports made before threads existed
+        threads.rebuild(self.room.id)
+        room_directory.rebuild_stats(self.room)
+        room_directory.refresh_read_counts([(self.room.id, user_id) for user_id in self.cursor_users])
+        get_buffer().invalidate(self.room.id)
+
+    def rebuild_reaction_counts(self):
+        totals = (
+            MessageReaction.objects.filter(message__room=self.room)
+            .values('message_id', 'emoji').annotate(total=Count('id')).order_by()
+        )
+        batch = []
+        for row in totals.iterator(chunk_size=self.batch_size):
+            batch.append(MessageReactionCount(message_id=row['message_id'], emoji=row['emoji'], count=row['total']))
+            if len(batch) >= self.batch_size:
+                self._save_counts(batch)
+                batch = []
+        if batch:
+            self._save_counts(batch)
+
+    def _save_counts(self, batch):
+        MessageReactionCount.objects.bulk_create(
+            batch, update_conflicts=True, unique_fields=['message', 'emoji'], update_fields=['count']
+        )
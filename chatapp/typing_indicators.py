@@ -0,0 +1,100 @@
+import asyncio
+import time
+import uuid
+
+from .conf import get_config
+from .protocol import group_send
+
+DEFAULTS = {
+    'INTERVAL': 0.5,
+    'TTL': 5,
+}
+
+
+class TypingTracker:
+    """In-memory typing state for the rooms served by this process.
+
+    ``typing`` frames only refresh an expiry; once per ``interval`` each room
+    with changes gets a single ``typing_status`` event listing who is typing on
+    this worker and who stopped. Ongoing typists are re-announced every
+    ``ttl / 2`` so clients can expire entries from workers that went away.
+
+    Events carry the worker's ``source`` id and list everyone typing there,
+    so a snapshot supersedes the previous one from the same worker.
+    """
+
+    def __init__(self, interval, ttl):
+        self.interval = interval
+        self.ttl = ttl
+        self.source = uuid.uuid4().hex[:12]
+        self._rooms = {}
+        self._stopped = {}
+        self._changed = set()
+        self._last_sent = {}
+        self._tasks = {}
+        self._loop = None
+
+    def start(self, channel_layer, group, user_id, username):
+        typists = self._rooms.setdefault(group, {})
+        if user_id not in typists:
+            self._changed.add(group)
+            self._stopped.get(group, set()).discard(user_id)
+        typists[user_id] = (username, time.monotonic() + self.ttl)
+        self._ensure_flusher(channel_layer, group)
+
+    def stop(self, channel_layer, group, user_id):
+        typists = self._rooms.get(group)
+        if typists and typists.pop(user_id, None) is not None:
+            self._stopped.setdefault(group, set()).add(user_id)
+            self._changed.add(group)
+            self._ensure_flusher(channel_layer, group)
+
+    def collect(self, group):
+        """Return the pending ``typing_status`` event for ``group``, if any."""
+        now = time.monotonic()
+        typists = self._rooms.get(group, {})
+        stopped = self._stopped.pop(group, set())
+        for user_id, (_, expires) in list(typists.items()):
+            if expires <= now:
+                del typists[user_id]
+                stopped.add(user_id)
+        refresh_due = typists and now - self._last_sent.get(group, 0) >= self.ttl / 2
+        if not stopped and group not in self._changed and not refresh_due:
+            return None
+        self._changed.discard(group)
+        self._last_sent[group] = now
+        return {
+            'type': 'typing_status',
+            'typing': [
+                {'user_id': user_id, 'username': username}
+                for user_id, (username, _) in typists.items()
+            ],
+            'stopped': sorted(stopped),
+            'ttl': self.ttl,
+            'source': self.source,
+        }
+
+    def _ensure_flusher(self, channel_layer, group):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._tasks = {}
+        task = self._tasks.get(group)
+        if task is None or task.done():
+            self._tasks[group] = loop.create_task(self._flush_room(channel_layer, group))
+
+    async def _flush_room(self, channel_layer, group):
+        while True:
+            await asyncio.sleep(self.interval)
+            event = self.collect(group)
+            if event is not None:
+                await group_send(channel_layer, group, event)
+            if not self._rooms.get(group) and not self._stopped.get(group):
+                self._rooms.pop(group, None)
+                self._last_sent.pop(group, None)
+                self._tasks.pop(group, None)
+                return
+
+
+_config = get_config('CHAT_TYPING', DEFAULTS)
+tracker = TypingTracker(_config['INTERVAL'], _config['TTL'])
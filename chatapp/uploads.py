@@ -0,0 +1,211 @@
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import close_old_connections
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+
+from . import protocol, room_directory, thumbnails
+from .conf import get_config
+from .models import Message, UploadSession
+from .serializers import serialize_new_message
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'TEMP_DIR': None,
+    'CHUNK_SIZE': 4 * 1024 * 1024,
+    'MAX_FILE_SIZE': 1024 * 1024 * 1024,
+    'WORKERS': 2,
+    'STALE_AFTER': 3600,
+}
+
+READ_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def get_settings():
+    return get_config('CHAT_UPLOADS', DEFAULTS)
+
+
+def part_path(session):
+    return os.path.join(get_settings()['TEMP_DIR'], f'{session.pk}.part')
+
+
+def append_chunk(session, offset, stream, length):
+    """Stream ``length`` bytes from ``stream`` onto the session's partial file.
+
+    ``offset`` must equal the bytes already received, which lets a client
+    resume after a dropped connection by asking for the current offset and
+    sending from there. The offset is checked and claimed (status
+    'receiving') in one conditional update, so no lock or transaction is
+    held while the body arrives. Updates ``session`` and returns the new
+    offset; a session that is now complete is left 'processing' for
+    :func:`schedule_finalize`.
+    """
+    if length > get_settings()['CHUNK_SIZE'] or offset + length > session.size:
+        raise UploadError('Chunk too large', status=413)
+    claimed = UploadSession.objects.filter(pk=session.pk, status='uploading', received=offset).update(
+        status='receiving', updated_at=timezone.now()
+    )
+    if not claimed:
+        session.refresh_from_db()
+        if session.status != 'uploading':
+            raise UploadError('Upload is not accepting data', status=409)
+        raise UploadError(f'Expected offset {session.received}', status=409)
+    try:
+        os.makedirs(get_settings()['TEMP_DIR'], exist_ok=True)
+        with open(part_path(session), 'ab') as part:
+            part.truncate(offset)
+            remaining = length
+            while remaining:
+                data = stream.read(min(READ_SIZE, remaining))
+                if not data:
+                    break
+                part.write(data)
+                remaining -= len(data)
+        if remaining:
+            raise UploadError('Incomplete chunk', status=400)
+    except BaseException:
+        # Release the claim; the next chunk at this offset truncates the tail
+        UploadSession.objects.filter(pk=session.pk, status='receiving').update(
+            status='uploading', updated_at=timezone.now()
+        )
+        session.status = 'uploading'
+        raise
+    session.received = offset + length
+    session.status = 'processing' if session.received == session.size else 'uploading'
+    UploadSession.objects.filter(pk=session.pk, status='receiving').update(
+        received=session.received, status=session.status, updated_at=timezone.now()
+    )
+    return session.received
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as part:
+        for block in iter(lambda: part.read(READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def finalize(session_id):
+    """Verify, store and announce a fully received upload.
+
+    Runs on the upload executor: hashes the partial file, streams it to
+    ``default_storage`` (S3 in production), creates the file message and
+    broadcasts it to the room like one sent over the socket.
+    """
+    session = UploadSession.objects.select_related('room', 'user').get(pk=session_id)
+    path = part_path(session)
+    try:
+        checksum = file_sha256(path)
+        if session.sha256 and checksum != session.sha256.lower():
+            raise UploadError('Checksum mismatch')
+        with open(path, 'rb') as part:
+            name = default_storage.save(
+                f'chat_files/{session.pk}/{get_valid_filename(session.file_name)}', File(part)
+            )
+        # Already off the request thread, so images get their thumbnails
+        # before the message is announced
+        derived = {}
+        if thumbnails.is_image(name):
+            derived = thumbnails.make_derivatives(name, thumbnails.get_settings()['IMAGE_SIZES'])
+        message = Message.objects.create(
+            room=session.room,
+            user=session.user,
+            content=f'Shared a file: {session.file_name}',
+            file=name,
+            thumbnails=derived,
+        )
+    except Exception:
+        logger.exception('Upload %s failed', session.pk)
+        session.status = 'failed'
+        session.save(update_fields=['status', 'updated_at'])
+        return None
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+    session.status = 'complete'
+    session.message = message
+    session.sha256 = checksum
+    session.save(update_fields=['status', 'message', 'sha256', 'updated_at'])
+    room_directory.record_now(message)
+    async_to_sync(protocol.group_send)(
+        get_channel_layer(),
+        f'chat_{session.room.name}',
+        dict(serialize_new_message(message), type='chat_message'),
+        keep=('message_id',),
+    )
+    return message
+
+
+def _run_finalize(session_id):
+    try:
+        return finalize(session_id)
+    finally:
+        close_old_connections()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(get_settings()['WORKERS'], thread_name_prefix='chat-upload')
+    return _executor
+
+
+def schedule_finalize(session):
+    """Hand a complete ('processing') upload to the executor so no request
+    thread waits on storage."""
+    return get_executor().submit(_run_finalize, session.pk)
+
+
+def recover_stale(sessions=None, now=None):
+    """Pick up uploads left behind by a worker that died, and return counts.
+
+    Sessions untouched for ``STALE_AFTER`` seconds while 'receiving' go back
+    to 'uploading' so the client can resend the chunk; 'processing' ones are
+    finalized again if their partial file is still on this host and marked
+    failed otherwise. Run by the retention command and on a resume (GET).
+    """
+    now = now or timezone.now()
+    cutoff = now - timedelta(seconds=get_settings()['STALE_AFTER'])
+    sessions = UploadSession.objects.all() if sessions is None else sessions
+    report = {'released': 0, 'retried': 0, 'failed': 0}
+    report['released'] = sessions.filter(status='receiving', updated_at__lt=cutoff).update(
+        status='uploading', updated_at=now
+    )
+    for session in sessions.filter(status='processing', updated_at__lt=cutoff).iterator():
+        # Claim it, so only one caller retries
+        if not UploadSession.objects.filter(
+            pk=session.pk, status='processing', updated_at=session.updated_at
+        ).update(updated_at=now):
+            continue
+        if os.path.exists(part_path(session)):
+            schedule_finalize(session)
+            report['retried'] += 1
+        else:
+            logger.error('Upload %s lost its partial file while processing', session.pk)
+            UploadSession.objects.filter(pk=session.pk).update(status='failed', updated_at=now)
+            report['failed'] += 1
+    return report
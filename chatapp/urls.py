@@ -11,6 +11,15 @@ urlpatterns = [
     path('logout/', views.logout_view, name='logout'),
     path('upload/', login_required(views.upload_file), name='upload_file'),
     path('profile/', login_required(views.profile), name='profile'),
+    path('api/rooms/', views.rooms_directory, name='rooms_directory'),
+    path('api/rooms/<str:room_name>/messages/', views.message_history, name='message_history'),
+    path('api/rooms/<str:room_name>/search/', views.message_search, name='message_search'),
+    path('api/rooms/<str:room_name>/threads/<int:message_id>/', views.message_thread, name='message_thread'),
+    path('api/rooms/<str:room_name>/ticket/', views.ws_ticket, name='ws_ticket'),
+    path('api/rooms/<str:room_name>/export/', views.room_export, name='room_export'),
+    path('api/uploads/', views.create_upload, name='create_upload'),
+    path('api/uploads/<uuid:upload_id>/', views.upload_chunk, name='upload_chunk'),
+    path('metrics/', views.metrics_view, name='metrics'),
     path('', login_required(views.index), name='index'),
     path('<str:room_name>/', login_required(views.room), name='room'),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
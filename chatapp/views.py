@@ -1,9 +1,14 @@
-from django.shortcuts import render, redirect
+from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from .models import Room, Message, UserProfile
+from .models import Room, Message, UploadSession, UserProfile
+from django.utils.dateparse import parse_datetime
+from . import history, identity_cache, metrics, room_directory, search, thumbnails, tickets, transfer, uploads
+from .conf import get_config
 from django.contrib.auth import login, logout
 from django.contrib import messages
-from django.http import JsonResponse
+from django.db import transaction
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.crypto import constant_time_compare
 from .forms import SignUpForm
 import json
 
@@ -24,22 +29,154 @@ def signup(request):
 
 @login_required
 def index(request):
-    rooms = Room.objects.all()
+    rooms, has_more = room_directory.directory_page(1)
+    rooms = [
+        dict(room, last_activity=parse_datetime(room['last_activity']))
+        for room in room_directory.with_unread(rooms, request.user)
+    ]
     return render(request, 'chatapp/index.html', {
-        'rooms': rooms
+        'rooms': rooms,
+        'has_more': has_more
+    })
+
+@login_required
+def rooms_directory(request):
+    try:
+        page = max(1, int(request.GET.get('page') or 1))
+        rooms, has_more = room_directory.directory_page(page, limit=request.GET.get('limit'))
+    except ValueError:
+        return JsonResponse({'status': 'error', 'error': 'Invalid page or limit'}, status=400)
+    return JsonResponse({
+        'status': 'success',
+        'rooms': room_directory.with_unread(rooms, request.user),
+        'page': page,
+        'has_more': has_more,
     })
 
 @login_required
 def room(request, room_name):
-    room, created = Room.objects.get_or_create(name=room_name)
-    if created:
-        room.members.add(request.user)
-    messages = Message.objects.filter(room=room)[:100]
+    try:
+        room = identity_cache.get_room(room_name)
+    except Room.DoesNotExist:
+        room, created = Room.objects.get_or_create(name=room_name)
+        if created:
+            identity_cache.join(room, request.user)
+    if not identity_cache.is_member(room.id, request.user.id):
+        # Membership scopes history, search and WebSocket joins
+        if request.method != 'POST':
+            return render(request, 'chatapp/join_room.html', {'room': room})
+        identity_cache.join(room, request.user)
+        return redirect('chatapp:room', room_name=room.name)
+    messages, _ = history.load_page(room.id, limit=100)
+    messages = [
+        dict(message, timestamp=parse_datetime(message['timestamp']))
+        for message in messages
+    ]
     return render(request, 'chatapp/room.html', {
         'room': room,
-        'messages': messages
+        'messages': messages,
+        'ws_ticket': tickets.issue(request.user, room),
+        'ws_ticket_ttl': tickets.get_settings()['TTL'],
+    })
+
+@login_required
+def ws_ticket(request, room_name):
+    try:
+        room = identity_cache.get_room(room_name)
+    except Room.DoesNotExist:
+        return JsonResponse({'status': 'error', 'error': 'Room not found'}, status=404)
+    if not identity_cache.is_member(room.id, request.user.id):
+        return JsonResponse({'status': 'error', 'error': 'Not a member of this room'}, status=403)
+    return JsonResponse({
+        'status': 'success',
+        'ticket': tickets.issue(request.user, room),
+        'expires_in': tickets.get_settings()['TTL'],
+    })
+
+@login_required
+def message_history(request, room_name):
+    room = get_object_or_404(Room, name=room_name)
+    if not identity_cache.is_member(room.id, request.user.id):
+        return JsonResponse({'status': 'error', 'error': 'Not a member of this room'}, status=403)
+    before = request.GET.get('before')
+    after = request.GET.get('after')
+    if before and after:
+        return JsonResponse({'status': 'error', 'error': 'Use either before or after, not both'}, status=400)
+    try:
+        messages, has_more = history.load_page(room.id, before=before, after=after, limit=request.GET.get('limit'))
+    except (history.InvalidCursor, ValueError):
+        return JsonResponse({'status': 'error', 'error': 'Invalid cursor or limit'}, status=400)
+    return JsonResponse({
+        'status': 'success',
+        'messages': messages,
+        'has_more': has_more,
+        'before': history.encode_cursor(messages[0]) if messages else before,
+        'after': history.encode_cursor(messages[-1]) if messages else after,
+    })
+
+@login_required
+def message_thread(request, room_name, message_id):
+    room = get_object_or_404(Room, name=room_name)
+    if not identity_cache.is_member(room.id, request.user.id):
+        return JsonResponse({'status': 'error', 'error': 'Not a member of this room'}, status=403)
+    after = request.GET.get('after')
+    try:
+        root_id, messages, has_more = history.load_thread(
+            room.id, message_id, after=after, limit=request.GET.get('limit')
+        )
+    except (history.InvalidCursor, ValueError):
+        return JsonResponse({'status': 'error', 'error': 'Invalid cursor or limit'}, status=400)
+    if root_id is None:
+        return JsonResponse({'status': 'error', 'error': 'Message not found'}, status=404)
+    return JsonResponse({
+        'status': 'success',
+        'thread_root_id': root_id,
+        'messages': messages,
+        'has_more': has_more,
+        'after': history.encode_cursor(messages[-1]) if messages else after,
     })
 
+@login_required
+def message_search(request, room_name):
+    room = get_object_or_404(Room, name=room_name)
+    if not identity_cache.is_member(room.id, request.user.id):
+        return JsonResponse({'status': 'error', 'error': 'Not a member of this room'}, status=403)
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return JsonResponse({'status': 'error', 'error': 'q is required'}, status=400)
+    try:
+        offset = int(request.GET.get('offset') or 0)
+        results, has_more = search.search(room.id, query, offset=offset, limit=request.GET.get('limit'))
+    except ValueError:
+        return JsonResponse({'status': 'error', 'error': 'Invalid offset or limit'}, status=400)
+    return JsonResponse({
+        'status': 'success',
+        'results': results,
+        'has_more': has_more,
+        'next_offset': offset + len(results) if has_more else None,
+    })
+
+@login_required
+def room_export(request, room_name):
+    room = get_object_or_404(Room, name=room_name)
+    if not identity_cache.is_member(room.id, request.user.id):
+        return JsonResponse({'status': 'error', 'error': 'Not a member of this room'}, status=403)
+    response = StreamingHttpResponse(transfer.stream(transfer.export_room(room)), content_type='application/x-ndjson')
+    response['Content-Disposition'] = f'attachment; filename="{room.name}.ndjson"'
+    return response
+
+def metrics_view(request):
+    # Scraped by Prometheus with a bearer token; without one configured only
+    # staff sessions may look
+    token = get_config('CHAT_METRICS', {'TOKEN': None})['TOKEN']
+    if token:
+        allowed = constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}')
+    else:
+        allowed = request.user.is_staff
+    if not allowed:
+        return HttpResponse(status=403)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @login_required
 def logout_view(request):
     logout(request)
@@ -50,12 +187,19 @@ def logout_view(request):
 def upload_file(request):
     if request.method == 'POST' and request.FILES.get('file'):
         file = request.FILES['file']
+        # chat.js posts the room name as room_id
+        room = get_object_or_404(Room, name=request.POST.get('room_id'))
+        if not identity_cache.is_member(room.id, request.user.id):
+            return JsonResponse({'status': 'error', 'error': 'Not a member of this room'}, status=403)
         message = Message.objects.create(
-            room_id=request.POST.get('room_id'),
+            room=room,
             user=request.user,
             file=file,
             content=f'Shared a file: {file.name}'
         )
+        room_directory.record_now(message)
+        if thumbnails.is_image(message.file.name):
+            transaction.on_commit(lambda: thumbnails.schedule_message(message.pk))
         return JsonResponse({
             'status': 'success',
             'file_url': message.file.url,
@@ -63,16 +207,83 @@ def upload_file(request):
         })
     return JsonResponse({'status': 'error'}, status=400)
 
+def _upload_state(session):
+    return {
+        'status': session.status,
+        'upload_id': str(session.pk),
+        'offset': session.received,
+        'size': session.size,
+        'chunk_size': uploads.get_settings()['CHUNK_SIZE'],
+        'message_id': session.message_id,
+    }
+
+@login_required
+def create_upload(request):
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error'}, status=405)
+    try:
+        data = json.loads(request.body)
+        room = get_object_or_404(Room, name=data['room'])
+        size = int(data['size'])
+        file_name = str(data['file_name'])[:255]
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'status': 'error', 'error': 'room, file_name and size are required'}, status=400)
+    if not identity_cache.is_member(room.id, request.user.id):
+        return JsonResponse({'status': 'error', 'error': 'Not a member of this room'}, status=403)
+    if not 0 < size <= uploads.get_settings()['MAX_FILE_SIZE']:
+        return JsonResponse({'status': 'error', 'error': 'File too large'}, status=413)
+    session = UploadSession.objects.create(
+        room=room,
+        user=request.user,
+        file_name=file_name,
+        size=size,
+        sha256=str(data.get('sha256') or '')[:64],
+    )
+    return JsonResponse(_upload_state(session), status=201)
+
+@login_required
+def upload_chunk(request, upload_id):
+    # GET reports how far an upload got so clients can resume; PUT appends
+    # the request body at the Upload-Offset header, streamed to a temp file
+    if request.method == 'GET':
+        sessions = UploadSession.objects.filter(pk=upload_id, user=request.user)
+        uploads.recover_stale(sessions)
+        session = get_object_or_404(sessions)
+        return JsonResponse(_upload_state(session))
+    if request.method != 'PUT':
+        return JsonResponse({'status': 'error'}, status=405)
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+        length = int(request.headers.get('Content-Length', ''))
+    except ValueError:
+        return JsonResponse({'status': 'error', 'error': 'Upload-Offset and Content-Length are required'}, status=400)
+    session = get_object_or_404(UploadSession, pk=upload_id, user=request.user)
+    try:
+        uploads.append_chunk(session, offset, request, length)
+    except uploads.UploadError as error:
+        return JsonResponse(dict(_upload_state(session), error=str(error)), status=error.status)
+    if session.status == 'processing':
+        uploads.schedule_finalize(session)
+    return JsonResponse(_upload_state(session), status=202 if session.status == 'processing' else 200)
+
 @login_required
 def profile(request):
     if request.method == 'POST':
         profile = request.user.profile
-        if request.FILES.get('avatar'):
-            profile.avatar = request.FILES['avatar']
+        new_avatar = request.FILES.get('avatar')
+        if new_avatar:
+            profile.avatar = new_avatar
+            profile.avatar_thumbnails = {}
         if request.POST.get('theme'):
             profile.theme_preference = request.POST['theme']
         profile.save()
+        if new_avatar:
+            # Only once the new avatar is stored, so the worker renders it and
+            # no later save of this instance resets what it writes
+            transaction.on_commit(lambda: thumbnails.schedule_avatar(profile.pk))
         return JsonResponse({'status': 'success'})
+    profile = request.user.profile
     return render(request, 'chatapp/profile.html', {
-        'profile': request.user.profile
+        'profile': profile,
+        'avatar_url': thumbnails.urls(profile.avatar_thumbnails).get('medium'),
     })
@@ -0,0 +1,314 @@
+import asyncio
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import uuid
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, IntegrityError, transaction
+from django.utils.dateparse import parse_datetime
+
+from . import metrics, search
+from .conf import get_config
+from .ids import allocate_message_id, get_worker_id
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'ENABLED': False,
+    'BATCH_SIZE': 200,
+    'FLUSH_INTERVAL': 0.25,
+    'JOURNAL_DIR': None,
+    'FSYNC': False,
+    # Flushes a row the database rejects is retried for before giving up
+    'MAX_ATTEMPTS': 40,
+}
+
+
+def get_settings():
+    return get_config('CHAT_WRITE_BEHIND', DEFAULTS)
+
+
+def is_enabled():
+    return bool(get_settings()['ENABLED'])
+
+
+class MessageJournal:
+    """Append-only JSONL segments holding rows that are not yet in the database.
+
+    Each flush rotates the active segment; a rotated segment is deleted only
+    once its rows have been committed, so a crash leaves every unwritten row on
+    disk for :meth:`recover` to replay.
+
+    A directory belongs to one live process at a time (enforced with a lock
+    file), and segments are named after a random id per process, so any
+    segment with another id was left by a previous process and is safe to
+    replay, whatever pids the container hands out after a restart.
+    """
+
+    def __init__(self, directory, fsync=False):
+        self.directory = directory
+        self.fsync = fsync
+        self.owner = uuid.uuid4().hex
+        self._counter = 0
+        self._fd = None
+        self._path = None
+        self._rotated = []
+        os.makedirs(directory, exist_ok=True)
+        self._lock_fd = os.open(os.path.join(directory, 'lock'), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self._lock_fd)
+            raise ImproperlyConfigured(
+                f'Write-behind journal {directory} is in use by another process; '
+                'give every worker its own CHAT_WORKER_ID'
+            )
+
+    def append(self, row):
+        if self._fd is None:
+            self._counter += 1
+            self._path = os.path.join(self.directory, f'{self.owner}-{self._counter}.jsonl')
+            self._fd = os.open(self._path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        os.write(self._fd, (json.dumps(row) + '\n').encode())
+        if self.fsync:
+            os.fsync(self._fd)
+
+    def rotate(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._rotated.append(self._path)
+            self._fd = None
+            self._path = None
+
+    def discard_rotated(self):
+        for path in self._rotated:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._rotated = []
+
+    def orphaned_segments(self):
+        """Segments written by earlier processes, i.e. every one this journal doesn't own."""
+        return [
+            os.path.join(self.directory, name)
+            for name in sorted(os.listdir(self.directory))
+            if name.endswith('.jsonl') and not name.startswith(f'{self.owner}-')
+        ]
+
+
+def _build_message(row):
+    return Message(
+        id=row['id'],
+        room_id=row['room_id'],
+        user_id=row['user_id'],
+        parent_message_id=row.get('parent_message_id'),
+        thread_root_id=row.get('thread_root_id'),
+        content=row['content'],
+        file=row.get('file') or None,
+        timestamp=parse_datetime(row['timestamp']),
+    )
+
+
+def write_rows(rows):
+    """Insert ``rows`` in one statement, falling back to row-by-row on bad data.
+
+    Returns ``(written, failed)``. Rows already in the table, from a journal
+    replayed after a crash between commit and cleanup, are skipped. An id
+    held by a different message means two processes allocated the same id;
+    the row is stored under a fresh id rather than lost. Rows the database
+    still rejects, typically a reply whose parent is queued on another
+    worker, are returned in ``failed`` for the caller to retry.
+    """
+    rows = {row['id']: row for row in rows}
+    messages = {message_id: _build_message(row) for message_id, row in rows.items()}
+    stored = Message.objects.filter(pk__in=list(messages)).values_list('pk', 'room_id', 'user_id', 'timestamp')
+    for message_id, room_id, user_id, timestamp in stored:
+        message = messages[message_id]
+        if (room_id, user_id, timestamp) == (message.room_id, message.user_id, message.timestamp):
+            del messages[message_id]
+        else:
+            message.id = allocate_message_id()
+            logger.error('Message id %s was already taken; stored as %s', message_id, message.id)
+    try:
+        with transaction.atomic():
+            Message.objects.bulk_create(list(messages.values()))
+        search.index_messages(list(messages.values()))
+        return len(messages), []
+    except IntegrityError:
+        logger.warning('Write-behind batch of %d rejected; retrying row by row', len(messages))
+    written = 0
+    failed = []
+    for message_id, message in messages.items():
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create([message])
+            search.index_messages([message])
+            written += 1
+        except IntegrityError:
+            failed.append(rows[message_id])
+    return written, failed
+
+
+class WriteBehindBuffer:
+    """Queues chat messages in memory and persists them with ``bulk_create``.
+
+    A batch is written when it reaches ``BATCH_SIZE`` rows or ``FLUSH_INTERVAL``
+    seconds after its first row was queued, whichever comes first.
+    """
+
+    def __init__(self, batch_size, flush_interval, journal=None, max_attempts=40):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.journal = journal
+        self.max_attempts = max_attempts
+        self.pending = []
+        self._timer = None
+        self._lock = None
+        self._loop = None
+        self._thread_lock = threading.Lock()
+        self._recovered = False
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._lock = asyncio.Lock()
+            self._timer = None
+        return loop
+
+    async def enqueue(self, row):
+        loop = self._bind_loop()
+        if not self._recovered:
+            await metrics.db_call(self.recover)()
+        with self._thread_lock:
+            if self.journal is not None:
+                self.journal.append(row)
+            self.pending.append(row)
+            size = len(self.pending)
+        if size >= self.batch_size:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_interval, self._flush_soon)
+
+    def _flush_soon(self):
+        self._timer = None
+        asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        self._bind_loop()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            await metrics.db_call(self.flush_sync)()
+        if self.pending and self._timer is None:
+            self._timer = self._loop.call_later(self.flush_interval, self._flush_soon)
+
+    def flush_sync(self):
+        with self._thread_lock:
+            batch, self.pending = self.pending, []
+            if self.journal is not None:
+                self.journal.rotate()
+        if not batch:
+            return 0
+        try:
+            written, failed = write_rows(batch)
+        except DatabaseError:
+            logger.exception('Write-behind flush of %d messages failed; will retry', len(batch))
+            with self._thread_lock:
+                self.pending[:0] = batch
+            return 0
+        self._requeue(failed)
+        return written
+
+    def _requeue(self, rows):
+        """Queue rejected ``rows`` for the next flush, then drop the segments
+        holding the rest of the batch.
+
+        The rows were already broadcast, so they are retried rather than
+        dropped; a reply whose parent never arrives is finally stored
+        without it.
+        """
+        retry = []
+        for row in rows:
+            row['attempts'] = row.get('attempts', 0) + 1
+            if row['attempts'] == self.max_attempts and row.get('parent_message_id'):
+                logger.warning('Parent of message %s never arrived; storing it without one', row['id'])
+                row.update(parent_message_id=None, thread_root_id=None)
+            if row['attempts'] <= self.max_attempts:
+                retry.append(row)
+            else:
+                logger.error('Dropping unwritable message %s', row['id'])
+        with self._thread_lock:
+            if self.journal is not None:
+                # Journaled again before the old segments go
+                for row in retry:
+                    self.journal.append(row)
+                self.journal.discard_rotated()
+            self.pending[:0] = retry
+
+    def recover(self):
+        """Replay journal segments left behind by earlier processes."""
+        if self._recovered or self.journal is None:
+            self._recovered = True
+            return 0
+        self._recovered = True
+        paths = self.journal.orphaned_segments()
+        rows = []
+        for path in paths:
+            with open(path) as segment:
+                rows.extend(json.loads(line) for line in segment if line.strip())
+        replayed = 0
+        if rows:
+            # Ids are time-ordered, so parents are inserted before their replies
+            rows.sort(key=lambda row: row['id'])
+            replayed, failed = write_rows(rows)
+            self._requeue(failed)
+        for path in paths:
+            os.remove(path)
+        if replayed:
+            logger.info('Replayed %d journaled messages', replayed)
+        return replayed
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    global _buffer
+    if _buffer is None:
+        with _buffer_lock:
+            if _buffer is None:
+                config = get_settings()
+                journal = None
+                if config['JOURNAL_DIR']:
+                    # One directory per worker id, so a restarted worker replays its own
+                    journal = MessageJournal(
+                        os.path.join(config['JOURNAL_DIR'], f'worker-{get_worker_id()}'), fsync=config['FSYNC']
+                    )
+                _buffer = WriteBehindBuffer(
+                    config['BATCH_SIZE'], config['FLUSH_INTERVAL'], journal=journal,
+                    max_attempts=config['MAX_ATTEMPTS']
+                )
+                atexit.register(_buffer.flush_sync)
+    return _buffer
+
+
+def startup():
+    """Replay what a crashed predecessor left in the journal before serving."""
+    if is_enabled():
+        get_buffer().recover()
+
+
+@metrics.collector
+def _collect():
+    pending = len(_buffer.pending) if _buffer is not None else 0
+    yield ('chat_write_behind_pending', 'gauge', 'Messages queued by write-behind and not yet written',
+           [({}, pending)])